@@ -1,14 +1,43 @@
-from .clip import CLIPClient
-from .diffusion import DiffusionClient
+from .cache import LRUCache
+from .clip import CLIPBatcher, CLIPClient
+from .device import resolve_device
+from .embedding_map import EmbeddingMapClient
+from .lazy import LazyClient
 from .local_storage import LocalStorageClient
+from .map_tile import MapTileClient
+from .numpy_store import NumpyVectorStore
+from .presets import SAMPLING_PRESETS, SamplingPreset, get_sampling_preset
 from .qdrant import QdrantClientManager
-from .sqlite import ImageMetadata, SQLiteClient
+from .sqlite import GenerationJob, ImageMetadata, SQLiteClient
+from .vector_store import VectorStore, create_vector_store
 
 __all__ = [
+    "SAMPLING_PRESETS",
+    "CLIPBatcher",
     "CLIPClient",
     "DiffusionClient",
+    "EmbeddingMapClient",
+    "GenerationJob",
     "ImageMetadata",
+    "LRUCache",
+    "LazyClient",
     "LocalStorageClient",
+    "MapTileClient",
+    "NumpyVectorStore",
     "QdrantClientManager",
     "SQLiteClient",
+    "SamplingPreset",
+    "VectorStore",
+    "create_vector_store",
+    "get_sampling_preset",
+    "resolve_device",
 ]
+
+
+def __getattr__(name: str):
+    # diffusersのimportは重いため、画像生成のクライアントは最初に参照されたときにimportする
+    if name == "DiffusionClient":
+        from .diffusion import DiffusionClient
+
+        return DiffusionClient
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
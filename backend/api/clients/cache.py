@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+from api.schema import CacheStats
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """スレッドセーフなLRUキャッシュ (ヒット・ミス数を記録する)
+
+    max_bytes を指定した場合は sizeof で見積もった合計サイズも上限として扱う
+    ttl_seconds を指定した場合は追加から一定時間が経ったエントリを期限切れとして扱う
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int,
+        max_bytes: int | None = None,
+        sizeof: Callable[[V], int] | None = None,
+        ttl_seconds: float | None = None,
+    ):
+        self.name = name
+        # 0以下の場合はキャッシュしない
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[K, V] = OrderedDict()
+        self._sizes: dict[K, int] = {}
+        self._expires_at: dict[K, float] = {}
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: K) -> V | None:
+        """キーに対応する値を取得 (なければNone)"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            if self._is_expired(key):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: K, value: V):
+        """値を追加し、上限を超えた分を古い順に削除"""
+        if self.max_size <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        # 単体で上限を超えるものはキャッシュしない
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._sizes[key]
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            if self.ttl_seconds is not None:
+                self._expires_at[key] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def items(self) -> list[tuple[K, V]]:
+        """期限切れでないエントリを古い順に取得 (ヒット数には数えない)"""
+        with self._lock:
+            return [
+                (key, value)
+                for key, value in self._entries.items()
+                if not self._is_expired(key)
+            ]
+
+    def clear(self):
+        """全てのエントリを削除"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._expires_at.clear()
+            self.total_bytes = 0
+
+    def _is_expired(self, key: K) -> bool:
+        expires_at = self._expires_at.get(key)
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _remove(self, key: K):
+        del self._entries[key]
+        self.total_bytes -= self._sizes.pop(key)
+        self._expires_at.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def stats(self) -> CacheStats:
+        """キャッシュの統計情報を取得"""
+        with self._lock:
+            return CacheStats(
+                name=self.name,
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size_bytes=self.total_bytes if self.sizeof is not None else None,
+                max_bytes=self.max_bytes,
+            )
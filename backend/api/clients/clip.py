@@ -1,15 +1,25 @@
+import asyncio
+import os
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any
+
 import numpy as np
-import torch
 from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
 
+from api.clients.cache import LRUCache
+from api.clients.device import resolve_device
 from api.config import Settings
 
 
 class CLIPClient:
     def __init__(self, settings: Settings):
+        # torch・transformersのimportは重いため、モデルを作るときまで遅らせる
+        from transformers import CLIPModel, CLIPProcessor
+
         self.clip_model = CLIPModel.from_pretrained(settings.CLIP_EMBEDDING_MODEL).to(
-            settings.DEVICE
+            resolve_device(settings.DEVICE)
         )
         self.clip_processor = CLIPProcessor.from_pretrained(
             settings.CLIP_EMBEDDING_MODEL
@@ -17,20 +27,185 @@ class CLIPClient:
 
     def generate_image_embedding(self, image: Image.Image) -> np.ndarray:
         """画像の埋め込みベクトルを生成"""
+        return self.generate_image_embeddings([image])[0]
+
+    def generate_text_embedding(self, text: str) -> np.ndarray:
+        """テキストの埋め込みベクトルを生成"""
+        return self.generate_text_embeddings([text])[0]
+
+    def generate_image_embeddings(self, images: Sequence[Image.Image]) -> np.ndarray:
+        """複数画像の埋め込みベクトルを1回のforwardでまとめて生成 (shape: [N, dim])"""
+        import torch
+
         with torch.no_grad():
-            inputs = self.clip_processor(images=image, return_tensors="pt").to(
+            inputs = self.clip_processor(images=list(images), return_tensors="pt").to(
                 self.clip_model.device
             )
             outputs = self.clip_model.get_image_features(**inputs)
-            image_embedding = outputs.cpu().numpy()
-            return image_embedding[0] / np.linalg.norm(image_embedding[0])
+            return self._normalize(outputs.cpu().numpy())
+
+    def generate_text_embeddings(self, texts: Sequence[str]) -> np.ndarray:
+        """複数テキストの埋め込みベクトルを1回のforwardでまとめて生成 (shape: [N, dim])"""
+        import torch
 
-    def generate_text_embedding(self, text: str) -> np.ndarray:
-        """テキストの埋め込みベクトルを生成"""
         with torch.no_grad():
             inputs = self.clip_processor(
-                text=[text], return_tensors="pt", padding=True, truncation=True
+                text=list(texts), return_tensors="pt", padding=True, truncation=True
             ).to(self.clip_model.device)
             outputs = self.clip_model.get_text_features(**inputs)
-            text_embedding = outputs.cpu().numpy()
-            return text_embedding[0] / np.linalg.norm(text_embedding[0])
+            return self._normalize(outputs.cpu().numpy())
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """行ごとにL2正規化"""
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+class CLIPBatcher:
+    """同時に来た埋め込みリクエストを数ミリ秒だけ溜め、1回のバッチforwardで処理する"""
+
+    def __init__(
+        self,
+        clip_client: CLIPClient,
+        settings: Settings,
+        submit: Callable[..., Future] | None = None,
+    ):
+        self.clip_client = clip_client
+        self.max_batch_size = settings.CLIP_BATCH_MAX_SIZE
+        self.max_wait = settings.CLIP_BATCH_MAX_WAIT_MS / 1000
+        # submit(fn, *args) でバッチ推論を投入する (推論レーンの流量制限を通すため)
+        # Noneの場合はイベントループのデフォルトExecutorで実行する
+        self.submit = submit
+        self._pending: dict[str, list[tuple[Any, asyncio.Future]]] = {
+            "image": [],
+            "text": [],
+        }
+        self._timers: dict[str, asyncio.Handle | None] = {
+            "image": None,
+            "text": None,
+        }
+        # 実行中のバッチタスク (GCで回収されないよう参照を保持する)
+        self._tasks: set[asyncio.Task] = set()
+
+        # (モデル名, テキスト) -> 正規化済みのテキスト埋め込み
+        self.model_name = settings.CLIP_EMBEDDING_MODEL
+        self.text_embedding_cache: LRUCache[tuple[str, str], np.ndarray] = LRUCache(
+            "text_embedding",
+            settings.TEXT_EMBEDDING_CACHE_SIZE,
+            ttl_seconds=settings.TEXT_EMBEDDING_CACHE_TTL_SECONDS,
+        )
+        self.text_embedding_cache_path = (
+            Path(settings.TEXT_EMBEDDING_CACHE_PATH)
+            if settings.TEXT_EMBEDDING_CACHE_PATH
+            else None
+        )
+        self.load_text_embedding_cache()
+
+    async def embed_image(self, image: Image.Image) -> np.ndarray:
+        """画像の埋め込みベクトルを (他のリクエストとまとめて) 生成"""
+        return await self._submit("image", image)
+
+    async def embed_text(self, text: str) -> np.ndarray:
+        """テキストの埋め込みベクトルを (他のリクエストとまとめて) 生成 (キャッシュがあればモデルを使わない)"""
+        key = (self.model_name, text)
+        cached = self.text_embedding_cache.get(key)
+        if cached is not None:
+            return cached
+        embedding = await self._submit("text", text)
+        # キャッシュした配列を呼び出し側が書き換えないよう読み取り専用にする
+        embedding.setflags(write=False)
+        self.text_embedding_cache.put(key, embedding)
+        return embedding
+
+    def load_text_embedding_cache(self) -> int:
+        """保存されたテキスト埋め込みを読み込み、読み込んだ件数を返す"""
+        path = self.text_embedding_cache_path
+        if path is None or not path.exists():
+            return 0
+        data = np.load(path)
+        loaded = 0
+        for model_name, text, embedding in zip(
+            data["model_names"], data["texts"], data["embeddings"], strict=True
+        ):
+            # 別のモデルで作った埋め込みは使わない
+            if str(model_name) != self.model_name:
+                continue
+            embedding.setflags(write=False)
+            self.text_embedding_cache.put((self.model_name, str(text)), embedding)
+            loaded += 1
+        return loaded
+
+    def save_text_embedding_cache(self) -> int:
+        """キャッシュ中のテキスト埋め込みをファイルに保存し、保存した件数を返す"""
+        path = self.text_embedding_cache_path
+        if path is None:
+            return 0
+        items = self.text_embedding_cache.items()
+        if not items:
+            return 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 一時ファイルに書いてから置き換えることで、書き込み途中の状態を読ませない
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            model_names=np.array([model_name for (model_name, _), _ in items]),
+            texts=np.array([text for (_, text), _ in items], dtype=str),
+            embeddings=np.stack([embedding for _, embedding in items]),
+        )
+        os.replace(tmp_path, path)
+        return len(items)
+
+    async def _submit(self, kind: str, item: Any) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        pending = self._pending[kind]
+        pending.append((item, future))
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(kind)
+        elif self._timers[kind] is None:
+            self._timers[kind] = loop.call_later(self.max_wait, self._flush, kind)
+
+        return await future
+
+    def _flush(self, kind: str):
+        """溜まっているリクエストを取り出してバッチ推論を開始"""
+        timer = self._timers[kind]
+        if timer is not None:
+            timer.cancel()
+            self._timers[kind] = None
+
+        batch = self._pending[kind][: self.max_batch_size]
+        self._pending[kind] = self._pending[kind][self.max_batch_size :]
+        if self._pending[kind]:
+            # 上限を超えた分は次のバッチとしてすぐに処理する
+            loop = asyncio.get_running_loop()
+            self._timers[kind] = loop.call_soon(self._flush, kind)
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(kind, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, kind: str, batch: list[tuple[Any, asyncio.Future]]):
+        def embed_fn(items: list[Any]) -> np.ndarray:
+            # 遅延ロードのクライアントでもイベントループを止めないよう、Executor内で参照する
+            if kind == "image":
+                return self.clip_client.generate_image_embeddings(items)
+            return self.clip_client.generate_text_embeddings(items)
+
+        items = [item for item, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            if self.submit is not None:
+                embeddings = await asyncio.wrap_future(self.submit(embed_fn, items))
+            else:
+                embeddings = await loop.run_in_executor(None, embed_fn, items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(batch, embeddings, strict=True):
+            if not future.done():
+                future.set_result(embedding)
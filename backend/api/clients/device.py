@@ -0,0 +1,11 @@
+def resolve_device(device: str) -> str:
+    """設定のデバイスを解決 ("auto"の場合は利用できるものを選ぶ)"""
+    if device != "auto":
+        return device
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
@@ -1,27 +1,215 @@
+import threading
+from collections.abc import Callable
+from typing import Any
+
+import diffusers
 import torch
-from diffusers import FluxControlNetModel, FluxControlNetPipeline
+from diffusers import (
+    FluxControlNetModel,
+    FluxControlNetPipeline,
+    FluxPipeline,
+    FluxTransformer2DModel,
+)
 from PIL import Image
+from transformers import T5EncoderModel
 
+from api.clients.cache import LRUCache
+from api.clients.device import resolve_device
+from api.clients.presets import SamplingPreset, get_sampling_preset
 from api.config import Settings
 
+DIFFUSION_DTYPES = ("bfloat16", "float16", "float32")
+DIFFUSION_OFFLOAD_MODES = ("none", "model", "sequential")
+DIFFUSION_QUANTIZATIONS = ("none", "int8", "nf4")
+
+
+def build_quantization_configs(
+    quantization: str, dtype: torch.dtype
+) -> tuple[Any, Any]:
+    """トランスフォーマー (diffusers) とT5エンコーダ (transformers) の量子化設定を作成"""
+    if quantization == "none":
+        return None, None
+    if quantization == "int8":
+        # torchaoのint8 weight-only量子化 (CPUでも使える)
+        from diffusers import TorchAoConfig as DiffusersTorchAoConfig
+        from transformers import TorchAoConfig as TransformersTorchAoConfig
+
+        return (
+            DiffusersTorchAoConfig("int8_weight_only"),
+            TransformersTorchAoConfig("int8_weight_only"),
+        )
+    if quantization == "nf4":
+        # bitsandbytesの4bit量子化 (CUDAが必要)
+        from diffusers import BitsAndBytesConfig as DiffusersBitsAndBytesConfig
+        from transformers import BitsAndBytesConfig as TransformersBitsAndBytesConfig
+
+        kwargs = {
+            "load_in_4bit": True,
+            "bnb_4bit_quant_type": "nf4",
+            "bnb_4bit_compute_dtype": dtype,
+        }
+        return (
+            DiffusersBitsAndBytesConfig(**kwargs),
+            TransformersBitsAndBytesConfig(**kwargs),
+        )
+    raise ValueError(f"Unknown diffusion quantization: {quantization}")
+
 
 class DiffusionClient:
     def __init__(self, settings: Settings):
-        self.pipe = self._load_pipeline(settings)
+        self.pipe, self.base_pipe = self._load_pipeline(settings)
+        # (有効なLoRAアダプタ, プロンプト) -> (prompt_embeds, pooled_prompt_embeds)
+        self.prompt_embedding_cache: LRUCache[
+            tuple[str | None, str], tuple[torch.Tensor, torch.Tensor]
+        ] = LRUCache("prompt_embedding", settings.PROMPT_EMBEDDING_CACHE_SIZE)
+        self._active_adapter: str | None = None
+
+        # プリセットの切り替えはパイプライン全体の状態を変えるため、生成は1件ずつ行う
+        self._lock = threading.Lock()
+        self.enabled_presets = settings.DIFFUSION_PRESETS
+        self.default_preset = get_sampling_preset(
+            settings.DIFFUSION_DEFAULT_PRESET, self.enabled_presets
+        ).name
+        self.presets = {
+            name: get_sampling_preset(name, self.enabled_presets)
+            for name in self.enabled_presets
+        }
+        self._load_presets(settings)
+
+    def _load_pipeline(self, settings) -> tuple[FluxControlNetPipeline, FluxPipeline]:
+        """ControlNetありとなしのFluxのパイプラインをロード (メモリ設定に応じて量子化・オフロードする)"""
+        if settings.DIFFUSION_DTYPE not in DIFFUSION_DTYPES:
+            raise ValueError(f"Unknown diffusion dtype: {settings.DIFFUSION_DTYPE}")
+        if settings.DIFFUSION_OFFLOAD not in DIFFUSION_OFFLOAD_MODES:
+            raise ValueError(
+                f"Unknown diffusion offload mode: {settings.DIFFUSION_OFFLOAD}"
+            )
+        dtype = getattr(torch, settings.DIFFUSION_DTYPE)
 
-    def _load_pipeline(self, settings):
-        """Fluxのパイプラインをロード"""
         controlnet = FluxControlNetModel.from_pretrained(
-            settings.CONTROLNET_MODEL, torch_dtype=torch.bfloat16
+            settings.CONTROLNET_MODEL, torch_dtype=dtype
+        )
+
+        # 量子化する場合は、大きい2つ (トランスフォーマーとT5エンコーダ) を個別にロードする
+        components = {}
+        transformer_config, text_encoder_config = build_quantization_configs(
+            settings.DIFFUSION_QUANTIZATION, dtype
         )
+        if transformer_config is not None:
+            components["transformer"] = FluxTransformer2DModel.from_pretrained(
+                settings.SD_BASE_MODEL,
+                subfolder="transformer",
+                quantization_config=transformer_config,
+                torch_dtype=dtype,
+            )
+            components["text_encoder_2"] = T5EncoderModel.from_pretrained(
+                settings.SD_BASE_MODEL,
+                subfolder="text_encoder_2",
+                quantization_config=text_encoder_config,
+                torch_dtype=dtype,
+            )
 
         pipe = FluxControlNetPipeline.from_pretrained(
             settings.SD_BASE_MODEL,
             controlnet=[controlnet],
-            torch_dtype=torch.bfloat16,
-        ).to(settings.DEVICE)
+            torch_dtype=dtype,
+            **components,
+        )
+        # 条件画像がない場合に使う、ControlNetを含まないパイプライン
+        # (ロード済みのトランスフォーマー・VAE・テキストエンコーダを共有するので重みは増えない)
+        # オフロードのフックを付ける前に作る
+        base_pipe = FluxPipeline.from_pipe(pipe)
+        # オフロードのフックは共有しているモジュール自体に付くので、全モジュールを持つpipeにだけ適用する
+        # (base_pipeにも適用すると、pipeのフックが外されてControlNetだけが古いフックのまま残る)
+        self._apply_memory_settings(pipe, settings)
+
+        return pipe, base_pipe
+
+    def _load_presets(self, settings):
+        """プリセットで使うスケジューラ・LoRA・コンパイル済みのトランスフォーマーを準備"""
+        base_config = self.pipe.scheduler.config
+        self._schedulers = {
+            name: (
+                getattr(diffusers, preset.scheduler).from_config(
+                    base_config, **preset.scheduler_kwargs
+                )
+                if preset.scheduler
+                else self.pipe.scheduler
+            )
+            for name, preset in self.presets.items()
+        }
 
-        return pipe
+        # LoRAはアダプタとして全て読み込んでおき、リクエストごとに切り替える
+        self._lora_presets = [
+            preset.name for preset in self.presets.values() if preset.lora_repo
+        ]
+        for name in self._lora_presets:
+            preset = self.presets[name]
+            self.pipe.load_lora_weights(
+                preset.lora_repo, weight_name=preset.lora_weight_name, adapter_name=name
+            )
+
+        # コンパイル済みのモジュールは元の重みを共有するので、メモリは増えない
+        self._transformer = self.pipe.transformer
+        self._compiled_transformer = None
+        compiled_presets = [
+            preset.name for preset in self.presets.values() if preset.compile
+        ]
+        if compiled_presets:
+            self._compiled_transformer = torch.compile(self._transformer)
+            if settings.DIFFUSION_COMPILE_WARMUP:
+                # 最初のリクエストでコンパイルを待たせないよう、小さい画像で1回生成する
+                self.generate_image(
+                    prompt="warm-up",
+                    control_images=[],
+                    width=512,
+                    height=512,
+                    controlnet_conditioning_scale=[],
+                    control_guidance_end=[],
+                    num_inference_steps=2,
+                    guidance_scale=3.5,
+                    seed=0,
+                    preset=compiled_presets[0],
+                )
+
+    def _activate_preset(
+        self, pipe: FluxControlNetPipeline | FluxPipeline, preset: SamplingPreset
+    ):
+        """パイプラインのスケジューラ・LoRA・トランスフォーマーをプリセットに合わせる"""
+        pipe.scheduler = self._schedulers[preset.name]
+        if self._lora_presets:
+            if preset.lora_repo:
+                pipe.enable_lora()
+                pipe.set_adapters([preset.name], adapter_weights=[preset.lora_scale])
+            else:
+                pipe.disable_lora()
+        self._active_adapter = preset.name if preset.lora_repo else None
+        pipe.transformer = (
+            self._compiled_transformer
+            if preset.compile and self._compiled_transformer is not None
+            else self._transformer
+        )
+
+    @staticmethod
+    def _apply_memory_settings(pipe, settings):
+        """オフロード・VAEのタイル分割などのメモリ設定をパイプラインに適用"""
+        device = resolve_device(settings.DEVICE)
+        if settings.DIFFUSION_OFFLOAD == "model":
+            # 使うモデルだけをデバイスに載せる (速度の低下は小さい)
+            pipe.enable_model_cpu_offload(device=device)
+        elif settings.DIFFUSION_OFFLOAD == "sequential":
+            # 層単位でデバイスに載せる (メモリは最小だが大幅に遅い)
+            pipe.enable_sequential_cpu_offload(device=device)
+        else:
+            pipe.to(device)
+
+        if settings.DIFFUSION_VAE_TILING:
+            pipe.vae.enable_tiling()
+        if settings.DIFFUSION_VAE_SLICING:
+            pipe.vae.enable_slicing()
+        if settings.DIFFUSION_ATTENTION_SLICING:
+            # 分割に対応していないモデル (Fluxのトランスフォーマー等) では何もしない
+            pipe.enable_attention_slicing()
 
     def generate_image(
         self,
@@ -34,19 +222,142 @@ class DiffusionClient:
         num_inference_steps: int,
         guidance_scale: float,
         seed: int,
+        step_callback: Callable[[int, int], None] | None = None,
+        preset: str | None = None,
     ) -> Image.Image:
         """パラメータに基づいて画像を1枚生成"""
-        # Generate images
-        image: Image.Image = self.pipe(
-            prompt=prompt,
-            control_image=control_images,
+        return self.generate_images(
+            prompts=[prompt],
+            control_images=control_images,
             width=width,
             height=height,
             controlnet_conditioning_scale=controlnet_conditioning_scale,
             control_guidance_end=control_guidance_end,
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
-            generator=torch.Generator(device=self.pipe.device).manual_seed(seed),
-        ).images[0]  # type: ignore
+            seeds=[seed],
+            step_callback=step_callback,
+            preset=preset,
+        )[0]
+
+    def generate_images(
+        self,
+        prompts: list[str],
+        control_images: list[Image.Image] | Image.Image,
+        width: int,
+        height: int,
+        controlnet_conditioning_scale: list[float] | float,
+        control_guidance_end: list[float] | float,
+        num_inference_steps: int,
+        guidance_scale: float,
+        seeds: list[int],
+        step_callback: Callable[[int, int], None] | None = None,
+        preset: str | None = None,
+    ) -> list[Image.Image]:
+        """プロンプトとシードの組ごとに画像を生成 (1回のパイプライン呼び出しでまとめて処理)
+
+        サイズ・条件画像は全ての画像で共通
+        条件画像がない場合はControlNetを使わずに生成する
+        プリセットのステップ数・ガイダンスが指定されている場合は引数の値より優先する
+        """
+        if len(prompts) != len(seeds):
+            raise ValueError("Prompts and seeds must match in length.")
+        sampling_preset = get_sampling_preset(
+            preset or self.default_preset, self.enabled_presets
+        )
+        num_inference_steps, guidance_scale = sampling_preset.resolve(
+            num_inference_steps, guidance_scale
+        )
+
+        # Generate images
+        pipe = self.pipe if control_images else self.base_pipe
+        control_kwargs = (
+            {
+                "control_image": control_images,
+                "controlnet_conditioning_scale": controlnet_conditioning_scale,
+                "control_guidance_end": control_guidance_end,
+            }
+            if control_images
+            else {}
+        )
+        with self._lock:
+            self._activate_preset(pipe, sampling_preset)
+            # LoRAの切り替えがテキストエンコーダにも及ぶため、プリセットを有効にしてからエンコードする
+            # 同じプロンプトだけの場合は埋め込みを1件だけ渡して枚数分複製させる
+            if len(set(prompts)) == 1:
+                prompt_embeds, pooled_prompt_embeds = self.encode_prompts(prompts[:1])
+                num_images_per_prompt = len(seeds)
+            else:
+                prompt_embeds, pooled_prompt_embeds = self.encode_prompts(prompts)
+                num_images_per_prompt = 1
+            images: list[Image.Image] = pipe(
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                num_images_per_prompt=num_images_per_prompt,
+                width=width,
+                height=height,
+                **control_kwargs,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                # オフロード時も同じシードで同じ画像になるよう、実行デバイスで乱数を作る
+                generator=[
+                    torch.Generator(device=pipe._execution_device).manual_seed(seed)
+                    for seed in seeds
+                ],
+                callback_on_step_end=self._to_pipeline_callback(
+                    step_callback, num_inference_steps
+                ),
+            ).images  # type: ignore
+            if pipe is self.base_pipe:
+                # base_pipeはフックの一覧を持たないので、pipeのフックで全モジュールをオフロードし直す
+                self.pipe.maybe_free_model_hooks()
+
+        return images
+
+    def encode_prompts(self, prompts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
+        """プロンプトをT5・CLIPのテキストエンコーダで埋め込む (キャッシュ済みのものは再利用)
+
+        現在有効なLoRAアダプタで埋め込むため、生成時はプリセットの切り替えと同じロックの中で呼ぶ
+        """
+        adapter = self._active_adapter
+        cached = {
+            prompt: self.prompt_embedding_cache.get((adapter, prompt))
+            for prompt in dict.fromkeys(prompts)
+        }
+        missing = [prompt for prompt, value in cached.items() if value is None]
+
+        # キャッシュにないプロンプトはまとめて1回でエンコードする
+        if missing:
+            with torch.no_grad():
+                prompt_embeds, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                    prompt=missing,
+                    prompt_2=None,
+                    device=self.pipe._execution_device,
+                )
+            for i, prompt in enumerate(missing):
+                value = (prompt_embeds[i : i + 1], pooled_prompt_embeds[i : i + 1])
+                cached[prompt] = value
+                self.prompt_embedding_cache.put((adapter, prompt), value)
+
+        embeddings = [cached[prompt] for prompt in prompts]
+        return (
+            torch.cat([prompt_embeds for prompt_embeds, _ in embeddings]),  # type: ignore
+            torch.cat([pooled for _, pooled in embeddings]),  # type: ignore
+        )
+
+    @staticmethod
+    def _to_pipeline_callback(
+        step_callback: Callable[[int, int], None] | None, num_inference_steps: int
+    ) -> Callable | None:
+        """(完了ステップ数, 総ステップ数) を受け取るコールバックをパイプライン用に変換
+
+        コールバック内で例外を送出すると生成を中断できる
+        """
+        if step_callback is None:
+            return None
+
+        def callback(pipe, step: int, timestep, callback_kwargs: dict) -> dict:
+            step_callback(step + 1, num_inference_steps)
+            return callback_kwargs
 
-        return image
+        return callback
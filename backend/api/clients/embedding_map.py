@@ -0,0 +1,229 @@
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from api.config import Settings
+
+
+class PCAProjection:
+    """numpyだけで計算する2次元PCA射影"""
+
+    def fit(self, embeddings: np.ndarray) -> "PCAProjection":
+        self.mean = embeddings.mean(axis=0)
+        centered = embeddings - self.mean
+        # 共分散行列 (dim x dim) の固有ベクトルのうち上位2つを使う
+        covariance = centered.T @ centered / max(len(embeddings) - 1, 1)
+        _, eigenvectors = np.linalg.eigh(covariance)
+        self.components = eigenvectors[:, ::-1][:, :2].T
+        return self
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        return (embeddings - self.mean) @ self.components.T
+
+
+class UMAPProjection:
+    """umap-learnによる2次元射影 (インストールされている場合のみ利用可能)"""
+
+    def fit(self, embeddings: np.ndarray) -> "UMAPProjection":
+        try:
+            import umap
+        except ImportError as e:
+            raise ImportError(
+                "MAP_PROJECTION_METHOD='umap' requires the umap-learn package."
+            ) from e
+        self.reducer = umap.UMAP(n_components=2, metric="cosine")
+        self.reducer.fit(embeddings)
+        return self
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        return self.reducer.transform(embeddings)
+
+
+PROJECTIONS: dict[str, type[PCAProjection] | type[UMAPProjection]] = {
+    "pca": PCAProjection,
+    "umap": UMAPProjection,
+}
+
+
+class EmbeddingMapClient:
+    """画像embeddingの2次元マップ (座標と学習済みの射影) をディスクに保存・管理する
+
+    座標は学習時にnpzへまとめて書き、それ以降の追加・削除はログに追記する
+    """
+
+    def __init__(self, settings: Settings):
+        self.map_dir = Path(settings.MAP_DIR)
+        self.map_dir.mkdir(parents=True, exist_ok=True)
+        self.method = settings.MAP_PROJECTION_METHOD
+        if self.method not in PROJECTIONS:
+            raise ValueError(f"Unknown map projection method: {self.method}")
+        self.coordinates_path = self.map_dir / "coordinates.npz"
+        self.projection_path = self.map_dir / "projection.pkl"
+        self.log_path = self.map_dir / "coordinates.log.jsonl"
+
+        self._lock = threading.Lock()
+        self.filenames: list[str] = []
+        self.coordinates = np.zeros((0, 2), dtype=np.float32)
+        self.version = 0
+        # タイル分割の基準となる正方形の範囲 [min_x, min_y, max_x, max_y]
+        self.bounds: np.ndarray | None = None
+        self.projection: Any = None
+        # npzに書いた時点のバージョン (ログがどのnpzに続くものかの判定に使う)
+        self._snapshot_version = 0
+        self._load()
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.projection is not None
+
+    def fit(self, filenames: list[str], embeddings: np.ndarray):
+        """全てのembeddingで射影を学習し直し、座標を計算して保存"""
+        projection = PROJECTIONS[self.method]().fit(embeddings)
+        coordinates = projection.transform(embeddings).astype(np.float32)
+        bounds = self._compute_bounds(coordinates)
+        with self._lock:
+            self.projection = projection
+            self.filenames = list(filenames)
+            self.coordinates = coordinates
+            self.bounds = bounds
+            self.version += 1
+            self._save()
+
+    def add_points(self, filenames: list[str], embeddings: np.ndarray) -> np.ndarray:
+        """学習済みの射影で新しい点を配置して保存 (未学習の場合は何もしない)"""
+        if not self.is_fitted or not filenames:
+            return np.zeros((0, 2), dtype=np.float32)
+        coordinates = self.projection.transform(embeddings).astype(np.float32)
+        with self._lock:
+            # 同じファイル名の点は置き換える
+            new_names = set(filenames)
+            keep = [i for i, name in enumerate(self.filenames) if name not in new_names]
+            self.filenames = [self.filenames[i] for i in keep] + list(filenames)
+            self.coordinates = np.concatenate([self.coordinates[keep], coordinates])
+            self.version += 1
+            self._append_log(
+                {"add": list(filenames), "coordinates": coordinates.tolist()}
+            )
+        return coordinates
+
+    def remove_points(self, filenames: list[str]) -> np.ndarray:
+        """指定したファイル名の点を削除して保存し、削除した点の座標を返す"""
+        removed_names = set(filenames)
+        with self._lock:
+            removed = [
+                i for i, name in enumerate(self.filenames) if name in removed_names
+            ]
+            if not removed:
+                return np.zeros((0, 2), dtype=np.float32)
+            removed_coordinates = self.coordinates[removed]
+            keep = np.ones(len(self.filenames), dtype=bool)
+            keep[removed] = False
+            self.filenames = [
+                name for name, kept in zip(self.filenames, keep, strict=True) if kept
+            ]
+            self.coordinates = self.coordinates[keep]
+            self.version += 1
+            self._append_log({"remove": sorted(removed_names)})
+        return removed_coordinates
+
+    def get_coordinates(self) -> tuple[list[str], np.ndarray, int]:
+        """(ファイル名, 座標 [N, 2] float32, バージョン) を取得"""
+        with self._lock:
+            return list(self.filenames), self.coordinates.copy(), self.version
+
+    def get_bounds(self) -> np.ndarray | None:
+        """学習時に決めたマップの範囲を取得 (未学習の場合はNone)"""
+        with self._lock:
+            return None if self.bounds is None else self.bounds.copy()
+
+    @staticmethod
+    def _compute_bounds(coordinates: np.ndarray) -> np.ndarray:
+        """座標を少し余白を持たせて囲む正方形の範囲を計算"""
+        minimum = coordinates.min(axis=0)
+        maximum = coordinates.max(axis=0)
+        center = (minimum + maximum) / 2
+        half = max(float((maximum - minimum).max()) / 2, 1e-6) * 1.05
+        return np.array(
+            [center[0] - half, center[1] - half, center[0] + half, center[1] + half],
+            dtype=np.float64,
+        )
+
+    def _load(self):
+        """保存済みのマップがあれば読み込む"""
+        if self.coordinates_path.exists():
+            data = np.load(self.coordinates_path, allow_pickle=False)
+            self.filenames = data["filenames"].tolist()
+            self.coordinates = data["coordinates"].astype(np.float32)
+            self.version = int(data["version"])
+            if "bounds" in data.files and data["bounds"].size == 4:
+                self.bounds = data["bounds"]
+            elif len(self.coordinates):
+                self.bounds = self._compute_bounds(self.coordinates)
+            self._snapshot_version = self.version
+        if self.log_path.exists():
+            self._replay_log()
+        if self.projection_path.exists():
+            with self.projection_path.open("rb") as f:
+                self.projection = pickle.load(f)
+
+    def _replay_log(self):
+        """npzに続く追加・削除のログを再生する"""
+        points = dict(zip(self.filenames, self.coordinates.tolist(), strict=True))
+        with self.log_path.open(encoding="utf-8") as f:
+            for line in f:
+                # 書き込み途中で止まった末尾の行は使わない
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                # 学習し直す前に書かれたログは使わない
+                if entry["base_version"] != self._snapshot_version:
+                    continue
+                for name in entry.get("remove", []):
+                    points.pop(name, None)
+                for name, coordinate in zip(
+                    entry.get("add", []), entry.get("coordinates", []), strict=True
+                ):
+                    # 同じファイル名の点は置き換えて末尾に移す
+                    points.pop(name, None)
+                    points[name] = coordinate
+                self.version = entry["version"]
+        self.filenames = list(points)
+        self.coordinates = np.array(list(points.values()), dtype=np.float32).reshape(
+            -1, 2
+        )
+
+    def _append_log(self, entry: dict):
+        """npzを書き直さず、変更分だけをログに追記する"""
+        entry = {
+            "base_version": self._snapshot_version,
+            "version": self.version,
+        } | entry
+        with self.log_path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _save(self):
+        """座標と射影を書き直し、それまでのログを捨てる
+
+        一時ファイルに書いてから置き換えることで、書き込み途中の状態を読ませない
+        """
+        tmp_path = self.coordinates_path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            filenames=np.array(self.filenames, dtype=str),
+            coordinates=self.coordinates,
+            version=np.array(self.version),
+            bounds=self.bounds if self.bounds is not None else np.zeros(0),
+        )
+        os.replace(tmp_path, self.coordinates_path)
+        self._snapshot_version = self.version
+        self.log_path.unlink(missing_ok=True)
+
+        tmp_path = self.projection_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump(self.projection, f)
+        os.replace(tmp_path, self.projection_path)
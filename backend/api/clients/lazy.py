@@ -0,0 +1,47 @@
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyClient(Generic[T]):
+    """最初に使われたときにクライアントを作成する (重いモデルのロードを起動時に行わない)
+
+    自身に定義されていない属性へのアクセスは、作成したクライアントにそのまま渡す
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self._factory = factory
+        self._client: T | None = None
+        self._lock = threading.Lock()
+        # 直近のロードにかかった時間と失敗した場合のエラー
+        self.load_seconds: float | None = None
+        self.error: str | None = None
+
+    @property
+    def loaded(self) -> bool:
+        """クライアントが作成済みか"""
+        return self._client is not None
+
+    def get(self) -> T:
+        """クライアントを取得 (未作成なら作成し、同時に呼ばれても1回だけ作る)"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                started_at = time.perf_counter()
+                try:
+                    self._client = self._factory()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.error = None
+                self.load_seconds = time.perf_counter() - started_at
+            return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
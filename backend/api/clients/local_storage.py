@@ -1,9 +1,33 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from PIL import Image
+from PIL import Image, ImageOps
 
+from api.clients.cache import LRUCache
 from api.config import Settings
 
+IMAGE_FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG"}
+THUMBNAIL_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def _image_nbytes(image: Image.Image) -> int:
+    """デコード済み画像のおおよそのメモリ使用量"""
+    return image.width * image.height * len(image.getbands())
+
+
+def _save_atomically(image: Image.Image, path: Path, image_format: str, **params):
+    """同じディレクトリの一時ファイルに書いてから置き換え、書き込み途中のファイルを読ませない"""
+    # 同じファイルを同時に書く場合に備えて、一時ファイル名は毎回変える
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        image.save(tmp_path, format=image_format, **params)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
 
 class LocalStorageClient:
     def __init__(self, settings: Settings):
@@ -11,17 +35,137 @@ class LocalStorageClient:
         self.control_image_dir = settings.CONDITION_IMAGE_DIR
         Path(self.image_dir).mkdir(parents=True, exist_ok=True)
         Path(self.control_image_dir).mkdir(parents=True, exist_ok=True)
+        self.image_format = settings.IMAGE_FORMAT
+        if self.image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format: {self.image_format}")
+        self.png_compress_level = settings.IMAGE_PNG_COMPRESS_LEVEL
+        self.image_quality = settings.IMAGE_QUALITY
+        self.thumbnail_dir = settings.THUMBNAIL_DIR
+        # 大きいサイズから順に縮小していく
+        self.thumbnail_sizes = sorted(settings.THUMBNAIL_SIZES, reverse=True)
+        self.thumbnail_format = settings.THUMBNAIL_FORMAT
+        if self.thumbnail_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unknown thumbnail format: {self.thumbnail_format}")
+        self.thumbnail_quality = settings.THUMBNAIL_QUALITY
+        # (ファイル名, 幅, 高さ, 更新時刻) -> デコード・リサイズ済みの条件画像
+        self.control_image_cache: LRUCache[
+            tuple[str | None, int, int, int], Image.Image
+        ] = LRUCache(
+            "control_image",
+            settings.CONTROL_IMAGE_CACHE_SIZE,
+            max_bytes=settings.CONTROL_IMAGE_CACHE_MAX_BYTES,
+            sizeof=_image_nbytes,
+        )
 
     def save_image(self, image: Image.Image, image_filename: str) -> Path:
-        """画像をローカルに保存"""
+        """画像をローカルに保存 (サムネイルも同時に作成)"""
         image_path = Path(self.image_dir) / image_filename
-        image.save(image_path)
+        # 形式は拡張子から決め、圧縮レベル・品質は設定に従う
+        _save_atomically(
+            image,
+            image_path,
+            Image.registered_extensions()[image_path.suffix.lower()],
+            compress_level=self.png_compress_level,
+            quality=self.image_quality,
+        )
+        self.save_thumbnails(image, image_filename)
         return image_path
 
     def delete_image(self, image_filename: str) -> bool:
-        """ローカルの画像を削除"""
+        """ローカルの画像を削除 (サムネイルも削除)"""
+        for size in self.thumbnail_sizes:
+            self.thumbnail_path(image_filename, size).unlink(missing_ok=True)
         image_path = Path(self.image_dir) / image_filename
         if image_path.exists():
             image_path.unlink()
             return True
         return False
+
+    def thumbnail_path(self, image_filename: str, size: int) -> Path:
+        """サムネイルの保存先 (THUMBNAIL_DIR/サイズ/元のファイル名.形式)"""
+        return (
+            Path(self.thumbnail_dir)
+            / str(size)
+            / f"{image_filename}.{self.thumbnail_format}"
+        )
+
+    def save_thumbnails(self, image: Image.Image, image_filename: str) -> list[Path]:
+        """設定された全サイズのサムネイルを作成して保存"""
+        thumbnail = image.convert("RGB")
+        paths = []
+        for size in self.thumbnail_sizes:
+            # 直前の (一回り大きい) サムネイルから縮小する
+            thumbnail = thumbnail.copy()
+            thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+            path = self.thumbnail_path(image_filename, size)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _save_atomically(
+                thumbnail,
+                path,
+                THUMBNAIL_FORMATS[self.thumbnail_format],
+                quality=self.thumbnail_quality,
+            )
+            paths.append(path)
+        return paths
+
+    def load_thumbnail_path(self, image_filename: str, size: int) -> Path:
+        """サムネイルのパスを取得 (まだなければ元画像から作成)"""
+        if size not in self.thumbnail_sizes:
+            raise ValueError(f"Thumbnail size must be one of {self.thumbnail_sizes}.")
+        path = self.thumbnail_path(image_filename, size)
+        if not path.exists():
+            with Image.open(Path(self.image_dir) / image_filename) as image:
+                self.save_thumbnails(image, image_filename)
+        return path
+
+    def backfill_thumbnails(self, workers: int = 4) -> tuple[int, int]:
+        """サムネイルがない保存済み画像についてサムネイルを作成し、(作成数, 失敗数) を返す"""
+        targets = [
+            path.name
+            for path in sorted(Path(self.image_dir).iterdir())
+            if path.is_file()
+            and not all(
+                self.thumbnail_path(path.name, size).exists()
+                for size in self.thumbnail_sizes
+            )
+        ]
+
+        def create(image_filename: str) -> bool:
+            try:
+                with Image.open(Path(self.image_dir) / image_filename) as image:
+                    self.save_thumbnails(image, image_filename)
+                return True
+            except OSError:
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(create, targets))
+        created = sum(results)
+        return created, len(results) - created
+
+    def load_control_image(
+        self, control_image_filename: str, width: int, height: int
+    ) -> Image.Image:
+        """条件画像を読み込み、生成サイズにリサイズして返す (更新されるまでキャッシュ)"""
+        image_path = Path(self.control_image_dir) / control_image_filename
+        # ファイルが更新された場合は更新時刻が変わるので別のキーになる
+        key = (
+            control_image_filename,
+            width,
+            height,
+            self.control_image_version(control_image_filename),
+        )
+        image = self.control_image_cache.get(key)
+        if image is None:
+            with Image.open(image_path) as f:
+                image = ImageOps.exif_transpose(f).convert("RGB")
+            if image.size != (width, height):
+                image = image.resize((width, height), Image.Resampling.LANCZOS)
+            self.control_image_cache.put(key, image)
+        return image
+
+    def control_image_version(self, control_image_filename: str) -> int:
+        """条件画像の更新時刻 (ナノ秒) を返す (差し替えられたかの判定に使う)"""
+        return (
+            (Path(self.control_image_dir) / control_image_filename).stat().st_mtime_ns
+        )
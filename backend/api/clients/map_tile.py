@@ -0,0 +1,185 @@
+import contextlib
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from api.config import Settings
+from api.schema import MapCluster, MapTile
+
+
+class MapTileClient:
+    """埋め込みマップの四分木タイルを計算し、ディスクにキャッシュする
+
+    ズームレベルzではマップの範囲を 2^z x 2^z のタイルに分け、
+    各タイルをさらに GRID_SIZE x GRID_SIZE のセルに分けて点をクラスタにまとめる
+    """
+
+    def __init__(self, settings: Settings):
+        self.tile_dir = Path(settings.MAP_DIR) / "tiles"
+        self.tile_dir.mkdir(parents=True, exist_ok=True)
+        self.max_zoom = settings.MAP_TILE_MAX_ZOOM
+        self.grid_size = settings.MAP_TILE_GRID_SIZE
+        # タイルの計算・保存と無効化が入れ違わないよう、ズームレベルごとにロックする
+        self._level_locks = [threading.Lock() for _ in range(self.max_zoom + 1)]
+        # ズームレベル -> (マップの版, (列, 行) -> タイル内の点のインデックス)
+        self._level_index: dict[int, tuple[int, dict[tuple[int, int], np.ndarray]]] = {}
+
+    def level_lock(self, z: int) -> threading.Lock:
+        """指定したズームレベルのタイルを読み書きする間に保持するロック"""
+        return self._level_locks[z]
+
+    def validate(self, z: int, x: int, y: int):
+        """タイル番号が範囲内か確認"""
+        if not 0 <= z <= self.max_zoom:
+            raise ValueError(f"Zoom level must be between 0 and {self.max_zoom}.")
+        n = 2**z
+        if not (0 <= x < n and 0 <= y < n):
+            raise ValueError(f"Tile ({x}, {y}) is out of range at zoom {z}.")
+
+    def load_tile(self, z: int, x: int, y: int) -> MapTile | None:
+        """キャッシュ済みのタイルを読み込む (なければNone)"""
+        path = self._tile_path(z, x, y)
+        if not path.exists():
+            return None
+        return MapTile.model_validate_json(path.read_text(encoding="utf-8"))
+
+    def save_tile(self, tile: MapTile):
+        """タイルをキャッシュに書き込む"""
+        path = self._tile_path(tile.z, tile.x, tile.y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(tile.model_dump_json(), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def build_tile(
+        self,
+        z: int,
+        x: int,
+        y: int,
+        filenames: list[str],
+        coordinates: np.ndarray,
+        bounds: np.ndarray,
+        version: int | None = None,
+    ) -> MapTile:
+        """タイル内の点をセルごとにまとめ、重心と代表画像を求める
+
+        versionを指定した場合、点のタイルへの振り分けをズームレベル・版ごとに1回だけ計算して使い回す
+        """
+        n = 2**z
+        tile_size = (bounds[2] - bounds[0]) / n
+        tile_min_x = bounds[0] + x * tile_size
+        tile_min_y = bounds[1] + y * tile_size
+        tile_bounds = [
+            float(tile_min_x),
+            float(tile_min_y),
+            float(tile_min_x + tile_size),
+            float(tile_min_y + tile_size),
+        ]
+
+        if version is None:
+            tile_x, tile_y = self._tile_indices(coordinates, bounds, n)
+            indices = np.flatnonzero((tile_x == x) & (tile_y == y))
+        else:
+            indices = self._points_by_tile(z, version, coordinates, bounds).get(
+                (x, y), np.zeros(0, dtype=np.int64)
+            )
+        if len(indices) == 0:
+            return MapTile(z=z, x=x, y=y, bounds=tile_bounds, count=0, clusters=[])
+
+        points = coordinates[indices].astype(np.float64)
+        cell_size = tile_size / self.grid_size
+        cell_x = np.clip(
+            ((points[:, 0] - tile_min_x) // cell_size).astype(np.int64),
+            0,
+            self.grid_size - 1,
+        )
+        cell_y = np.clip(
+            ((points[:, 1] - tile_min_y) // cell_size).astype(np.int64),
+            0,
+            self.grid_size - 1,
+        )
+        cells = cell_y * self.grid_size + cell_x
+
+        clusters = []
+        for cell in np.unique(cells):
+            members = np.flatnonzero(cells == cell)
+            centroid = points[members].mean(axis=0)
+            distances = np.linalg.norm(points[members] - centroid, axis=1)
+            representative = indices[members[int(distances.argmin())]]
+            clusters.append(
+                MapCluster(
+                    x=float(centroid[0]),
+                    y=float(centroid[1]),
+                    count=len(members),
+                    image_filename=filenames[representative],
+                )
+            )
+        return MapTile(
+            z=z,
+            x=x,
+            y=y,
+            bounds=tile_bounds,
+            count=len(indices),
+            clusters=clusters,
+        )
+
+    def invalidate(self, coordinates: np.ndarray, bounds: np.ndarray) -> int:
+        """指定した座標を含むタイルを全ズームレベルでキャッシュから削除し、削除数を返す"""
+        if len(coordinates) == 0:
+            return 0
+        removed = 0
+        for z in range(self.max_zoom + 1):
+            with self._level_locks[z]:
+                tile_x, tile_y = self._tile_indices(coordinates, bounds, 2**z)
+                for x, y in set(zip(tile_x.tolist(), tile_y.tolist(), strict=True)):
+                    path = self._tile_path(z, x, y)
+                    if path.exists():
+                        path.unlink()
+                        removed += 1
+        return removed
+
+    def clear(self):
+        """キャッシュ済みのタイルを全て削除"""
+        with contextlib.ExitStack() as stack:
+            for lock in self._level_locks:
+                stack.enter_context(lock)
+            shutil.rmtree(self.tile_dir, ignore_errors=True)
+            self.tile_dir.mkdir(parents=True, exist_ok=True)
+            self._level_index.clear()
+
+    def _points_by_tile(
+        self, z: int, version: int, coordinates: np.ndarray, bounds: np.ndarray
+    ) -> dict[tuple[int, int], np.ndarray]:
+        """ズームレベルzで、タイルごとに含まれる点のインデックスを求める (版が同じなら再利用)"""
+        cached = self._level_index.get(z)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        n = 2**z
+        tile_x, tile_y = self._tile_indices(coordinates, bounds, n)
+        keys = tile_y * n + tile_x
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        points_by_tile = {
+            (int(key % n), int(key // n)): indices
+            for key, indices in zip(
+                unique_keys.tolist(), np.split(order, starts[1:]), strict=True
+            )
+        }
+        self._level_index[z] = (version, points_by_tile)
+        return points_by_tile
+
+    def _tile_path(self, z: int, x: int, y: int) -> Path:
+        return self.tile_dir / str(z) / str(x) / f"{y}.json"
+
+    @staticmethod
+    def _tile_indices(
+        coordinates: np.ndarray, bounds: np.ndarray, n: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """各点が属するタイルの (列, 行) を計算 (範囲外の点は端のタイルに含める)"""
+        tile_size = (bounds[2] - bounds[0]) / n
+        tile_x = ((coordinates[:, 0] - bounds[0]) // tile_size).astype(np.int64)
+        tile_y = ((coordinates[:, 1] - bounds[1]) // tile_size).astype(np.int64)
+        return np.clip(tile_x, 0, n - 1), np.clip(tile_y, 0, n - 1)
@@ -0,0 +1,453 @@
+import json
+import os
+import re
+import threading
+from datetime import UTC, datetime
+from pathlib import Path
+
+import numpy as np
+from fastapi import HTTPException
+
+from api.config import Settings
+from api.schema import ScoredMetadata, SearchFilters
+
+VECTOR_NAMES = ("image", "text")
+# Qdrantの重み付きRRFと同じ定数
+RRF_RANKING_CONSTANT = 2
+# 1回の行列積で扱う行数 (float16の行列をfloat32に変換する際のメモリを抑える)
+SEARCH_CHUNK_ROWS = 65536
+# 絞り込みに使う行ごとの列 (行列と同じくメモリマップした .npy に保存する)
+COLUMN_DTYPES = {
+    "has_text": np.dtype(bool),
+    "has_seed": np.dtype(bool),
+    "seed": np.dtype(np.int64),
+    "created_at": np.dtype("datetime64[us]"),
+}
+# ペイロードのログがこの行数と件数の2倍を超えたら書き直して詰める
+PAYLOAD_LOG_MIN_LINES = 1024
+
+
+class NumpyVectorStore:
+    """正規化済みembeddingをメモリマップした .npy 行列に保存し、全件探索で検索する
+
+    QdrantClientManagerと同じメソッドを持ち、小〜中規模のコレクションで置き換えて使う
+    行は末尾に追加し、削除時は最後の行を空いた位置に移して詰める
+    ペイロードは変更した行だけをログに追記し、読み込み時に再生する
+    """
+
+    def __init__(self, settings: Settings):
+        self.store_dir = Path(settings.NUMPY_STORE_DIR)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.embedding_dim = settings.EMBEDDING_DIM
+        self.dtype = np.dtype(settings.NUMPY_STORE_DTYPE)
+        if self.dtype not in (np.float16, np.float32):
+            raise ValueError(f"Unsupported embedding dtype: {self.dtype}")
+        self.hybrid_prefetch_limit = settings.HYBRID_PREFETCH_LIMIT
+        self.meta_path = self.store_dir / "meta.json"
+        self.payloads_path = self.store_dir / "payloads.jsonl"
+
+        self._lock = threading.RLock()
+        self.count = 0
+        self.payloads: list[dict] = []
+        self._payload_log_lines = 0
+        self.matrices: dict[str, np.memmap] = {}
+        # has_text: text embeddingを持つ行 (取り込んだ画像は画像のembeddingのみ)
+        # has_seed / seed / created_at: 絞り込みをベクトル演算で行うための列
+        self.columns: dict[str, np.memmap] = {}
+        self._row_by_filename: dict[str, int] = {}
+        # このプロセスで内容を変更するたびに増える (検索結果キャッシュの無効化に使う)
+        self.version = 0
+        self._load()
+
+    def upload_point(
+        self,
+        image_embedding: np.ndarray,
+        text_embedding: np.ndarray,
+        image_filename: str,
+        prompt: str,
+        extra_payload: dict | None = None,
+    ):
+        """1件のembeddingとメタデータを保存"""
+        self.upload_points(
+            image_embeddings=image_embedding[None],
+            text_embeddings=text_embedding[None],
+            image_filenames=[image_filename],
+            prompts=[prompt],
+            extra_payloads=[extra_payload or {}],
+        )
+
+    def upload_points(
+        self,
+        image_embeddings: np.ndarray,
+        text_embeddings: np.ndarray | None,
+        image_filenames: list[str],
+        prompts: list[str],
+        extra_payloads: list[dict] | None = None,
+    ):
+        """複数のembeddingとメタデータをまとめて保存 (同じファイル名は上書き)"""
+        # 作成日時はSQLiteと揃えるため呼び出し側がextra_payloadsで渡す (なければ現在時刻)
+        created_at = datetime.now(UTC).isoformat()
+        if extra_payloads is None:
+            extra_payloads = [{} for _ in image_filenames]
+        vectors = {"image": self._normalize(image_embeddings)}
+        if text_embeddings is not None:
+            vectors["text"] = self._normalize(text_embeddings)
+
+        with self._lock:
+            changed_rows = []
+            for i, (image_filename, prompt, extra_payload) in enumerate(
+                zip(image_filenames, prompts, extra_payloads, strict=True)
+            ):
+                row = self._row_by_filename.get(image_filename)
+                if row is None:
+                    row = self.count
+                    self._reserve(self.count + 1)
+                    self.count += 1
+                    self.payloads.append({})
+                    self._row_by_filename[image_filename] = row
+                for name, matrix in self.matrices.items():
+                    if name in vectors:
+                        matrix[row] = vectors[name][i]
+                self.columns["has_text"][row] = "text" in vectors
+                self._set_payload(
+                    row,
+                    {
+                        "image_filename": image_filename,
+                        "prompt": prompt,
+                        "created_at": created_at,
+                        **extra_payload,
+                    },
+                )
+                changed_rows.append(row)
+            self._save(changed_rows)
+            self.version += 1
+
+    def search_points(
+        self,
+        query_embedding: np.ndarray,
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+    ) -> list[ScoredMetadata]:
+        """画像のembeddingとの内積で上位topk件を検索"""
+        return self.search_points_batch(query_embedding[None], topk, filters)[0]
+
+    def search_points_batch(
+        self,
+        query_embeddings: np.ndarray,
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+    ) -> list[list[ScoredMetadata]]:
+        """複数のembedding [B, dim] を1回の行列積でまとめて検索"""
+        with self._lock:
+            scores = self._scores("image", query_embeddings, self._filter_mask(filters))
+            return [
+                [
+                    self._to_scored_metadata(row, float(row_scores[row]))
+                    for row in self._topk(row_scores, topk)
+                ]
+                for row_scores in scores
+            ]
+
+    def hybrid_search_points(
+        self,
+        queries: list[tuple[str, np.ndarray, float]],
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+        fusion: str = "rrf",
+    ) -> list[ScoredMetadata]:
+        """複数の (ベクトル名, embedding, 重み) で候補を取り、順位を統合する (Qdrantと同じ計算)"""
+        if not queries:
+            raise ValueError("At least one query is required.")
+        if fusion not in ("rrf", "weighted"):
+            raise ValueError(f"Unknown fusion method: {fusion}")
+        prefetch_limit = max(self.hybrid_prefetch_limit, topk)
+
+        with self._lock:
+            mask = self._filter_mask(filters)
+            fused: dict[int, float] = {}
+            for using, embedding, weight in queries:
+                row_scores = self._scores(using, embedding[None], mask)[0]
+                for position, row in enumerate(self._topk(row_scores, prefetch_limit)):
+                    if fusion == "rrf":
+                        score = (
+                            1 / ((position + 1) / weight + RRF_RANKING_CONSTANT - 1)
+                            if weight > 0
+                            else 0.0
+                        )
+                    else:
+                        score = weight * float(row_scores[row])
+                    fused[row] = fused.get(row, 0.0) + score
+            rows = sorted(fused, key=fused.__getitem__, reverse=True)[:topk]
+            return [self._to_scored_metadata(row, fused[row]) for row in rows]
+
+    def scroll_embeddings(self, using: str = "image") -> tuple[list[str], np.ndarray]:
+        """全行の (ファイル名, 指定したembedding [N, dim]) を取得"""
+        with self._lock:
+            rows = np.arange(self.count)
+            if using == "text":
+                rows = rows[self.columns["has_text"][: self.count]]
+            image_filenames = [self.payloads[row]["image_filename"] for row in rows]
+            embeddings = np.asarray(self.matrices[using][rows], dtype=np.float32)
+        return image_filenames, embeddings
+
+    def retrieve_embeddings(
+        self, image_filenames: list[str], using: str = "image"
+    ) -> np.ndarray:
+        """指定した画像の正規化済みembedding [N, dim] を指定した順に取得"""
+        with self._lock:
+            rows = [self._row_by_filename.get(name) for name in image_filenames]
+            missing = [
+                name
+                for name, row in zip(image_filenames, rows, strict=True)
+                if row is None
+                or (using == "text" and not self.columns["has_text"][row])
+            ]
+            if missing:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"No {using} embeddings found for: {', '.join(missing)}",
+                )
+            return np.asarray(self.matrices[using][rows], dtype=np.float32).reshape(
+                -1, self.embedding_dim
+            )
+
+    def delete_point(self, image_filename: str):
+        """指定した画像ファイル名の行を削除"""
+        if image_filename not in self._row_by_filename:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Image with filename {image_filename} not found in the vector store.",
+            )
+        self.delete_points([image_filename])
+
+    def delete_points(self, image_filenames: list[str]):
+        """指定した画像ファイル名の行をまとめて削除"""
+        with self._lock:
+            deleted = False
+            moved_rows = set()
+            for image_filename in image_filenames:
+                row = self._row_by_filename.pop(image_filename, None)
+                if row is None:
+                    continue
+                deleted = True
+                last = self.count - 1
+                # 最後の行を空いた位置に移して詰める
+                if row != last:
+                    for array in (*self.matrices.values(), *self.columns.values()):
+                        array[row] = array[last]
+                    self.payloads[row] = self.payloads[last]
+                    self._row_by_filename[self.payloads[row]["image_filename"]] = row
+                    moved_rows.add(row)
+                self.payloads.pop()
+                self.count -= 1
+            if deleted:
+                self._save([row for row in moved_rows if row < self.count])
+                self.version += 1
+
+    def _scores(
+        self, using: str, query_embeddings: np.ndarray, mask: np.ndarray | None
+    ) -> np.ndarray:
+        """クエリ [B, dim] と全行の内積 [B, N] を計算 (対象外の行は -inf)"""
+        queries = self._normalize(np.atleast_2d(query_embeddings)).astype(np.float32)
+        matrix = self.matrices[using]
+        scores = np.empty((len(queries), self.count), dtype=np.float32)
+        for start in range(0, self.count, SEARCH_CHUNK_ROWS):
+            stop = min(start + SEARCH_CHUNK_ROWS, self.count)
+            chunk = np.asarray(matrix[start:stop], dtype=np.float32)
+            scores[:, start:stop] = queries @ chunk.T
+        if using == "text":
+            scores[:, ~self.columns["has_text"][: self.count]] = -np.inf
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        return scores
+
+    @staticmethod
+    def _topk(row_scores: np.ndarray, topk: int) -> np.ndarray:
+        """スコアの高い順に上位topk行 (対象外の行を除く) のインデックスを返す"""
+        k = min(topk, len(row_scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.argpartition(-row_scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-row_scores[candidates], kind="stable")]
+        return candidates[np.isfinite(row_scores[candidates])]
+
+    def _filter_mask(self, filters: SearchFilters | None) -> np.ndarray | None:
+        """検索条件に合う行のマスク (条件がなければNone)"""
+        if filters is None or not any(
+            value is not None and value != "" for value in filters.model_dump().values()
+        ):
+            return None
+        prompt_words = set(re.findall(r"\w+", (filters.prompt_contains or "").lower()))
+        # Qdrantと同じく、タイムゾーンのない日時はUTCとして扱う
+        created_after, created_before = (
+            value.replace(tzinfo=UTC) if value and value.tzinfo is None else value
+            for value in (filters.created_after, filters.created_before)
+        )
+        columns = {name: column[: self.count] for name, column in self.columns.items()}
+        mask = np.ones(self.count, dtype=bool)
+        if filters.seed is not None:
+            mask &= columns["has_seed"] & (columns["seed"] == filters.seed)
+        if created_after is not None:
+            mask &= columns["created_at"] >= self._to_datetime64(created_after)
+        if created_before is not None:
+            mask &= columns["created_at"] <= self._to_datetime64(created_before)
+
+        # 条件画像とプロンプトは列に持てないため、残った行だけペイロードを確認する
+        if filters.control_image_filename is None and not prompt_words:
+            return mask
+        for row in np.flatnonzero(mask):
+            payload = self.payloads[row]
+            if (
+                filters.control_image_filename is not None
+                and filters.control_image_filename
+                not in payload.get("control_image_filenames", [])
+            ) or (
+                prompt_words
+                and not prompt_words
+                <= set(re.findall(r"\w+", payload.get("prompt", "").lower()))
+            ):
+                mask[row] = False
+        return mask
+
+    def _set_payload(self, row: int, payload: dict):
+        """行のペイロードと絞り込み用の列を更新"""
+        self.payloads[row] = payload
+        seed = payload.get("seed")
+        self.columns["has_seed"][row] = seed is not None
+        self.columns["seed"][row] = seed if seed is not None else 0
+        self.columns["created_at"][row] = self._to_datetime64(
+            datetime.fromisoformat(payload["created_at"])
+        )
+
+    @staticmethod
+    def _to_datetime64(value: datetime) -> np.datetime64:
+        """日時をUTCのnp.datetime64に変換 (タイムゾーンのない日時はUTCとして扱う)"""
+        if value.tzinfo is not None:
+            value = value.astimezone(UTC).replace(tzinfo=None)
+        return np.datetime64(value, "us")
+
+    def _to_scored_metadata(self, row: int, score: float) -> ScoredMetadata:
+        payload = self.payloads[row]
+        return ScoredMetadata(
+            image_filename=payload["image_filename"],
+            prompt=payload["prompt"],
+            score=score,
+        )
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def _reserve(self, rows: int):
+        """行数がrowsを超える場合、容量を倍にした行列と列を作り直す"""
+        capacity = len(self.columns["has_text"]) if self.columns else 0
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2, 1024)
+        for name in VECTOR_NAMES:
+            self.matrices[name] = self._grow(
+                self._matrix_path(name),
+                self.matrices.pop(name, None),
+                self.dtype,
+                (new_capacity, self.embedding_dim),
+            )
+        for name, dtype in COLUMN_DTYPES.items():
+            self.columns[name] = self._grow(
+                self._column_path(name),
+                self.columns.pop(name, None),
+                dtype,
+                (new_capacity,),
+            )
+
+    def _grow(
+        self,
+        path: Path,
+        array: np.memmap | None,
+        dtype: np.dtype,
+        shape: tuple[int, ...],
+    ) -> np.memmap:
+        """既存の行をコピーした大きな .npy を作り、置き換えてメモリマップで開き直す"""
+        tmp_path = path.with_suffix(".tmp.npy")
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        if array is not None:
+            grown[: self.count] = array[: self.count]
+            del array
+        grown.flush()
+        del grown
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r+")
+
+    def _matrix_path(self, name: str) -> Path:
+        return self.store_dir / f"{name}.npy"
+
+    def _column_path(self, name: str) -> Path:
+        return self.store_dir / f"column_{name}.npy"
+
+    def _load(self):
+        """保存済みの行列とメタデータを読み込む"""
+        if not self.meta_path.exists():
+            self._reserve(1)
+            return
+        meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+        if meta["dim"] != self.embedding_dim or meta["dtype"] != self.dtype.name:
+            raise ValueError(
+                f"Vector store at {self.store_dir} was created with "
+                f"dim={meta['dim']} dtype={meta['dtype']}."
+            )
+        self.count = meta["count"]
+        for name in VECTOR_NAMES:
+            self.matrices[name] = np.load(self._matrix_path(name), mmap_mode="r+")
+        for name in COLUMN_DTYPES:
+            self.columns[name] = np.load(self._column_path(name), mmap_mode="r+")
+
+        # ログを先頭から再生し、最後に保存した件数より後ろの行は捨てる
+        with self.payloads_path.open(encoding="utf-8") as f:
+            for line in f:
+                # 書き込み途中で止まった末尾の行は使わない
+                if not line.endswith("\n"):
+                    break
+                row, payload = json.loads(line)
+                if row >= len(self.payloads):
+                    self.payloads.extend(
+                        {} for _ in range(row + 1 - len(self.payloads))
+                    )
+                self.payloads[row] = payload
+                self._payload_log_lines += 1
+        del self.payloads[self.count :]
+        self._row_by_filename = {
+            payload["image_filename"]: row for row, payload in enumerate(self.payloads)
+        }
+
+    def _save(self, changed_rows: list[int]):
+        """行列と列をディスクに反映し、変更した行のペイロードを追記してから件数を置き換える"""
+        for array in (*self.matrices.values(), *self.columns.values()):
+            array.flush()
+        if self._payload_log_lines + len(changed_rows) > max(
+            PAYLOAD_LOG_MIN_LINES, self.count * 2
+        ):
+            # 上書きや削除で古い行が溜まったら、現在の内容だけで書き直す
+            tmp_path = self.payloads_path.with_suffix(".tmp")
+            with tmp_path.open("w", encoding="utf-8") as f:
+                for row, payload in enumerate(self.payloads):
+                    f.write(json.dumps([row, payload]) + "\n")
+            os.replace(tmp_path, self.payloads_path)
+            self._payload_log_lines = self.count
+        else:
+            with self.payloads_path.open("a", encoding="utf-8") as f:
+                for row in changed_rows:
+                    f.write(json.dumps([row, self.payloads[row]]) + "\n")
+            self._payload_log_lines += len(changed_rows)
+
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps(
+                {
+                    "count": self.count,
+                    "dim": self.embedding_dim,
+                    "dtype": self.dtype.name,
+                }
+            ),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, self.meta_path)
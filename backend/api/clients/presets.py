@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from typing import Any
+
+
+@dataclass(frozen=True)
+class SamplingPreset:
+    """画像生成の速度と品質のバランスを決める設定の組
+
+    Noneの項目はリクエストの値やパイプラインの既定値をそのまま使う
+    """
+
+    name: str
+    description: str
+    num_inference_steps: int | None = None
+    guidance_scale: float | None = None
+    # diffusersのスケジューラのクラス名と、既定の設定から変える項目
+    scheduler: str | None = None
+    scheduler_kwargs: dict[str, Any] = field(default_factory=dict)
+    # ステップ数を減らすよう蒸留されたLoRA
+    lora_repo: str | None = None
+    lora_weight_name: str | None = None
+    lora_scale: float = 1.0
+    # トランスフォーマーをtorch.compileしたものを使う
+    compile: bool = False
+
+    def resolve(
+        self, num_inference_steps: int, guidance_scale: float
+    ) -> tuple[int, float]:
+        """リクエストのステップ数・ガイダンスにプリセットの値を反映"""
+        return (
+            self.num_inference_steps or num_inference_steps,
+            self.guidance_scale if self.guidance_scale is not None else guidance_scale,
+        )
+
+
+SAMPLING_PRESETS: dict[str, SamplingPreset] = {
+    preset.name: preset
+    for preset in [
+        SamplingPreset(
+            name="default",
+            description="Pipeline scheduler with the requested number of steps",
+        ),
+        SamplingPreset(
+            name="unipc",
+            description="UniPC multistep scheduler (20 steps)",
+            num_inference_steps=20,
+            scheduler="UniPCMultistepScheduler",
+            scheduler_kwargs={
+                "prediction_type": "flow_prediction",
+                "use_flow_sigmas": True,
+            },
+        ),
+        SamplingPreset(
+            name="turbo",
+            description="FLUX.1-Turbo-Alpha step-distilled LoRA (8 steps)",
+            num_inference_steps=8,
+            guidance_scale=3.5,
+            lora_repo="alimama-creative/FLUX.1-Turbo-Alpha",
+            lora_weight_name="diffusion_pytorch_model.safetensors",
+        ),
+        SamplingPreset(
+            name="hyper",
+            description="Hyper-SD 8-step LoRA",
+            num_inference_steps=8,
+            guidance_scale=3.5,
+            lora_repo="ByteDance/Hyper-SD",
+            lora_weight_name="Hyper-FLUX.1-dev-8steps-lora.safetensors",
+            lora_scale=0.125,
+        ),
+        SamplingPreset(
+            name="compiled",
+            description="Pipeline scheduler with a torch.compile'd transformer",
+            compile=True,
+        ),
+    ]
+}
+
+
+def get_sampling_preset(name: str, enabled: list[str]) -> SamplingPreset:
+    """有効なプリセットを名前で取得 (未知・無効なものはValueError)"""
+    if name not in SAMPLING_PRESETS:
+        raise ValueError(f"Unknown sampling preset: {name}")
+    if name not in enabled:
+        raise ValueError(f"Sampling preset {name} is not enabled.")
+    return SAMPLING_PRESETS[name]
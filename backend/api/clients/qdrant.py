@@ -1,27 +1,118 @@
+import logging
 import uuid
+import warnings
+from collections.abc import Iterable
+from datetime import UTC, datetime
 
 import numpy as np
 from fastapi import HTTPException
 from qdrant_client import QdrantClient
 from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CollectionInfo,
+    DatetimeRange,
     Distance,
     FieldCondition,
     Filter,
+    FormulaQuery,
+    HnswConfigDiff,
+    MatchText,
     MatchValue,
+    MultExpression,
+    PayloadSchemaType,
+    PointIdsList,
     PointStruct,
+    Prefetch,
+    QuantizationConfig,
+    QuantizationSearchParams,
+    QueryRequest,
+    Rrf,
+    RrfQuery,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    ScoredPoint,
+    SearchParams,
+    SetPayload,
+    SetPayloadOperation,
+    SumExpression,
+    TextIndexParams,
+    TextIndexType,
+    TokenizerType,
     VectorParams,
+    VectorParamsDiff,
 )
 
 from api.config import Settings
-from api.schema import SimpleMetadata
+from api.schema import ScoredMetadata, SearchFilters
+
+logger = logging.getLogger(__name__)
+
+# ファイル名からポイントIDを決めるための名前空間
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "genmap/image_filename")
+
+
+def filename_to_point_id(image_filename: str) -> str:
+    """画像ファイル名から決定的なポイントIDを生成"""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, image_filename))
+
+
+def build_quantization_config(
+    quantization: str, always_ram: bool
+) -> QuantizationConfig | None:
+    """設定値 (none / scalar / binary) からQdrantの量子化設定を作る"""
+    if quantization == "none":
+        return None
+    if quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=always_ram)
+        )
+    if quantization == "binary":
+        return BinaryQuantization(
+            binary=BinaryQuantizationConfig(always_ram=always_ram)
+        )
+    raise ValueError(f"Unknown quantization: {quantization}")
 
 
 class QdrantClientManager:
     def __init__(self, settings: Settings):
-        self.qdrant = QdrantClient(path=settings.QDRANT_DB_PATH)
+        # URLが指定されていればサーバーに接続し、なければローカルモードで動かす
+        self.is_local = settings.QDRANT_URL is None
+        if self.is_local:
+            self.qdrant = QdrantClient(path=settings.QDRANT_DB_PATH)
+        else:
+            self.qdrant = QdrantClient(
+                url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY
+            )
         self.collection_name = settings.COLLECTION_NAME
         self.embedding_dim = settings.EMBEDDING_DIM
+        self.upsert_batch_size = settings.QDRANT_UPSERT_BATCH_SIZE
+        self.hybrid_prefetch_limit = settings.HYBRID_PREFETCH_LIMIT
+        # このプロセスでコレクションを変更するたびに増える (検索結果キャッシュの無効化に使う)
+        self.version = 0
+
+        # ベクトルの保存方法とインデックスの設定
+        self.on_disk = settings.QDRANT_ON_DISK
+        self.hnsw_config = HnswConfigDiff(
+            m=settings.QDRANT_HNSW_M, ef_construct=settings.QDRANT_HNSW_EF_CONSTRUCT
+        )
+        self.quantization_config = build_quantization_config(
+            settings.QDRANT_QUANTIZATION, settings.QDRANT_QUANTIZATION_ALWAYS_RAM
+        )
+        # ローカルモードは常に全件探索なので検索パラメータは渡さない
+        self.search_params: SearchParams | None = None
+        if not self.is_local:
+            self.search_params = SearchParams(
+                hnsw_ef=settings.QDRANT_HNSW_EF,
+                quantization=QuantizationSearchParams(
+                    rescore=settings.QDRANT_RESCORE,
+                    oversampling=settings.QDRANT_OVERSAMPLING,
+                ),
+            )
         self._init_collection()
+        if settings.QDRANT_MIGRATE_POINT_IDS:
+            self.migrate_point_ids()
 
     def _init_collection(self):
         """コレクションの初期化 (存在しなければ作成)"""
@@ -33,14 +124,97 @@ class QdrantClientManager:
             self.qdrant.create_collection(
                 collection_name=self.collection_name,
                 vectors_config={
-                    "image": VectorParams(
-                        size=self.embedding_dim, distance=Distance.COSINE
-                    ),
-                    "text": VectorParams(
-                        size=self.embedding_dim, distance=Distance.COSINE
-                    ),
+                    name: VectorParams(
+                        size=self.embedding_dim,
+                        distance=Distance.COSINE,
+                        on_disk=self.on_disk,
+                        hnsw_config=self.hnsw_config,
+                        quantization_config=self.quantization_config,
+                    )
+                    for name in ("image", "text")
                 },
             )
+        elif not self.is_local:
+            # 既存のコレクションの設定が異なる場合だけ反映する (インデックスはサーバーが作り直す)
+            vectors_config = self._diff_vectors_config(
+                self.qdrant.get_collection(self.collection_name)
+            )
+            if vectors_config:
+                for name, diff in vectors_config.items():
+                    logger.info(
+                        "Updating vector %s of collection %s: %s",
+                        name,
+                        self.collection_name,
+                        diff.model_dump(exclude_none=True),
+                    )
+                self.qdrant.update_collection(
+                    collection_name=self.collection_name,
+                    vectors_config=vectors_config,
+                )
+        self._init_payload_indexes()
+
+    def _diff_vectors_config(
+        self, collection_info: CollectionInfo
+    ) -> dict[str, VectorParamsDiff]:
+        """既存のコレクションのベクトル設定のうち、現在の設定と異なる項目だけを返す"""
+        vectors = collection_info.config.params.vectors
+        if not isinstance(vectors, dict):
+            return {}
+        collection_hnsw = collection_info.config.hnsw_config
+        diffs = {}
+        for name in ("image", "text"):
+            current = vectors.get(name)
+            if current is None:
+                continue
+            changes = {}
+            if bool(current.on_disk) != self.on_disk:
+                changes["on_disk"] = self.on_disk
+            # ベクトルごとの指定がない項目はコレクション全体の設定が使われる
+            hnsw_changes = {
+                field: value
+                for field, value in self.hnsw_config.model_dump(
+                    exclude_none=True
+                ).items()
+                if value
+                != (
+                    getattr(current.hnsw_config, field, None)
+                    or getattr(collection_hnsw, field)
+                )
+            }
+            if hnsw_changes:
+                changes["hnsw_config"] = HnswConfigDiff(**hnsw_changes)
+            # 量子化をやめる場合は明示的な無効化が必要なので、ここでは追加・変更だけを扱う
+            if (
+                self.quantization_config is not None
+                and current.quantization_config != self.quantization_config
+            ):
+                changes["quantization_config"] = self.quantization_config
+            if changes:
+                diffs[name] = VectorParamsDiff(**changes)
+        return diffs
+
+    def _init_payload_indexes(self):
+        """フィルタ検索に使うペイロードのインデックスを作成"""
+        field_schemas = {
+            "image_filename": PayloadSchemaType.KEYWORD,
+            "prompt": TextIndexParams(
+                type=TextIndexType.TEXT,
+                tokenizer=TokenizerType.WORD,
+                lowercase=True,
+            ),
+            "created_at": PayloadSchemaType.DATETIME,
+            "seed": PayloadSchemaType.INTEGER,
+            "control_image_filenames": PayloadSchemaType.KEYWORD,
+        }
+        with warnings.catch_warnings():
+            # ローカルモードではインデックスは効かない旨の警告が出るので抑制する
+            warnings.simplefilter("ignore", UserWarning)
+            for field_name, field_schema in field_schemas.items():
+                self.qdrant.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field_name,
+                    field_schema=field_schema,
+                )
 
     def upload_point(
         self,
@@ -48,66 +222,388 @@ class QdrantClientManager:
         text_embedding: np.ndarray,
         image_filename: str,
         prompt: str,
+        extra_payload: dict | None = None,
     ):
         """ポイント (画像・テキストのembeddingとメタデータ)をQdrantにアップロード"""
-        point = PointStruct(
-            id=str(uuid.uuid4()),
-            vector={"image": image_embedding.tolist(), "text": text_embedding.tolist()},
-            payload={"image_filename": image_filename, "prompt": prompt},
+        self.upload_points(
+            image_embeddings=image_embedding[None],
+            text_embeddings=text_embedding[None],
+            image_filenames=[image_filename],
+            prompts=[prompt],
+            extra_payloads=[extra_payload or {}],
         )
 
-        self.qdrant.upsert(
-            collection_name=self.collection_name,
-            points=[point],
-        )
+    def upload_points(
+        self,
+        image_embeddings: np.ndarray,
+        text_embeddings: np.ndarray | None,
+        image_filenames: list[str],
+        prompts: list[str],
+        extra_payloads: list[dict] | None = None,
+    ):
+        """複数のポイントをまとめてQdrantにアップロード
+
+        text_embeddingsがNoneの場合は画像のembeddingだけを登録する
+        extra_payloadsにはフィルタ検索用の項目 (created_at, seed, control_image_filenames) を渡す
+        """
+        # 作成日時はSQLiteと揃えるため呼び出し側がextra_payloadsで渡す (なければ現在時刻)
+        created_at = datetime.now(UTC).isoformat()
+        if extra_payloads is None:
+            extra_payloads = [{} for _ in image_filenames]
+        points = []
+        for i, (image_filename, prompt, extra_payload) in enumerate(
+            zip(image_filenames, prompts, extra_payloads, strict=True)
+        ):
+            vector = {"image": image_embeddings[i].tolist()}
+            if text_embeddings is not None:
+                vector["text"] = text_embeddings[i].tolist()
+            points.append(
+                PointStruct(
+                    id=filename_to_point_id(image_filename),
+                    vector=vector,
+                    payload={
+                        "image_filename": image_filename,
+                        "prompt": prompt,
+                        "created_at": created_at,
+                        **extra_payload,
+                    },
+                )
+            )
+
+        for start in range(0, len(points), self.upsert_batch_size):
+            self.qdrant.upsert(
+                collection_name=self.collection_name,
+                points=points[start : start + self.upsert_batch_size],
+            )
+        self.version += 1
 
     def search_points(
         self,
         query_embedding: np.ndarray,
         topk: int = 5,
-    ) -> list[SimpleMetadata]:
-        """指定したembeddingに基づいてQdrantからポイントを検索"""
+        filters: SearchFilters | None = None,
+    ) -> list[ScoredMetadata]:
+        """指定したembeddingに基づいてQdrantからポイントを検索 (フィルタはQdrant側で適用)"""
         results = self.qdrant.query_points(
             collection_name=self.collection_name,
             query=query_embedding.tolist(),
             using="image",
+            query_filter=self._build_filter(filters),
+            search_params=self.search_params,
             with_payload=True,
             with_vectors=False,
             limit=topk,
         ).points
+        return self._to_scored_metadata_list(results)
+
+    def search_points_batch(
+        self,
+        query_embeddings: np.ndarray,
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+    ) -> list[list[ScoredMetadata]]:
+        """複数のembedding [B, dim] で1回のリクエストにまとめて検索"""
+        query_filter = self._build_filter(filters)
+        responses = self.qdrant.query_batch_points(
+            collection_name=self.collection_name,
+            requests=[
+                QueryRequest(
+                    query=query_embedding.tolist(),
+                    using="image",
+                    filter=query_filter,
+                    params=self.search_params,
+                    with_payload=True,
+                    limit=topk,
+                )
+                for query_embedding in query_embeddings
+            ],
+        )
+        return [
+            self._to_scored_metadata_list(response.points) for response in responses
+        ]
+
+    def hybrid_search_points(
+        self,
+        queries: list[tuple[str, np.ndarray, float]],
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+        fusion: str = "rrf",
+    ) -> list[ScoredMetadata]:
+        """複数の (ベクトル名, embedding, 重み) で候補を取り、1回のリクエストで順位を統合する
+
+        fusionが "rrf" の場合は重み付きRRF、"weighted" の場合は類似度の重み付き和で並べる
+        """
+        if not queries:
+            raise ValueError("At least one query is required.")
+        query_filter = self._build_filter(filters)
+        prefetch_limit = max(self.hybrid_prefetch_limit, topk)
+        prefetch = [
+            Prefetch(
+                query=embedding.tolist(),
+                using=using,
+                filter=query_filter,
+                params=self.search_params,
+                limit=prefetch_limit,
+            )
+            for using, embedding, _ in queries
+        ]
+        weights = [weight for _, _, weight in queries]
 
-        simple_metadata_list = []
+        fusion_query: RrfQuery | FormulaQuery
+        if fusion == "rrf":
+            fusion_query = RrfQuery(rrf=Rrf(weights=weights))
+        elif fusion == "weighted":
+            # 片方の候補にしか含まれない点はもう一方の類似度を0として扱う
+            fusion_query = FormulaQuery(
+                formula=SumExpression(
+                    sum=[
+                        MultExpression(mult=[weight, f"$score[{i}]"])
+                        for i, weight in enumerate(weights)
+                    ]
+                ),
+                defaults={f"$score[{i}]": 0.0 for i in range(len(weights))},
+            )
+        else:
+            raise ValueError(f"Unknown fusion method: {fusion}")
+
+        results = self.qdrant.query_points(
+            collection_name=self.collection_name,
+            prefetch=prefetch,
+            query=fusion_query,
+            query_filter=query_filter,
+            with_payload=True,
+            with_vectors=False,
+            limit=topk,
+        ).points
+        return self._to_scored_metadata_list(results)
+
+    @staticmethod
+    def _to_scored_metadata_list(results: list[ScoredPoint]) -> list[ScoredMetadata]:
+        """検索結果を類似度付きのレスポンス用メタデータに変換"""
+        scored_metadata_list = []
         for result in results:
             if result is None or result.payload is None:
                 raise HTTPException(
                     status_code=404, detail="No points found in Qdrant."
                 )
-            metadata: SimpleMetadata = SimpleMetadata(**result.payload)
-            simple_metadata_list.append(metadata)
+            metadata: ScoredMetadata = ScoredMetadata(
+                image_filename=result.payload["image_filename"],
+                prompt=result.payload["prompt"],
+                score=result.score,
+            )
+            scored_metadata_list.append(metadata)
+
+        return scored_metadata_list
+
+    def scroll_embeddings(self, using: str = "image") -> tuple[list[str], np.ndarray]:
+        """全ポイントの (ファイル名, 指定したembedding [N, dim]) を取得"""
+        image_filenames: list[str] = []
+        embeddings: list[list[float]] = []
+        offset = None
+        while True:
+            points, offset = self.qdrant.scroll(
+                collection_name=self.collection_name,
+                with_payload=["image_filename"],
+                with_vectors=[using],
+                limit=self.upsert_batch_size,
+                offset=offset,
+            )
+            for point in points:
+                vector = (point.vector or {}).get(using)  # type: ignore
+                if point.payload is None or vector is None:
+                    continue
+                image_filenames.append(point.payload["image_filename"])
+                embeddings.append(vector)
+            if offset is None:
+                break
+
+        return image_filenames, np.array(embeddings, dtype=np.float32).reshape(
+            -1, self.embedding_dim
+        )
+
+    def retrieve_embeddings(
+        self, image_filenames: list[str], using: str = "image"
+    ) -> np.ndarray:
+        """指定した画像のembedding [N, dim] を指定した順に取得"""
+        vectors: dict[str, list[float]] = {}
+        for start in range(0, len(image_filenames), self.upsert_batch_size):
+            points = self.qdrant.retrieve(
+                collection_name=self.collection_name,
+                ids=[
+                    filename_to_point_id(image_filename)
+                    for image_filename in image_filenames[
+                        start : start + self.upsert_batch_size
+                    ]
+                ],
+                with_payload=["image_filename"],
+                with_vectors=[using],
+            )
+            for point in points:
+                vector = (point.vector or {}).get(using)  # type: ignore
+                if point.payload is not None and vector is not None:
+                    vectors[point.payload["image_filename"]] = vector
+
+        missing = [name for name in image_filenames if name not in vectors]
+        if missing:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No {using} embeddings found for: {', '.join(missing)}",
+            )
+        return np.array(
+            [vectors[name] for name in image_filenames], dtype=np.float32
+        ).reshape(-1, self.embedding_dim)
+
+    @staticmethod
+    def _build_filter(filters: SearchFilters | None) -> Filter | None:
+        """検索条件をQdrantのフィルタに変換"""
+        if filters is None:
+            return None
+
+        conditions: list[FieldCondition] = []
+        if filters.control_image_filename is not None:
+            conditions.append(
+                FieldCondition(
+                    key="control_image_filenames",
+                    match=MatchValue(value=filters.control_image_filename),
+                )
+            )
+        if filters.created_after is not None or filters.created_before is not None:
+            conditions.append(
+                FieldCondition(
+                    key="created_at",
+                    range=DatetimeRange(
+                        gte=filters.created_after, lte=filters.created_before
+                    ),
+                )
+            )
+        if filters.seed is not None:
+            conditions.append(
+                FieldCondition(key="seed", match=MatchValue(value=filters.seed))
+            )
+        if filters.prompt_contains:
+            conditions.append(
+                FieldCondition(
+                    key="prompt", match=MatchText(text=filters.prompt_contains)
+                )
+            )
 
-        return simple_metadata_list
+        return Filter(must=conditions) if conditions else None
 
     def delete_point(self, image_filename: str):
         """指定した画像ファイル名のポイントをQdrantから削除"""
-        points = self.qdrant.scroll(
+        point_id = filename_to_point_id(image_filename)
+        if not self.qdrant.retrieve(
             collection_name=self.collection_name,
-            scroll_filter=Filter(
-                must=[
-                    FieldCondition(
-                        key="image_filename",
-                        match=MatchValue(value=image_filename),
-                    )
-                ]
-            ),
-            limit=1,
-        )
-        if not points or not points[0]:
+            ids=[point_id],
+            with_payload=False,
+            with_vectors=False,
+        ):
             raise HTTPException(
                 status_code=404,
                 detail=f"Image with filename {image_filename} not found in Qdrant.",
             )
-        point_id = points[0][0].id
+        self.delete_points([image_filename])
+
+    def delete_points(self, image_filenames: list[str]):
+        """指定した画像ファイル名のポイントを1回のリクエストでまとめて削除"""
+        if not image_filenames:
+            return
         self.qdrant.delete(
             collection_name=self.collection_name,
-            points_selector=[point_id],
+            points_selector=PointIdsList(
+                points=[filename_to_point_id(name) for name in image_filenames]
+            ),
         )
+        self.version += 1
+
+    def migrate_point_ids(self) -> int:
+        """ランダムなIDで登録された既存のポイントを、ファイル名から決まるIDに移行する"""
+        legacy_ids = []
+        offset = None
+        while True:
+            points, offset = self.qdrant.scroll(
+                collection_name=self.collection_name,
+                with_payload=["image_filename"],
+                with_vectors=False,
+                limit=self.upsert_batch_size,
+                offset=offset,
+            )
+            for point in points:
+                image_filename = (point.payload or {}).get("image_filename")
+                if image_filename and str(point.id) != filename_to_point_id(
+                    image_filename
+                ):
+                    legacy_ids.append(point.id)
+            if offset is None:
+                break
+
+        for start in range(0, len(legacy_ids), self.upsert_batch_size):
+            batch_ids = legacy_ids[start : start + self.upsert_batch_size]
+            records = self.qdrant.retrieve(
+                collection_name=self.collection_name,
+                ids=batch_ids,
+                with_payload=True,
+                with_vectors=True,
+            )
+            self.qdrant.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    PointStruct(
+                        id=filename_to_point_id(record.payload["image_filename"]),  # type: ignore
+                        vector=record.vector,  # type: ignore
+                        payload=record.payload,
+                    )
+                    for record in records
+                ],
+            )
+            self.qdrant.delete(
+                collection_name=self.collection_name,
+                points_selector=PointIdsList(points=batch_ids),
+            )
+
+        return len(legacy_ids)
+
+    def backfill_payloads(
+        self, rows: Iterable[tuple[str, datetime, int | None, list[str]]]
+    ) -> int:
+        """(ファイル名, 作成日時, シード, 条件画像のファイル名) でフィルタ用のペイロードを上書きする
+
+        フィルタ項目を持たない旧形式のポイントや、作成日時がSQLiteと異なるポイントを揃えるために使い、
+        コレクションに存在するポイントの数を返す
+        """
+        items = list(rows)
+        updated = 0
+        for start in range(0, len(items), self.upsert_batch_size):
+            batch = items[start : start + self.upsert_batch_size]
+            payloads = {
+                filename_to_point_id(image_filename): {
+                    "created_at": created_at.isoformat(),
+                    "control_image_filenames": control_image_filenames,
+                }
+                | ({"seed": seed} if seed is not None else {})
+                for image_filename, created_at, seed, control_image_filenames in batch
+            }
+            # 存在しないポイントは更新できないので、登録済みのものだけに絞る
+            existing = self.qdrant.retrieve(
+                collection_name=self.collection_name,
+                ids=list(payloads),
+                with_payload=False,
+                with_vectors=False,
+            )
+            if not existing:
+                continue
+            self.qdrant.batch_update_points(
+                collection_name=self.collection_name,
+                update_operations=[
+                    SetPayloadOperation(
+                        set_payload=SetPayload(
+                            payload=payloads[str(point.id)], points=[point.id]
+                        )
+                    )
+                    for point in existing
+                ],
+            )
+            updated += len(existing)
+        if updated:
+            self.version += 1
+        return updated
@@ -1,6 +1,27 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
 from datetime import UTC, datetime
 
-from sqlalchemy import TIMESTAMP, Column, Float, Integer, String, create_engine
+from sqlalchemy import (
+    JSON,
+    TIMESTAMP,
+    Boolean,
+    Column,
+    Float,
+    Index,
+    Integer,
+    String,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    tuple_,
+    update,
+)
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
 from api.config import Settings
@@ -23,31 +44,137 @@ class ImageMetadata(Base):  # type: ignore
     controlnet_conditioning_scale_2 = Column(Float, nullable=True)
     control_guidance_end_1 = Column(Float, nullable=True)
     control_guidance_end_2 = Column(Float, nullable=True)
+    # 3つ目以降の条件画像 ([{filename, conditioning_scale, guidance_end}, ...])
+    control_images = Column(JSON, nullable=True)
 
     num_inference_steps = Column(Integer)
     guidance_scale = Column(Float)
     seed = Column(Integer)
     created_at = Column(TIMESTAMP(timezone=True), default=lambda: datetime.now(UTC))
 
+    # 生成に使ったプリセットと、1枚あたりの生成時間 (取り込んだ画像はNone)
+    preset = Column(String, nullable=True)
+    generation_seconds = Column(Float, nullable=True)
+    # 生成条件とモデルから作ったハッシュ (同じ条件の生成を再利用するために引く)
+    fingerprint = Column(String, nullable=True, index=True)
+
+    # 新しい順のページングに使うインデックス (同時刻はファイル名で順序を決める)
+    __table_args__ = (
+        Index("ix_image_metadata_created_at_filename", "created_at", "image_filename"),
+    )
+
+
+class GenerationJob(Base):  # type: ignore
+    __tablename__ = "generation_job"
+
+    job_id = Column(String, primary_key=True, index=True)
+    # queued / running / succeeded / failed / cancelled
+    status = Column(String, index=True, default="queued")
+    params = Column(JSON)
+
+    # 進捗 (デノイズのステップ数)
+    current_step = Column(Integer, default=0)
+    total_steps = Column(Integer)
+    cancel_requested = Column(Boolean, default=False)
+
+    # 結果
+    image_filename = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+
+    created_at = Column(TIMESTAMP(timezone=True), default=lambda: datetime.now(UTC))
+    started_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    finished_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+
+SQLITE_JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
 
 class SQLiteClient:
     def __init__(self, settings: Settings):
         self.db_url = f"sqlite:///{settings.SQLITE_DB_PATH}"
+        journal_mode = settings.SQLITE_JOURNAL_MODE.upper()
+        synchronous = settings.SQLITE_SYNCHRONOUS.upper()
+        if journal_mode not in SQLITE_JOURNAL_MODES:
+            raise ValueError(f"Unknown SQLite journal mode: {journal_mode}")
+        if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown SQLite synchronous mode: {synchronous}")
+        # 接続はプールで使い回し、スレッド間 (ジョブワーカー・APIなど) で共有する
         self.engine = create_engine(
-            self.db_url, connect_args={"check_same_thread": False}
+            self.db_url,
+            connect_args={
+                "check_same_thread": False,
+                "timeout": settings.SQLITE_BUSY_TIMEOUT_SECONDS,
+            },
+            pool_size=settings.SQLITE_POOL_SIZE,
+            max_overflow=settings.SQLITE_POOL_MAX_OVERFLOW,
         )
-        self.SessionLocal = sessionmaker(bind=self.engine)
+
+        @event.listens_for(self.engine, "connect")
+        def set_pragmas(dbapi_connection, _):
+            """接続ごとにジャーナル・同期モードとmmapサイズを設定"""
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+            cursor.close()
+
+        # コミット後に属性を読み直さないので、refreshせずにそのまま返せる
+        self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
         # マイグレーション
         self._migrate()
 
     def _migrate(self):
         """テーブルが存在しない場合、マイグレーションを実行"""
         Base.metadata.create_all(bind=self.engine)
+        # 既存のテーブルに後から追加したカラムを足す (SQLiteはNULL許容のカラムなら追加できる)
+        existing_columns = {
+            column["name"]
+            for column in inspect(self.engine).get_columns(ImageMetadata.__tablename__)
+        }
+        with self.engine.begin() as connection:
+            for column in ImageMetadata.__table__.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {ImageMetadata.__tablename__} "
+                            f"ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+        # 既存のテーブルにはcreate_allでインデックスが追加されないので個別に作成する
+        for index in ImageMetadata.__table__.indexes:
+            index.create(bind=self.engine, checkfirst=True)
 
     def get_session(self) -> Session:
         """セッションを取得"""
         return self.SessionLocal()
 
+    @contextmanager
+    def unit_of_work(self) -> Iterator[Session]:
+        """1つのトランザクションで複数の操作を行う (例外時はロールバック)
+
+        session引数を受け取るメソッドに渡すと、同じトランザクション内で実行される
+        """
+        session: Session = self.get_session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @contextmanager
+    def _session_scope(self, session: Session | None) -> Iterator[Session]:
+        """渡されたセッションを使うか、新しいトランザクションを開始する"""
+        if session is not None:
+            yield session
+        else:
+            with self.unit_of_work() as new_session:
+                yield new_session
+
     def upload_metadata(
         self,
         image_filename: str,
@@ -63,10 +190,13 @@ class SQLiteClient:
         num_inference_steps: int,
         guidance_scale: float,
         seed: int,
+        control_images: list[dict] | None = None,
+        preset: str | None = None,
+        generation_seconds: float | None = None,
+        fingerprint: str | None = None,
+        session: Session | None = None,
     ) -> ImageMetadata:
         """メタデータをSQLiteにアップロード"""
-        session: Session = self.get_session()
-
         new_metadata = ImageMetadata(
             image_filename=image_filename,
             prompt=prompt,
@@ -78,17 +208,85 @@ class SQLiteClient:
             controlnet_conditioning_scale_2=controlnet_conditioning_scale_2,
             control_guidance_end_1=control_guidance_end_1,
             control_guidance_end_2=control_guidance_end_2,
+            control_images=control_images,
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             seed=seed,
+            preset=preset,
+            generation_seconds=generation_seconds,
+            fingerprint=fingerprint,
         )
 
-        session.add(new_metadata)
-        session.commit()
-        session.refresh(new_metadata)
-        session.close()
+        with self._session_scope(session) as scoped_session:
+            scoped_session.add(new_metadata)
         return new_metadata
 
+    def bulk_upload_metadata(
+        self, metadata_list: list[dict], session: Session | None = None
+    ):
+        """複数のメタデータを1トランザクションでまとめてSQLiteに登録"""
+        if not metadata_list:
+            return
+        created_at = datetime.now(UTC)
+        with self._session_scope(session) as scoped_session:
+            scoped_session.execute(
+                insert(ImageMetadata),
+                [{"created_at": created_at, **metadata} for metadata in metadata_list],
+            )
+
+    def retrieve_existing_filenames(
+        self, image_filenames: list[str], session: Session | None = None
+    ) -> set[str]:
+        """指定したファイル名のうち、メタデータが登録済みのものを取得"""
+        existing: set[str] = set()
+        with self._session_scope(session) as scoped_session:
+            # SQLiteのバインド変数の上限を超えないよう分割して問い合わせる
+            for start in range(0, len(image_filenames), 500):
+                rows = scoped_session.query(ImageMetadata.image_filename).filter(
+                    ImageMetadata.image_filename.in_(
+                        image_filenames[start : start + 500]
+                    )
+                )
+                existing.update(str(image_filename) for (image_filename,) in rows)
+        return existing
+
+    def retrieve_filter_fields(
+        self,
+    ) -> Iterator[tuple[str, datetime, int | None, list[str]]]:
+        """全画像の (ファイル名, 作成日時 (UTC), シード, 条件画像のファイル名) を順に取得
+
+        検索バックエンドのペイロードをSQLiteの値で補うために使う
+        """
+        statement = select(
+            ImageMetadata.image_filename,
+            ImageMetadata.created_at,
+            ImageMetadata.seed,
+            ImageMetadata.control_image_filename_1,
+            ImageMetadata.control_image_filename_2,
+            ImageMetadata.control_images,
+        ).execution_options(yield_per=500)
+        session: Session = self.get_session()
+        try:
+            for (
+                image_filename,
+                created_at,
+                seed,
+                control_image_filename_1,
+                control_image_filename_2,
+                control_images,
+            ) in session.execute(statement):
+                # SQLiteはタイムゾーンを保存しないので、UTCとして扱う
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=UTC)
+                control_image_filenames = [
+                    name
+                    for name in (control_image_filename_1, control_image_filename_2)
+                    if name
+                ] + [params["filename"] for params in control_images or []]
+                yield image_filename, created_at, seed, control_image_filenames
+        finally:
+            session.close()
+
     def retrieve_metadata_list(self) -> list[ImageMetadata]:
         """メタデータの一覧を取得"""
         session: Session = self.get_session()
@@ -96,15 +294,262 @@ class SQLiteClient:
         session.close()
         return metadata_list
 
+    def retrieve_generation_latencies(
+        self, limit: int
+    ) -> dict[str, list[tuple[float, int]]]:
+        """プリセットごとに直近の (1枚あたりの生成時間, ステップ数) を新しい順に最大limit件取得"""
+        row_number = (
+            func.row_number()
+            .over(
+                partition_by=ImageMetadata.preset,
+                order_by=ImageMetadata.created_at.desc(),
+            )
+            .label("row_number")
+        )
+        recent = (
+            select(
+                ImageMetadata.preset,
+                ImageMetadata.generation_seconds,
+                ImageMetadata.num_inference_steps,
+                row_number,
+            )
+            .where(ImageMetadata.preset.is_not(None))
+            .where(ImageMetadata.generation_seconds.is_not(None))
+            .subquery()
+        )
+        session: Session = self.get_session()
+        rows = session.execute(
+            select(
+                recent.c.preset,
+                recent.c.generation_seconds,
+                recent.c.num_inference_steps,
+            )
+            .where(recent.c.row_number <= limit)
+            .order_by(recent.c.preset, recent.c.row_number)
+        ).all()
+        session.close()
+
+        latencies: dict[str, list[tuple[float, int]]] = {}
+        for preset, generation_seconds, num_inference_steps in rows:
+            latencies.setdefault(preset, []).append(
+                (generation_seconds, num_inference_steps)
+            )
+        return latencies
+
+    def retrieve_simple_metadata_page(
+        self,
+        limit: int | None = None,
+        cursor: tuple[datetime, str] | None = None,
+    ) -> list[tuple[str, str, datetime]]:
+        """(ファイル名, プロンプト, 作成日時) を新しい順に取得
+
+        cursorには前のページの最後の (作成日時, ファイル名) を渡す
+        """
+        statement = select(
+            ImageMetadata.image_filename,
+            ImageMetadata.prompt,
+            ImageMetadata.created_at,
+        ).order_by(ImageMetadata.created_at.desc(), ImageMetadata.image_filename.desc())
+        if cursor is not None:
+            statement = statement.where(
+                tuple_(ImageMetadata.created_at, ImageMetadata.image_filename)
+                < tuple_(*cursor)
+            )
+        if limit is not None:
+            statement = statement.limit(limit)
+
+        session: Session = self.get_session()
+        rows = session.execute(statement).all()
+        session.close()
+        return [tuple(row) for row in rows]  # type: ignore
+
+    def retrieve_simple_metadata_by_fingerprints(
+        self, fingerprints: list[str]
+    ) -> dict[str, tuple[str, str]]:
+        """フィンガープリントごとに、同じ条件で生成済みの (ファイル名, プロンプト) を取得"""
+        found: dict[str, tuple[str, str]] = {}
+        session: Session = self.get_session()
+        # SQLiteのバインド変数の上限を超えないよう分割して問い合わせる
+        for start in range(0, len(fingerprints), 500):
+            rows = session.execute(
+                select(
+                    ImageMetadata.fingerprint,
+                    ImageMetadata.image_filename,
+                    ImageMetadata.prompt,
+                ).where(
+                    ImageMetadata.fingerprint.in_(fingerprints[start : start + 500])
+                )
+            )
+            for fingerprint, image_filename, prompt in rows:
+                found[fingerprint] = (image_filename, prompt or "")
+        session.close()
+        return found
+
     def delete_metadata(self, image_filename: str):
         """画像ファイル名でメタデータを削除"""
+        self.delete_metadata_list([image_filename])
+
+    def delete_metadata_list(
+        self, image_filenames: list[str], session: Session | None = None
+    ):
+        """複数の画像ファイル名のメタデータを1トランザクションでまとめて削除"""
+        with self._session_scope(session) as scoped_session:
+            # SQLiteのバインド変数の上限を超えないよう分割する
+            for start in range(0, len(image_filenames), 500):
+                scoped_session.execute(
+                    delete(ImageMetadata).where(
+                        ImageMetadata.image_filename.in_(
+                            image_filenames[start : start + 500]
+                        )
+                    )
+                )
+
+    def enqueue_job(self, job_id: str, params: dict, total_steps: int) -> GenerationJob:
+        """生成ジョブをキューに追加"""
         session: Session = self.get_session()
-        metadata_to_delete = (
-            session.query(ImageMetadata)
-            .filter(ImageMetadata.image_filename == image_filename)
+        job = GenerationJob(
+            job_id=job_id,
+            status="queued",
+            params=params,
+            current_step=0,
+            total_steps=total_steps,
+            cancel_requested=False,
+        )
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        session.close()
+        return job
+
+    def retrieve_job(self, job_id: str) -> GenerationJob | None:
+        """ジョブIDでジョブを取得"""
+        session: Session = self.get_session()
+        job = session.get(GenerationJob, job_id)
+        session.close()
+        return job
+
+    def claim_next_job(self) -> GenerationJob | None:
+        """最も古い待機中のジョブを実行中にして取得"""
+        session: Session = self.get_session()
+        job = (
+            session.query(GenerationJob)
+            .filter(GenerationJob.status == "queued")
+            .order_by(GenerationJob.created_at)
             .first()
         )
-        if metadata_to_delete:
-            session.delete(metadata_to_delete)
-            session.commit()
+        if job is None:
+            session.close()
+            return None
+
+        # 他のワーカーに先に取られていないことを条件に更新する
+        claimed = session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.job_id == job.job_id)
+            .where(GenerationJob.status == "queued")
+            .values(status="running", started_at=datetime.now(UTC))
+        ).rowcount  # type: ignore
+        session.commit()
+        if claimed:
+            session.refresh(job)
+        session.close()
+        return job if claimed else None
+
+    def update_job_progress(self, job_id: str, current_step: int) -> bool:
+        """ジョブの進捗を更新し、キャンセルが要求されているかを返す"""
+        session: Session = self.get_session()
+        session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.job_id == job_id)
+            .values(current_step=current_step)
+        )
+        session.commit()
+        cancel_requested = (
+            session.query(GenerationJob.cancel_requested)
+            .filter(GenerationJob.job_id == job_id)
+            .scalar()
+        )
+        session.close()
+        return bool(cancel_requested)
+
+    def finish_job(
+        self,
+        job_id: str,
+        status: str,
+        image_filename: str | None = None,
+        error: str | None = None,
+    ):
+        """ジョブを終了状態にする"""
+        session: Session = self.get_session()
+        session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.job_id == job_id)
+            .values(
+                status=status,
+                image_filename=image_filename,
+                error=error,
+                finished_at=datetime.now(UTC),
+            )
+        )
+        session.commit()
+        session.close()
+
+    def request_job_cancel(self, job_id: str) -> GenerationJob | None:
+        """ジョブのキャンセルを要求 (待機中ならその場でキャンセル)"""
+        session: Session = self.get_session()
+        job = session.get(GenerationJob, job_id)
+        if job is None:
+            session.close()
+            return None
+        if job.status == "queued":
+            job.status = "cancelled"  # type: ignore
+            job.finished_at = datetime.now(UTC)  # type: ignore
+        elif job.status == "running":
+            job.cancel_requested = True  # type: ignore
+        session.commit()
+        session.refresh(job)
+        session.close()
+        return job
+
+    def requeue_running_jobs(self) -> int:
+        """前回のプロセスで実行中のまま残ったジョブを待機中に戻す"""
+        session: Session = self.get_session()
+        # キャンセル要求済みのものはそのままキャンセル扱いにする
+        session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.status == "running")
+            .where(GenerationJob.cancel_requested.is_(True))
+            .values(status="cancelled", finished_at=datetime.now(UTC))
+        )
+        requeued = session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.status == "running")
+            .values(status="queued", current_step=0, started_at=None)
+        ).rowcount  # type: ignore
+        session.commit()
+        session.close()
+        return requeued
+
+    def count_jobs_by_status(self) -> dict[str, int]:
+        """ステータスごとのジョブ数を取得"""
+        session: Session = self.get_session()
+        rows = (
+            session.query(GenerationJob.status, func.count())
+            .group_by(GenerationJob.status)
+            .all()
+        )
+        session.close()
+        return dict(rows)  # type: ignore
+
+    def retrieve_finished_jobs(self, limit: int) -> list[GenerationJob]:
+        """直近に終了したジョブを新しい順に取得"""
+        session: Session = self.get_session()
+        jobs = (
+            session.query(GenerationJob)
+            .filter(GenerationJob.finished_at.is_not(None))
+            .filter(GenerationJob.started_at.is_not(None))
+            .order_by(GenerationJob.finished_at.desc())
+            .limit(limit)
+            .all()
+        )
         session.close()
+        return jobs
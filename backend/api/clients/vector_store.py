@@ -0,0 +1,76 @@
+from typing import Protocol
+
+import numpy as np
+
+from api.clients.numpy_store import NumpyVectorStore
+from api.clients.qdrant import QdrantClientManager
+from api.config import Settings
+from api.schema import ScoredMetadata, SearchFilters
+
+
+class VectorStore(Protocol):
+    """embeddingを保存・検索するバックエンド (Qdrant / NumPy) の共通インターフェース"""
+
+    # 内容を変更するたびに増える番号
+    version: int
+
+    def upload_point(
+        self,
+        image_embedding: np.ndarray,
+        text_embedding: np.ndarray,
+        image_filename: str,
+        prompt: str,
+        extra_payload: dict | None = None,
+    ): ...
+
+    def upload_points(
+        self,
+        image_embeddings: np.ndarray,
+        text_embeddings: np.ndarray | None,
+        image_filenames: list[str],
+        prompts: list[str],
+        extra_payloads: list[dict] | None = None,
+    ): ...
+
+    def search_points(
+        self,
+        query_embedding: np.ndarray,
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+    ) -> list[ScoredMetadata]: ...
+
+    def search_points_batch(
+        self,
+        query_embeddings: np.ndarray,
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+    ) -> list[list[ScoredMetadata]]: ...
+
+    def hybrid_search_points(
+        self,
+        queries: list[tuple[str, np.ndarray, float]],
+        topk: int = 5,
+        filters: SearchFilters | None = None,
+        fusion: str = "rrf",
+    ) -> list[ScoredMetadata]: ...
+
+    def scroll_embeddings(
+        self, using: str = "image"
+    ) -> tuple[list[str], np.ndarray]: ...
+
+    def retrieve_embeddings(
+        self, image_filenames: list[str], using: str = "image"
+    ) -> np.ndarray: ...
+
+    def delete_point(self, image_filename: str): ...
+
+    def delete_points(self, image_filenames: list[str]): ...
+
+
+def create_vector_store(settings: Settings) -> VectorStore:
+    """設定 (VECTOR_BACKEND) に応じてバックエンドを作成"""
+    if settings.VECTOR_BACKEND == "qdrant":
+        return QdrantClientManager(settings)
+    if settings.VECTOR_BACKEND == "numpy":
+        return NumpyVectorStore(settings)
+    raise ValueError(f"Unknown vector backend: {settings.VECTOR_BACKEND}")
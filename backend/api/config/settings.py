@@ -1,6 +1,5 @@
 from pathlib import Path
 
-import torch
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,13 +8,7 @@ class Settings(BaseSettings):
         env_file=".env",
         env_file_encoding="utf-8",
     )
-    DEVICE: str = (
-        "cuda"
-        if torch.cuda.is_available()
-        else "mps"
-        if torch.backends.mps.is_available()
-        else "cpu"
-    )
+    DEVICE: str = "auto"  # モデルを載せるデバイス (autoでcuda・mps・cpuの順に選ぶ)
     EMBEDDING_DIM: int = 512
 
     # データベース
@@ -47,7 +40,77 @@ class Settings(BaseSettings):
         / "data"
         / "embeddings.db"
     )
+    MAP_DIR: str = str(
+        Path(__file__).resolve().parents[3]
+        / "frontend"
+        / "public"
+        / "data"
+        / "embedding_map"
+    )
+    THUMBNAIL_DIR: str = str(
+        Path(__file__).resolve().parents[3]
+        / "frontend"
+        / "public"
+        / "data"
+        / "thumbnails"
+    )
+    SQLITE_JOURNAL_MODE: str = "WAL"  # 読み込みと書き込みを並行できるWALを使う
+    SQLITE_SYNCHRONOUS: str = "NORMAL"  # WALではNORMALでもDBが壊れることはない
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024  # 読み込みに使うmmapのサイズ (0で無効)
+    SQLITE_POOL_SIZE: int = 5  # 使い回す接続数
+    SQLITE_POOL_MAX_OVERFLOW: int = 10  # プールを超えて一時的に開ける接続数
+    SQLITE_BUSY_TIMEOUT_SECONDS: float = 5.0  # ロック解除を待つ最大時間
+    NUMPY_STORE_DIR: str = str(
+        Path(__file__).resolve().parents[3]
+        / "frontend"
+        / "public"
+        / "data"
+        / "embeddings_npy"
+    )
+    VECTOR_BACKEND: str = "qdrant"  # 検索バックエンド (qdrant / numpy)
+    NUMPY_STORE_DTYPE: str = (
+        "float32"  # numpyバックエンドの保存形式 (float16 / float32)
+    )
     COLLECTION_NAME: str = "image_embeddings"
+    QDRANT_UPSERT_BATCH_SIZE: int = 256  # 1回のupsertで送るポイント数
+    QDRANT_URL: str | None = None  # Qdrantサーバーを使う場合のURL (未指定ならローカル)
+    QDRANT_API_KEY: str | None = None
+    QDRANT_ON_DISK: bool = False  # 元のベクトルをメモリではなくディスクに置く
+    QDRANT_QUANTIZATION: str = "none"  # ベクトルの量子化 (none / scalar / binary)
+    QDRANT_QUANTIZATION_ALWAYS_RAM: bool = True  # 量子化したベクトルは常にメモリに置く
+    QDRANT_HNSW_M: int = 16  # HNSWグラフで各点がつながる近傍の数
+    QDRANT_HNSW_EF_CONSTRUCT: int = 100  # インデックス構築時の探索幅
+    QDRANT_HNSW_EF: int | None = None  # 検索時の探索幅 (Noneでサーバーのデフォルト)
+    QDRANT_RESCORE: bool = True  # 量子化で取った候補を元のベクトルで並べ直す
+    QDRANT_OVERSAMPLING: float = 2.0  # 並べ直し用に多めに取る候補の倍率
+    HYBRID_PREFETCH_LIMIT: int = 50  # ハイブリッド検索で各クエリから取る候補数
+    QDRANT_MIGRATE_POINT_IDS: bool = False  # 起動時に旧形式 (uuid4) のポイントIDを移行する (全件を走査するので通常は migrate_qdrant.py で1回だけ行う)
+
+    # 埋め込みマップ
+    MAP_PROJECTION_METHOD: str = "pca"  # 2次元への射影方法 (pca / umap)
+    MAP_TILE_MAX_ZOOM: int = 8  # タイルの最大ズームレベル
+    MAP_TILE_GRID_SIZE: int = 16  # 1タイルを何分割してクラスタにまとめるか (一辺)
+
+    # 生成画像の保存
+    IMAGE_FORMAT: str = "png"  # 生成画像の保存形式 (png / webp / jpeg)
+    IMAGE_PNG_COMPRESS_LEVEL: int = 1  # PNGの圧縮レベル (0-9, 大きいほど遅い)
+    IMAGE_QUALITY: int = 95  # WebP・JPEGのエンコード品質 (1-100)
+    PERSIST_DURABLE_DEFAULT: bool = False  # 保存の完了を待ってから応答するか
+    PERSIST_MAX_PENDING: int = 32  # 保存待ちにできるリクエスト数の上限
+    PERSIST_MAX_RETRIES: int = 2  # 保存に失敗したときに再試行する回数
+    PERSIST_RETRY_BACKOFF_SECONDS: float = (
+        1.0  # 最初の再試行までの待ち時間 (再試行のたびに倍にする)
+    )
+    PERSIST_FAILURE_HISTORY: int = 100  # 保存に失敗した画像を記録しておく件数
+
+    # サムネイル
+    THUMBNAIL_SIZES: list[int] = [128, 256, 512]  # 長辺のピクセル数
+    THUMBNAIL_FORMAT: str = "webp"  # サムネイルの形式 (webp / jpeg)
+    THUMBNAIL_QUALITY: int = 80  # エンコード品質 (1-100)
+
+    # 既存画像の一括取り込み
+    INGEST_BATCH_SIZE: int = 64  # CLIPでまとめて埋め込む画像数
+    INGEST_DECODE_WORKERS: int = 4  # 画像のデコードに使うスレッド数
 
     # モデル
     SD_BASE_MODEL: str = "black-forest-labs/FLUX.1-dev"  # Stable Diffusion ベースモデル
@@ -59,6 +122,80 @@ class Settings(BaseSettings):
         "openai/clip-vit-base-patch32"  # 画像・テキスト埋め込み用のCLIPモデル
     )
 
+    # 画像生成モデルのメモリ設定 (CPUやVRAMの少ない環境向け)
+    DIFFUSION_DTYPE: str = "bfloat16"  # 重みの型 (bfloat16 / float16 / float32)
+    DIFFUSION_OFFLOAD: str = (
+        "none"  # CPUオフロード (none / model: モデル単位 / sequential: 層単位)
+    )
+    DIFFUSION_VAE_TILING: bool = False  # VAEのデコードをタイルに分けて行う
+    DIFFUSION_VAE_SLICING: bool = False  # VAEのデコードを1枚ずつ行う
+    DIFFUSION_ATTENTION_SLICING: bool = False  # attentionを分割して計算する
+    DIFFUSION_QUANTIZATION: str = (
+        "none"  # トランスフォーマーとT5エンコーダの量子化 (none / int8 / nf4)
+    )
+
+    # 画像生成のプリセット (api/clients/presets.py)
+    DIFFUSION_PRESETS: list[str] = [
+        "default"
+    ]  # ロード時に準備するプリセット (LoRAのロード・torch.compileを行う)
+    DIFFUSION_DEFAULT_PRESET: str = "default"  # リクエストで指定がない場合のプリセット
+    DIFFUSION_COMPILE_WARMUP: bool = (
+        True  # torch.compileする場合、ロード時に1回生成してコンパイルを済ませる
+    )
+    PRESET_STATS_WINDOW: int = 100  # プリセットごとのレイテンシ集計に使う直近の画像数
+
+    PROMPT_EMBEDDING_CACHE_SIZE: int = (
+        128  # プロンプト埋め込みのキャッシュ件数 (0で無効)
+    )
+    CONTROL_IMAGE_CACHE_SIZE: int = 64  # 条件画像のキャッシュ件数 (0で無効)
+    CONTROL_IMAGE_CACHE_MAX_BYTES: int = (
+        256 * 1024 * 1024
+    )  # 条件画像キャッシュのメモリ上限
+    MAX_GENERATION_BATCH_SIZE: int = 8  # 1回のパイプライン呼び出しで生成する最大枚数
+    MAX_CONTROL_IMAGES: int = 4  # 1回の生成で使える条件画像の最大数
+    GENERATION_REUSE_DEFAULT: bool = (
+        True  # 同じ条件で生成済みの画像があれば生成せずに返す (リクエストで上書き可)
+    )
+    GENERATION_REUSE_WAIT_TIMEOUT_SECONDS: float = (
+        600.0  # 生成中の同じリクエストの完了を待つ最大時間 (超えた場合は503)
+    )
+
+    # CLIPのマイクロバッチ
+    CLIP_BATCH_MAX_SIZE: int = 32  # 1回のforwardでまとめる最大件数
+    CLIP_BATCH_MAX_WAIT_MS: float = 5.0  # リクエストを溜める最大待ち時間 (ミリ秒)
+
+    # 検索クエリのキャッシュ
+    TEXT_EMBEDDING_CACHE_SIZE: int = (
+        1024  # テキスト検索の埋め込みのキャッシュ件数 (0で無効)
+    )
+    TEXT_EMBEDDING_CACHE_TTL_SECONDS: float | None = (
+        None  # テキスト埋め込みの有効期限 (Noneで無期限)
+    )
+    TEXT_EMBEDDING_CACHE_PATH: str | None = (
+        None  # 再起動後も使えるようテキスト埋め込みを保存するファイル (Noneで保存しない)
+    )
+    SEARCH_RESULT_CACHE_SIZE: int = 256  # 検索結果のキャッシュ件数 (0で無効)
+    SEARCH_RESULT_CACHE_TTL_SECONDS: float | None = (
+        300.0  # 検索結果の有効期限 (Noneで無期限)
+    )
+    SEARCH_STREAM_CHUNK_SIZE: int = 256  # NDJSONの検索結果を1回に送る件数
+
+    # 推論用スレッドプール (レーンごとのワーカー数と待機キューの上限)
+    DIFFUSION_WORKERS: int = 1
+    DIFFUSION_MAX_QUEUE: int = 4
+    CLIP_WORKERS: int = 2
+    CLIP_MAX_QUEUE: int = 64
+
+    # 生成ジョブキュー
+    JOB_POLL_INTERVAL_SECONDS: float = 1.0  # 待機中ジョブを確認する間隔
+    JOB_STATS_WINDOW: int = 100  # レイテンシ集計に使う直近のジョブ数
+
+    # モデルのロード
+    SEARCH_ONLY: bool = False  # 検索専用で起動し、画像生成のモデルをロードしない
+    WARMUP_ON_STARTUP: bool = (
+        True  # 起動後にバックグラウンドでモデルをロードしておく (Falseなら最初の利用時)
+    )
+
 
 # シングルトンとして設定をエクスポート
 settings = Settings()
@@ -1,12 +1,40 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from api.config import settings
 from api.router import router
+from api.service import (
+    image_service,
+    inference_executor,
+    job_service,
+    model_warmup,
+    persistence_writer,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # モデルはバックグラウンドでロードし、起動自体は待たせない
+    model_warmup.start()
+    # 生成ジョブのワーカーを起動し、終了時に停止する (検索専用モードでは起動しない)
+    if not settings.SEARCH_ONLY:
+        job_service.start()
+    yield
+    job_service.stop()
+    inference_executor.shutdown()
+    # 保存待ちの画像を書き込んでから終了する
+    persistence_writer.shutdown()
+    # テキスト埋め込みのキャッシュを次回の起動で使えるよう保存する
+    image_service.save_caches()
+
 
 app = FastAPI(
     title="Image Generation and Search API",
     description="Stable Diffusionを使った画像生成・検索API",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 
@@ -18,7 +46,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"],
+    expose_headers=[
+        "Content-Disposition",
+        "X-Next-Cursor",
+        "X-Map-Count",
+        "X-Map-Version",
+        "X-Embedding-Shape",
+        "X-Embedding-Dtype",
+    ],
 )
 
 app.include_router(router, prefix="/api")
@@ -1,9 +1,15 @@
 from fastapi import APIRouter
 
+from .health import router as health_router
 from .image import router as image_router
+from .job import router as job_router
+from .map import router as map_router
 
 # メインルーターの作成と各サブルーターの登録
 router = APIRouter()
+router.include_router(health_router)
 router.include_router(image_router)
+router.include_router(job_router)
+router.include_router(map_router)
 
 __all__ = ["router"]
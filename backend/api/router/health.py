@@ -0,0 +1,28 @@
+from fastapi import APIRouter, HTTPException, Response
+
+from api.schema import Readiness
+from api.service import model_warmup
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+
+@router.get("")
+async def get_liveness():
+    """APIが起動しているかを確認する (モデルのロード状況には依存しない)"""
+    return {"status": "ok"}
+
+
+@router.get(
+    "/ready",
+    response_model=Readiness,
+    responses={503: {"model": Readiness}},
+)
+async def get_readiness(response: Response):
+    """必要なモデルがロード済みかを確認する (未ロードの場合は503を返す)"""
+    try:
+        result: Readiness = model_warmup.readiness()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not result.ready:
+        response.status_code = 503
+    return result
@@ -1,12 +1,27 @@
-from fastapi import APIRouter, HTTPException, UploadFile
+from datetime import datetime
+from typing import Literal
+
+from fastapi import APIRouter, Header, HTTPException, Query, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
 
 from api.schema import (
+    BatchImageGenerationParams,
+    CacheStats,
     DeleteResponse,
+    HybridSearchParams,
     ImageFilenames,
     ImageGenerationParams,
+    PersistenceStats,
+    PresetStats,
+    ScoredMetadata,
+    SearchFilters,
     SimpleMetadata,
 )
-from api.service import image_service
+from api.service import image_service, inference_executor
+
+# ファイル名はUUIDで内容が変わらないので、ブラウザに長期間キャッシュさせる
+THUMBNAIL_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 router = APIRouter(prefix="/image", tags=["image"])
 
@@ -15,7 +30,10 @@ router = APIRouter(prefix="/image", tags=["image"])
 async def generate_image(request: ImageGenerationParams):
     """プロンプトから画像を生成し保存する"""
     try:
-        result: SimpleMetadata = image_service.generate_and_save_image(
+        # 推論はdiffusionレーンで実行し、その間も他のリクエストを処理できるようにする
+        result: SimpleMetadata = await inference_executor.run(
+            "diffusion",
+            image_service.generate_and_save_image,
             prompt=request.prompt,
             width=request.width,
             height=request.height,
@@ -25,21 +43,75 @@ async def generate_image(request: ImageGenerationParams):
             controlnet_conditioning_scale_2=request.controlnet_conditioning_scale_2,
             control_guidance_end_1=request.control_guidance_end_1,
             control_guidance_end_2=request.control_guidance_end_2,
+            control_images=request.control_images,
             num_inference_steps=request.num_inference_steps,
             guidance_scale=request.guidance_scale,
             seed=request.seed,
+            preset=request.preset,
+            durable=request.durable,
+            reuse_existing=request.reuse_existing,
         )
         return result
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/generate-batch", response_model=list[SimpleMetadata])
+async def generate_images(request: BatchImageGenerationParams):
+    """複数のプロンプト・シードで画像をまとめて生成し保存する"""
+    try:
+        results: list[SimpleMetadata] = await inference_executor.run(
+            "diffusion",
+            image_service.generate_and_save_images,
+            prompts=request.prompts,
+            seeds=request.seeds,
+            width=request.width,
+            height=request.height,
+            control_image_filename_1=request.control_image_filename_1,
+            control_image_filename_2=request.control_image_filename_2,
+            controlnet_conditioning_scale_1=request.controlnet_conditioning_scale_1,
+            controlnet_conditioning_scale_2=request.controlnet_conditioning_scale_2,
+            control_guidance_end_1=request.control_guidance_end_1,
+            control_guidance_end_2=request.control_guidance_end_2,
+            control_images=request.control_images,
+            num_inference_steps=request.num_inference_steps,
+            guidance_scale=request.guidance_scale,
+            preset=request.preset,
+            durable=request.durable,
+            reuse_existing=request.reuse_existing,
+        )
+        return results
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.get("/all-simple-metadata", response_model=list[SimpleMetadata])
-async def get_all_simple_metadata():
-    """保存されている全ての画像についてシンプルなメタデータを取得する"""
+async def get_all_simple_metadata(
+    response: Response,
+    limit: int | None = Query(None, ge=1, le=1000),
+    cursor: str | None = None,
+):
+    """保存されている画像についてシンプルなメタデータを新しい順に取得する
+
+    limitを指定した場合はページングし、次のページのカーソルをX-Next-Cursorヘッダで返す
+    """
     try:
-        result: list[SimpleMetadata] = image_service.fetch_all_simple_metadata_list()
+        result, next_cursor = image_service.fetch_simple_metadata_page(
+            limit=limit, cursor=cursor
+        )
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
         return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -54,18 +126,205 @@ async def get_all_control_image_filenames():
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/search", response_model=list[SimpleMetadata])
+@router.get(
+    "/thumbnail/{size}/{image_filename}",
+    response_class=FileResponse,
+    responses={200: {"content": {"image/webp": {}, "image/jpeg": {}}}},
+)
+async def get_thumbnail(
+    size: int, image_filename: str, if_none_match: str | None = Header(None)
+):
+    """画像のサムネイルを取得する (ETagが一致する場合は304を返す)"""
+    try:
+        # 未作成のサムネイルは元画像のデコード・縮小・エンコードを伴うため、イベントループ外で実行する
+        path = await run_in_threadpool(
+            image_service.fetch_thumbnail_path, image_filename, size
+        )
+        stat = path.stat()
+        etag = f'"{size}-{stat.st_mtime_ns}-{stat.st_size}"'
+        headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        return FileResponse(
+            path,
+            media_type=f"image/{path.suffix.lstrip('.')}",
+            headers=headers,
+        )
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/cache-stats", response_model=list[CacheStats])
+async def get_cache_stats():
+    """各キャッシュのヒット・ミス数などを取得する"""
+    try:
+        result: list[CacheStats] = image_service.fetch_cache_stats()
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/persistence-stats", response_model=PersistenceStats)
+async def get_persistence_stats():
+    """保存待ち・失敗した書き込みなど、バックグラウンドでの保存の状況を取得する"""
+    try:
+        result: PersistenceStats = image_service.fetch_persistence_stats()
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/presets", response_model=list[PresetStats])
+async def get_presets():
+    """有効なサンプリングプリセットと、それぞれの直近の生成時間を取得する"""
+    try:
+        result: list[PresetStats] = image_service.fetch_preset_stats()
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/search", response_model=list[ScoredMetadata])
 async def search_images(
     image: UploadFile | None = None,
     text: str | None = None,
     topk: int = 3,
+    control_image_filename: str | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    seed: int | None = None,
+    prompt_contains: str | None = None,
 ):
-    """テキストまたは画像に基づいて類似画像を検索する"""
+    """テキストまたは画像に基づいて類似画像を類似度付きで検索する (条件での絞り込みも可能)"""
     try:
-        results: list[SimpleMetadata] = await image_service.search_similar_images(
-            image=image, text=text, topk=topk
+        filters = SearchFilters(
+            control_image_filename=control_image_filename,
+            created_after=created_after,
+            created_before=created_before,
+            seed=seed,
+            prompt_contains=prompt_contains,
+        )
+        results: list[ScoredMetadata] = await image_service.search_similar_images(
+            image=image, text=text, topk=topk, filters=filters
         )
         return results
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/search-stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def search_images_stream(
+    image: UploadFile | None = None,
+    text: str | None = None,
+    topk: int = 3,
+    control_image_filename: str | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    seed: int | None = None,
+    prompt_contains: str | None = None,
+):
+    """/search と同じ検索を行い、結果 (ScoredMetadata) を1行1件のNDJSONで返す (大きいtopk向け)"""
+    try:
+        filters = SearchFilters(
+            control_image_filename=control_image_filename,
+            created_after=created_after,
+            created_before=created_before,
+            seed=seed,
+            prompt_contains=prompt_contains,
+        )
+        chunks = await image_service.stream_similar_images(
+            image=image, text=text, topk=topk, filters=filters
+        )
+        return StreamingResponse(chunks, media_type="application/x-ndjson")
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/search-hybrid", response_model=list[ScoredMetadata])
+async def search_images_hybrid(
+    image: UploadFile | None = None,
+    text: str | None = None,
+    topk: int = 3,
+    fusion: Literal["rrf", "weighted"] = "rrf",
+    image_weight: float = Query(1.0, ge=0.0),
+    text_weight: float = Query(1.0, ge=0.0),
+    prompt_weight: float = Query(0.0, ge=0.0),
+    control_image_filename: str | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    seed: int | None = None,
+    prompt_contains: str | None = None,
+):
+    """テキストと画像を同時に使い、重み付きで順位を統合して類似画像を検索する"""
+    try:
+        filters = SearchFilters(
+            control_image_filename=control_image_filename,
+            created_after=created_after,
+            created_before=created_before,
+            seed=seed,
+            prompt_contains=prompt_contains,
+        )
+        params = HybridSearchParams(
+            fusion=fusion,
+            image_weight=image_weight,
+            text_weight=text_weight,
+            prompt_weight=prompt_weight,
+        )
+        results: list[ScoredMetadata] = await image_service.search_hybrid_images(
+            image=image, text=text, topk=topk, filters=filters, params=params
+        )
+        return results
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/embeddings",
+    response_class=Response,
+    responses={200: {"content": {"application/octet-stream": {}}}},
+)
+async def get_embeddings(
+    request: ImageFilenames, using: Literal["image", "text"] = "image"
+):
+    """指定した画像のembeddingをfloat32 [N, dim] (リトルエンディアン) のバイナリで取得する
+
+    行の順序はリクエストのファイル名と同じで、形状はX-Embedding-Shape (N,dim) で返す
+    """
+    try:
+        # 保存済みのembeddingを読むだけなので、推論レーンではなくスレッドプールで実行する
+        data, (count, dim) = await run_in_threadpool(
+            image_service.fetch_embeddings, request.image_filenames, using
+        )
+        return Response(
+            content=data,
+            media_type="application/octet-stream",
+            headers={
+                "X-Embedding-Shape": f"{count},{dim}",
+                "X-Embedding-Dtype": "float32",
+            },
+        )
+    except HTTPException as e:
+        raise e
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -76,7 +335,10 @@ async def search_images(
 async def delete_images(request: ImageFilenames):
     """画像を削除する"""
     try:
-        result: DeleteResponse = image_service.delete_images(request.image_filenames)
+        # 保存待ちの画像の書き込みや、マップのタイルの無効化を待つことがあるため、イベントループ外で実行する
+        result: DeleteResponse = await run_in_threadpool(
+            image_service.delete_images, request.image_filenames
+        )
         return result
     except HTTPException as e:
         raise e
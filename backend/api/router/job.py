@@ -0,0 +1,61 @@
+from fastapi import APIRouter, HTTPException
+
+from api.schema import ImageGenerationParams, JobProgress, JobQueueStats, JobStatus
+from api.service import job_service
+
+router = APIRouter(prefix="/job", tags=["job"])
+
+
+@router.post("/generate", response_model=JobStatus, status_code=202)
+async def submit_generation_job(request: ImageGenerationParams):
+    """画像生成ジョブをキューに追加し、ジョブIDを返す"""
+    try:
+        return job_service.submit(request)
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/stats", response_model=JobQueueStats)
+async def get_job_stats():
+    """キューの深さとジョブのレイテンシを取得する"""
+    try:
+        return job_service.get_stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/{job_id}", response_model=JobStatus)
+async def get_job_status(job_id: str):
+    """ジョブの状態を取得する"""
+    try:
+        return job_service.get_status(job_id)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/{job_id}/progress", response_model=JobProgress)
+async def get_job_progress(job_id: str):
+    """ジョブの進捗 (デノイズのステップ数) を取得する"""
+    try:
+        return job_service.get_progress(job_id)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/{job_id}/cancel", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    """ジョブをキャンセルする"""
+    try:
+        return job_service.cancel(job_id)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,76 @@
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+
+from api.schema import MapInfo, MapTile
+from api.service import inference_executor, map_service
+
+router = APIRouter(prefix="/map", tags=["map"])
+
+
+@router.post("/rebuild", response_model=MapInfo)
+async def rebuild_map():
+    """全画像のembeddingから2次元マップを作り直す"""
+    try:
+        result: MapInfo = await inference_executor.run("clip", map_service.rebuild)
+        return result
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/info", response_model=MapInfo)
+async def get_map_info():
+    """マップの状態を取得する"""
+    try:
+        result: MapInfo = map_service.fetch_info()
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get(
+    "/coordinates",
+    response_class=Response,
+    responses={200: {"content": {"application/octet-stream": {}}}},
+)
+async def get_map_coordinates():
+    """全点の座標をfloat32 [N, 2] (リトルエンディアン) のバイナリで取得する
+
+    点の順序は /map/filenames と同じ (X-Map-Versionが一致する場合)
+    """
+    try:
+        data, count, version = map_service.fetch_coordinates()
+        return Response(
+            content=data,
+            media_type="application/octet-stream",
+            headers={"X-Map-Count": str(count), "X-Map-Version": str(version)},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/filenames", response_model=list[str])
+async def get_map_filenames(response: Response):
+    """座標と同じ順の画像ファイル名を取得する"""
+    try:
+        image_filenames, version = map_service.fetch_filenames()
+        response.headers["X-Map-Version"] = str(version)
+        return image_filenames
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/tiles/{z}/{x}/{y}", response_model=MapTile)
+async def get_map_tile(z: int, x: int, y: int):
+    """ズームレベルに応じてクラスタにまとめたタイルを取得する"""
+    try:
+        # キャッシュがない場合は全点の振り分けを計算するため、イベントループ外で実行する
+        result: MapTile = await run_in_threadpool(map_service.fetch_tile, z, x, y)
+        return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,15 +1,51 @@
 from .schema import (
+    BatchImageGenerationParams,
+    CacheStats,
+    ControlImageParams,
     DeleteResponse,
     FullMetadata,
+    HybridSearchParams,
     ImageFilenames,
     ImageGenerationParams,
+    IngestReport,
+    JobProgress,
+    JobQueueStats,
+    JobStatus,
+    MapCluster,
+    MapInfo,
+    MapTile,
+    ModelStatus,
+    PersistenceFailure,
+    PersistenceStats,
+    PresetStats,
+    Readiness,
+    ScoredMetadata,
+    SearchFilters,
     SimpleMetadata,
 )
 
 __all__ = [
+    "BatchImageGenerationParams",
+    "CacheStats",
+    "ControlImageParams",
     "DeleteResponse",
     "FullMetadata",
+    "HybridSearchParams",
     "ImageFilenames",
     "ImageGenerationParams",
+    "IngestReport",
+    "JobProgress",
+    "JobQueueStats",
+    "JobStatus",
+    "MapCluster",
+    "MapInfo",
+    "MapTile",
+    "ModelStatus",
+    "PersistenceFailure",
+    "PersistenceStats",
+    "PresetStats",
+    "Readiness",
+    "ScoredMetadata",
+    "SearchFilters",
     "SimpleMetadata",
 ]
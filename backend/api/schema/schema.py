@@ -1,6 +1,17 @@
+from datetime import datetime
+from typing import Literal
+
 from pydantic import BaseModel, Field
 
 
+class ControlImageParams(BaseModel):
+    filename: str = Field(..., description="Filename of the control image")
+    conditioning_scale: float = Field(
+        ..., description="Conditioning scale for the control image"
+    )
+    guidance_end: float = Field(..., description="Guidance end for the control image")
+
+
 class ImageGenerationParams(BaseModel):
     prompt: str = Field(..., description="Text prompt for the image")
     width: int = Field(..., description="Width of the image")
@@ -23,9 +34,74 @@ class ImageGenerationParams(BaseModel):
     control_guidance_end_2: float | None = Field(
         None, description="Guidance end for the second control image"
     )
+    control_images: list[ControlImageParams] = Field(
+        default_factory=list,
+        description="Additional control images, applied after the numbered ones",
+    )
     num_inference_steps: int = Field(..., description="Number of inference steps")
     guidance_scale: float = Field(..., description="Guidance scale")
     seed: int = Field(..., description="Random seed for generation")
+    preset: str | None = Field(
+        None,
+        description="Sampling preset; its steps and guidance override the request (server default if omitted)",
+    )
+    durable: bool | None = Field(
+        None,
+        description="Wait until the image is persisted before responding (server default if omitted)",
+    )
+    reuse_existing: bool | None = Field(
+        None,
+        description="Return an existing image generated with identical parameters instead of generating again (server default if omitted)",
+    )
+
+
+class BatchImageGenerationParams(BaseModel):
+    prompts: list[str] = Field(
+        ...,
+        description="Text prompts for the images (repeated if a single prompt is given)",
+    )
+    seeds: list[int] = Field(
+        ...,
+        description="Random seeds for generation (repeated if a single seed is given)",
+    )
+    width: int = Field(..., description="Width of the images")
+    height: int = Field(..., description="Height of the images")
+    control_image_filename_1: str | None = Field(
+        None, description="Filename of the first control image"
+    )
+    control_image_filename_2: str | None = Field(
+        None, description="Filename of the second control image"
+    )
+    controlnet_conditioning_scale_1: float | None = Field(
+        None, description="Conditioning scale for the first control image"
+    )
+    controlnet_conditioning_scale_2: float | None = Field(
+        None, description="Conditioning scale for the second control image"
+    )
+    control_guidance_end_1: float | None = Field(
+        None, description="Guidance end for the first control image"
+    )
+    control_guidance_end_2: float | None = Field(
+        None, description="Guidance end for the second control image"
+    )
+    control_images: list[ControlImageParams] = Field(
+        default_factory=list,
+        description="Additional control images, applied after the numbered ones",
+    )
+    num_inference_steps: int = Field(..., description="Number of inference steps")
+    guidance_scale: float = Field(..., description="Guidance scale")
+    preset: str | None = Field(
+        None,
+        description="Sampling preset; its steps and guidance override the request (server default if omitted)",
+    )
+    durable: bool | None = Field(
+        None,
+        description="Wait until the images are persisted before responding (server default if omitted)",
+    )
+    reuse_existing: bool | None = Field(
+        None,
+        description="Return an existing image generated with identical parameters instead of generating again (server default if omitted)",
+    )
 
 
 class SimpleMetadata(BaseModel):
@@ -33,13 +109,51 @@ class SimpleMetadata(BaseModel):
     prompt: str = Field(..., description="Text prompt for the image")
 
 
+class ScoredMetadata(SimpleMetadata):
+    score: float = Field(
+        ..., description="Similarity to the query (fused score for hybrid search)"
+    )
+
+
+class SearchFilters(BaseModel):
+    control_image_filename: str | None = Field(
+        None, description="Only images generated with this control image"
+    )
+    created_after: datetime | None = Field(
+        None, description="Only images created at or after this time"
+    )
+    created_before: datetime | None = Field(
+        None, description="Only images created at or before this time"
+    )
+    seed: int | None = Field(None, description="Only images generated with this seed")
+    prompt_contains: str | None = Field(
+        None, description="Only images whose prompt contains these words"
+    )
+
+
+class HybridSearchParams(BaseModel):
+    fusion: Literal["rrf", "weighted"] = Field(
+        "rrf",
+        description="Fusion method (weighted reciprocal rank fusion or weighted score sum)",
+    )
+    image_weight: float = Field(
+        1.0, ge=0.0, description="Weight of the image query against image vectors"
+    )
+    text_weight: float = Field(
+        1.0, ge=0.0, description="Weight of the text query against image vectors"
+    )
+    prompt_weight: float = Field(
+        0.0, ge=0.0, description="Weight of the text query against prompt vectors"
+    )
+
+
 class FullMetadata(ImageGenerationParams):
     image_filename: str = Field(..., description="Filename of the generated image")
 
 
 class ImageFilenames(BaseModel):
     image_filenames: list[str] = Field(
-        ..., description="List of filenames of the images to be deleted"
+        ..., description="List of filenames of the images"
     )
 
 
@@ -51,3 +165,150 @@ class DeleteResponse(BaseModel):
     failed_filenames: list[str] = Field(
         ..., description="List of filenames that failed to delete"
     )
+
+
+class JobStatus(BaseModel):
+    job_id: str = Field(..., description="ID of the generation job")
+    status: str = Field(
+        ...,
+        description="Status of the job (queued, running, succeeded, failed, cancelled)",
+    )
+    current_step: int = Field(..., description="Number of completed denoising steps")
+    total_steps: int = Field(..., description="Total number of denoising steps")
+    image_filename: str | None = Field(
+        None, description="Filename of the generated image (when succeeded)"
+    )
+    error: str | None = Field(None, description="Error message (when failed)")
+    created_at: datetime = Field(..., description="Time the job was submitted")
+    started_at: datetime | None = Field(None, description="Time the job started")
+    finished_at: datetime | None = Field(None, description="Time the job finished")
+
+
+class JobProgress(BaseModel):
+    job_id: str = Field(..., description="ID of the generation job")
+    status: str = Field(..., description="Status of the job")
+    current_step: int = Field(..., description="Number of completed denoising steps")
+    total_steps: int = Field(..., description="Total number of denoising steps")
+    progress: float = Field(..., description="Progress ratio between 0 and 1")
+
+
+class JobQueueStats(BaseModel):
+    queue_depth: int = Field(..., description="Number of jobs waiting to run")
+    running: int = Field(..., description="Number of jobs currently running")
+    succeeded: int = Field(..., description="Number of succeeded jobs")
+    failed: int = Field(..., description="Number of failed jobs")
+    cancelled: int = Field(..., description="Number of cancelled jobs")
+    avg_wait_seconds: float | None = Field(
+        None, description="Average time recent jobs spent in the queue"
+    )
+    avg_run_seconds: float | None = Field(
+        None, description="Average run time of recent jobs"
+    )
+    p95_run_seconds: float | None = Field(
+        None, description="95th percentile run time of recent jobs"
+    )
+
+
+class PersistenceFailure(BaseModel):
+    image_filenames: list[str] = Field(
+        ..., description="Filenames of the images that could not be saved"
+    )
+    error: str = Field(..., description="Error message of the last attempt")
+    failed_at: datetime = Field(..., description="Time the write was given up")
+
+
+class PersistenceStats(BaseModel):
+    pending: int = Field(..., description="Number of images waiting to be saved")
+    succeeded: int = Field(..., description="Number of images saved")
+    retried: int = Field(..., description="Number of retried write attempts")
+    failed: int = Field(..., description="Number of images that could not be saved")
+    recent_failures: list[PersistenceFailure] = Field(
+        ..., description="Most recent failed writes, newest first"
+    )
+
+
+class PresetStats(BaseModel):
+    name: str = Field(..., description="Name of the sampling preset")
+    description: str = Field(..., description="What the preset changes")
+    num_inference_steps: int | None = Field(
+        None, description="Fixed number of steps (request value if omitted)"
+    )
+    is_default: bool = Field(
+        ..., description="Whether the preset is used when none is requested"
+    )
+    count: int = Field(..., description="Number of recent images measured")
+    avg_seconds: float | None = Field(
+        None, description="Average generation time per image"
+    )
+    p95_seconds: float | None = Field(
+        None, description="95th percentile generation time per image"
+    )
+    avg_seconds_per_step: float | None = Field(
+        None, description="Average generation time per image and denoising step"
+    )
+
+
+class CacheStats(BaseModel):
+    name: str = Field(..., description="Name of the cache")
+    size: int = Field(..., description="Number of entries in the cache")
+    max_size: int = Field(..., description="Maximum number of entries")
+    hits: int = Field(..., description="Number of cache hits")
+    misses: int = Field(..., description="Number of cache misses")
+    evictions: int = Field(..., description="Number of evicted entries")
+    size_bytes: int | None = Field(
+        None, description="Estimated memory used by the entries in bytes"
+    )
+    max_bytes: int | None = Field(None, description="Memory budget in bytes")
+
+
+class ModelStatus(BaseModel):
+    name: str = Field(..., description="Name of the model")
+    required: bool = Field(
+        ..., description="Whether the model is needed for the current mode"
+    )
+    loaded: bool = Field(..., description="Whether the model has been loaded")
+    load_seconds: float | None = Field(
+        None, description="Time taken to load the model in seconds"
+    )
+    error: str | None = Field(None, description="Error from the last load attempt")
+
+
+class Readiness(BaseModel):
+    ready: bool = Field(..., description="Whether all required models are loaded")
+    search_only: bool = Field(..., description="Whether image generation is disabled")
+    models: list[ModelStatus] = Field(..., description="Status of each model")
+
+
+class IngestReport(BaseModel):
+    ingested: int = Field(..., description="Number of newly ingested images")
+    skipped: int = Field(..., description="Number of images already indexed")
+    failed: int = Field(..., description="Number of images that could not be read")
+    elapsed_seconds: float = Field(..., description="Elapsed time in seconds")
+    images_per_second: float = Field(..., description="Ingestion throughput")
+
+
+class MapInfo(BaseModel):
+    method: str = Field(..., description="Projection method (pca or umap)")
+    fitted: bool = Field(..., description="Whether the projection has been fitted")
+    count: int = Field(..., description="Number of points on the map")
+    version: int = Field(..., description="Version incremented on every change")
+
+
+class MapCluster(BaseModel):
+    x: float = Field(..., description="Centroid x of the cluster")
+    y: float = Field(..., description="Centroid y of the cluster")
+    count: int = Field(..., description="Number of images in the cluster")
+    image_filename: str = Field(
+        ..., description="Representative image (closest to the centroid)"
+    )
+
+
+class MapTile(BaseModel):
+    z: int = Field(..., description="Zoom level")
+    x: int = Field(..., description="Tile column")
+    y: int = Field(..., description="Tile row")
+    bounds: list[float] = Field(
+        ..., description="Tile extent in map coordinates [min_x, min_y, max_x, max_y]"
+    )
+    count: int = Field(..., description="Number of images in the tile")
+    clusters: list[MapCluster] = Field(..., description="Clusters in the tile")
@@ -1,3 +1,18 @@
-from .initialize import image_service
+__all__ = [
+    "image_service",
+    "inference_executor",
+    "job_service",
+    "map_service",
+    "model_warmup",
+    "persistence_writer",
+]
 
-__all__ = ["image_service"]
+
+def __getattr__(name: str):
+    # サブモジュール (ingest等) だけを使う場合にモデルをロードしないよう、
+    # サービスのインスタンスは最初に参照されたときに初期化する
+    if name in __all__:
+        from . import initialize
+
+        return getattr(initialize, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Literal, TypeVar
+
+from fastapi import HTTPException
+
+from api.config import Settings
+
+T = TypeVar("T")
+
+Lane = Literal["diffusion", "clip"]
+
+
+class InferenceExecutor:
+    """モデル推論をイベントループ外で実行するためのレーン別スレッドプール"""
+
+    def __init__(self, settings: Settings):
+        self.executors: dict[Lane, ThreadPoolExecutor] = {
+            "diffusion": ThreadPoolExecutor(
+                max_workers=settings.DIFFUSION_WORKERS,
+                thread_name_prefix="diffusion",
+            ),
+            "clip": ThreadPoolExecutor(
+                max_workers=settings.CLIP_WORKERS,
+                thread_name_prefix="clip",
+            ),
+        }
+        # 実行中 + 待機中のタスク数の上限 (超えた場合は503を返す)
+        self._slots: dict[Lane, threading.BoundedSemaphore] = {
+            "diffusion": threading.BoundedSemaphore(
+                settings.DIFFUSION_WORKERS + settings.DIFFUSION_MAX_QUEUE
+            ),
+            "clip": threading.BoundedSemaphore(
+                settings.CLIP_WORKERS + settings.CLIP_MAX_QUEUE
+            ),
+        }
+
+    def submit(
+        self,
+        lane: Lane,
+        fn: Callable[..., T],
+        *args: Any,
+        block: bool = False,
+        **kwargs: Any,
+    ) -> Future[T]:
+        """指定レーンにタスクを投入 (blockがFalseでキューが満杯なら503)"""
+        slots = self._slots[lane]
+        if not slots.acquire(blocking=block):
+            raise HTTPException(
+                status_code=503,
+                detail=f"The {lane} inference queue is full. Please retry later.",
+            )
+        try:
+            future = self.executors[lane].submit(fn, *args, **kwargs)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    async def run(self, lane: Lane, fn: Callable[..., T], *args: Any, **kwargs) -> T:
+        """指定レーンでタスクを実行し、イベントループをブロックせずに結果を待つ"""
+        return await asyncio.wrap_future(self.submit(lane, fn, *args, **kwargs))
+
+    def shutdown(self):
+        """全レーンのスレッドプールを停止"""
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -1,39 +1,96 @@
+import asyncio
+import base64
+import dataclasses
+import functools
+import hashlib
+import json
+import threading
+import time
 import uuid
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import CancelledError, Future
+from datetime import datetime
 from io import BytesIO
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
-from diffusers.utils.loading_utils import load_image
+import numpy as np
 from fastapi import HTTPException, UploadFile
 from PIL import Image
 
 from api.clients import (
+    CLIPBatcher,
     CLIPClient,
-    DiffusionClient,
-    ImageMetadata,
+    LazyClient,
     LocalStorageClient,
-    QdrantClientManager,
+    LRUCache,
+    SamplingPreset,
     SQLiteClient,
+    VectorStore,
+    get_sampling_preset,
 )
 from api.config import Settings
-from api.schema import DeleteResponse, SimpleMetadata
+from api.schema import (
+    CacheStats,
+    ControlImageParams,
+    DeleteResponse,
+    HybridSearchParams,
+    PersistenceStats,
+    PresetStats,
+    ScoredMetadata,
+    SearchFilters,
+    SimpleMetadata,
+)
+from api.service.executor import InferenceExecutor
+from api.service.map import MapService
+from api.service.persistence import GeneratedImageRecord, PersistenceWriter
+
+if TYPE_CHECKING:
+    from api.clients import DiffusionClient
+
+
+class GenerationCancelledError(Exception):
+    """呼び出し元 (step_callback) の都合で生成が中断されたことを表す"""
 
 
 class ImageService:
     def __init__(
         self,
-        diffusion_client: DiffusionClient,
+        diffusion_client: "DiffusionClient",
         clip_client: CLIPClient,
-        qdrant_client: QdrantClientManager,
+        qdrant_client: VectorStore,
         sqlite_client: SQLiteClient,
         local_storage_client: LocalStorageClient,
+        map_service: MapService,
+        persistence_writer: PersistenceWriter,
+        inference_executor: InferenceExecutor,
         settings: Settings,
     ):
         self.diffusion_client: DiffusionClient = diffusion_client
         self.clip_client: CLIPClient = clip_client
-        self.qdrant_client: QdrantClientManager = qdrant_client
+        self.inference_executor: InferenceExecutor = inference_executor
+        # バッチ推論もCLIPのレーンに投入し、キューが満杯なら503を返す
+        self.clip_batcher: CLIPBatcher = CLIPBatcher(
+            clip_client,
+            settings,
+            submit=functools.partial(inference_executor.submit, "clip"),
+        )
+        self.qdrant_client: VectorStore = qdrant_client
         self.sqlite_client: SQLiteClient = sqlite_client
         self.local_storage_client: LocalStorageClient = local_storage_client
+        self.map_service: MapService = map_service
+        self.persistence_writer: PersistenceWriter = persistence_writer
         self.settings = settings
+        # (コレクションの版, 検索条件) -> 検索結果
+        self.search_result_cache: LRUCache[tuple, list[ScoredMetadata]] = LRUCache(
+            "search_result",
+            settings.SEARCH_RESULT_CACHE_SIZE,
+            ttl_seconds=settings.SEARCH_RESULT_CACHE_TTL_SECONDS,
+        )
+        self._search_result_version = qdrant_client.version
+        # フィンガープリント -> 生成中 (または保存待ち) の結果
+        self._in_flight_lock = threading.Lock()
+        self._in_flight: dict[str, Future[SimpleMetadata]] = {}
 
     def generate_and_save_image(
         self,
@@ -49,35 +106,407 @@ class ImageService:
         num_inference_steps: int,
         guidance_scale: float,
         seed: int,
+        control_images: list[ControlImageParams] | None = None,
+        preset: str | None = None,
+        durable: bool | None = None,
+        reuse_existing: bool | None = None,
+        step_callback: Callable[[int, int], None] | None = None,
     ) -> SimpleMetadata:
         """プロンプトから画像を生成し、embedding登録・ローカル保存・メタデータ保存を行う"""
+        return self.generate_and_save_images(
+            prompts=[prompt],
+            seeds=[seed],
+            width=width,
+            height=height,
+            control_image_filename_1=control_image_filename_1,
+            control_image_filename_2=control_image_filename_2,
+            controlnet_conditioning_scale_1=controlnet_conditioning_scale_1,
+            controlnet_conditioning_scale_2=controlnet_conditioning_scale_2,
+            control_guidance_end_1=control_guidance_end_1,
+            control_guidance_end_2=control_guidance_end_2,
+            control_images=control_images,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            preset=preset,
+            durable=durable,
+            reuse_existing=reuse_existing,
+            step_callback=step_callback,
+        )[0]
 
-        # 1. 引数から条件を構成する
-        control_images: list[Image.Image] = []
-        if (
-            control_image_filename_1
-            and Path(self.settings.CONDITION_IMAGE_DIR).exists()
+    def generate_and_save_images(
+        self,
+        prompts: list[str],
+        seeds: list[int],
+        width: int,
+        height: int,
+        control_image_filename_1: str | None,
+        control_image_filename_2: str | None,
+        controlnet_conditioning_scale_1: float | None,
+        controlnet_conditioning_scale_2: float | None,
+        control_guidance_end_1: float | None,
+        control_guidance_end_2: float | None,
+        num_inference_steps: int,
+        guidance_scale: float,
+        control_images: list[ControlImageParams] | None = None,
+        preset: str | None = None,
+        durable: bool | None = None,
+        reuse_existing: bool | None = None,
+        step_callback: Callable[[int, int], None] | None = None,
+    ) -> list[SimpleMetadata]:
+        """複数のプロンプト・シードで画像を1回のパイプライン呼び出しでまとめて生成し、保存する
+
+        prompts と seeds の一方が1件の場合はもう一方の件数に合わせて繰り返す
+        durableがFalseの場合は保存の完了を待たずに返す (Noneの場合は設定に従う)
+        reuse_existingがTrueの場合、同じ条件で生成済み・生成中の画像があればそれを返す
+        (Noneの場合は設定に従う)
+        生成中の画像を待つ間は呼び出し元 (拡散モデルのレーン) のワーカーを占有するため、
+        GENERATION_REUSE_WAIT_TIMEOUT_SECONDSを超えたら503を返して解放する
+        """
+
+        self.ensure_generation_enabled()
+
+        # 1. 引数から条件を構成する (ステップ数・ガイダンスはプリセットの値を優先)
+        prompts, seeds = self._broadcast_prompts_and_seeds(prompts, seeds)
+        sampling_preset = self.resolve_preset(preset)
+        num_inference_steps, guidance_scale = sampling_preset.resolve(
+            num_inference_steps, guidance_scale
+        )
+        all_control_images = self._collect_control_images(
+            control_image_filename_1=control_image_filename_1,
+            control_image_filename_2=control_image_filename_2,
+            controlnet_conditioning_scale_1=controlnet_conditioning_scale_1,
+            controlnet_conditioning_scale_2=controlnet_conditioning_scale_2,
+            control_guidance_end_1=control_guidance_end_1,
+            control_guidance_end_2=control_guidance_end_2,
+            control_images=control_images or [],
+        )
+        fingerprints = [
+            self._generation_fingerprint(
+                prompt=prompt,
+                seed=seed,
+                width=width,
+                height=height,
+                control_images=all_control_images,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                sampling_preset=sampling_preset,
+            )
+            for prompt, seed in zip(prompts, seeds, strict=True)
+        ]
+        # 番号付きの条件画像はそのままカラムに、追加の条件画像はJSONで保存する
+        control_metadata = {
+            "control_image_filename_1": control_image_filename_1,
+            "control_image_filename_2": control_image_filename_2,
+            "controlnet_conditioning_scale_1": controlnet_conditioning_scale_1,
+            "controlnet_conditioning_scale_2": controlnet_conditioning_scale_2,
+            "control_guidance_end_1": control_guidance_end_1,
+            "control_guidance_end_2": control_guidance_end_2,
+            "control_images": [params.model_dump() for params in control_images or []],
+        }
+        durable = (
+            self.persistence_writer.durable_default if durable is None else durable
+        )
+        if not (
+            self.settings.GENERATION_REUSE_DEFAULT
+            if reuse_existing is None
+            else reuse_existing
         ):
-            control_images.append(
-                load_image(
-                    str(
-                        Path(self.settings.CONDITION_IMAGE_DIR)
-                        / control_image_filename_1
+            return self._generate_and_persist(
+                prompts=prompts,
+                seeds=seeds,
+                fingerprints=fingerprints,
+                width=width,
+                height=height,
+                control_images=all_control_images,
+                control_metadata=control_metadata,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                sampling_preset=sampling_preset,
+                durable=durable,
+                step_callback=step_callback,
+            )
+
+        # 相乗りした生成が中断された条件は、もう一度探して自分で生成する
+        resolved: dict[str, SimpleMetadata] = {}
+        remaining = list(dict.fromkeys(fingerprints))
+        timeout = self.settings.GENERATION_REUSE_WAIT_TIMEOUT_SECONDS
+        while remaining:
+            # 2. 生成済みの画像を探し、なければ生成中の同じリクエストに相乗りする
+            existing = self.sqlite_client.retrieve_simple_metadata_by_fingerprints(
+                remaining
+            )
+            for fingerprint, (image_filename, prompt) in existing.items():
+                resolved[fingerprint] = SimpleMetadata(
+                    image_filename=image_filename, prompt=prompt
+                )
+            owned: dict[str, Future[SimpleMetadata]] = {}
+            waiting: dict[str, Future[SimpleMetadata]] = {}
+            with self._in_flight_lock:
+                for fingerprint in remaining:
+                    if fingerprint in existing:
+                        continue
+                    if fingerprint in self._in_flight:
+                        waiting[fingerprint] = self._in_flight[fingerprint]
+                    else:
+                        owned[fingerprint] = Future()
+                        self._in_flight[fingerprint] = owned[fingerprint]
+
+            # 3. 自分が担当する条件だけを生成する (他のリクエストを待つ前に済ませ、待ち合いを防ぐ)
+            if owned:
+                targets = [fingerprints.index(fingerprint) for fingerprint in owned]
+                try:
+                    generated = self._generate_and_persist(
+                        prompts=[prompts[index] for index in targets],
+                        seeds=[seeds[index] for index in targets],
+                        fingerprints=list(owned),
+                        width=width,
+                        height=height,
+                        control_images=all_control_images,
+                        control_metadata=control_metadata,
+                        num_inference_steps=num_inference_steps,
+                        guidance_scale=guidance_scale,
+                        sampling_preset=sampling_preset,
+                        durable=durable,
+                        step_callback=step_callback,
+                        on_persisted=self._release_in_flight,
                     )
+                except GenerationCancelledError:
+                    # 中断はこのリクエストだけの都合なので、相乗りしたリクエストには失敗を伝えない
+                    self._release_in_flight(list(owned))
+                    for future in owned.values():
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    self._release_in_flight(list(owned))
+                    for future in owned.values():
+                        future.set_exception(e)
+                    raise
+                for fingerprint, result in zip(owned, generated, strict=True):
+                    owned[fingerprint].set_result(result)
+                    resolved[fingerprint] = result
+
+            # 4. 相乗りした生成の結果を待つ
+            remaining = []
+            try:
+                joined: list[str] = []
+                for fingerprint, future in waiting.items():
+                    try:
+                        resolved[fingerprint] = future.result(timeout=timeout)
+                    except CancelledError:
+                        remaining.append(fingerprint)
+                    else:
+                        joined.append(resolved[fingerprint].image_filename)
+                if durable and joined:
+                    # 相乗りした画像もdurableなら保存の完了を待つ
+                    self.persistence_writer.wait_for(joined, timeout=timeout)
+            except TimeoutError as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail="An identical generation is still running. Please retry later.",
+                ) from e
+
+        # 5. 生成済み・生成結果をリクエストの順に並べる
+        return [resolved[fingerprint] for fingerprint in fingerprints]
+
+    def _generate_and_persist(
+        self,
+        prompts: list[str],
+        seeds: list[int],
+        fingerprints: list[str],
+        width: int,
+        height: int,
+        control_images: list[ControlImageParams],
+        control_metadata: dict[str, Any],
+        num_inference_steps: int,
+        guidance_scale: float,
+        sampling_preset: SamplingPreset,
+        durable: bool,
+        step_callback: Callable[[int, int], None] | None = None,
+        on_persisted: Callable[[list[str]], None] | None = None,
+    ) -> list[SimpleMetadata]:
+        """画像を生成して保存を投入する (on_persistedは保存が終わったときにフィンガープリントを渡して呼ぶ)"""
+        # 1. 画像生成 (プリセットごとのレイテンシを集計できるよう1枚あたりの時間を記録)
+        started_at = time.perf_counter()
+        images: list[Image.Image] = self.diffusion_client.generate_images(
+            prompts=prompts,
+            control_images=[
+                self.local_storage_client.load_control_image(
+                    params.filename, width, height
                 )
+                for params in control_images
+            ],
+            width=width,
+            height=height,
+            controlnet_conditioning_scale=[
+                params.conditioning_scale for params in control_images
+            ],
+            control_guidance_end=[params.guidance_end for params in control_images],
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            seeds=seeds,
+            step_callback=step_callback,
+            preset=sampling_preset.name,
+        )
+        generation_seconds = (time.perf_counter() - started_at) / len(images)
+
+        # 2. 画像のembeddingとテキストのembeddingをまとめて生成
+        image_embeddings = self.clip_client.generate_image_embeddings(images)
+        unique_prompts = list(dict.fromkeys(prompts))
+        text_embeddings = dict(
+            zip(
+                unique_prompts,
+                self.clip_client.generate_text_embeddings(unique_prompts),
+                strict=True,
             )
-        if (
-            control_image_filename_2
-            and Path(self.settings.CONDITION_IMAGE_DIR).exists()
-        ):
-            control_images.append(
-                load_image(
-                    str(
-                        Path(self.settings.CONDITION_IMAGE_DIR)
-                        / control_image_filename_2
+        )
+
+        # 3. 保存用のデータを作り、エンコード・書き込みはバックグラウンドに任せる
+        records = [
+            GeneratedImageRecord(
+                image=image,
+                image_filename=(
+                    f"{uuid.uuid4().hex}.{self.local_storage_client.image_format}"
+                ),
+                image_embedding=image_embedding,
+                text_embedding=text_embeddings[prompt],
+                prompt=prompt,
+                metadata={
+                    "width": width,
+                    "height": height,
+                    **control_metadata,
+                    "num_inference_steps": num_inference_steps,
+                    "guidance_scale": guidance_scale,
+                    "seed": seed,
+                    "preset": sampling_preset.name,
+                    "generation_seconds": generation_seconds,
+                    "fingerprint": fingerprint,
+                },
+                extra_payload={
+                    "seed": seed,
+                    "control_image_filenames": [
+                        params.filename for params in control_images
+                    ],
+                },
+            )
+            for image, image_embedding, prompt, seed, fingerprint in zip(
+                images, image_embeddings, prompts, seeds, fingerprints, strict=True
+            )
+        ]
+        future = self.persistence_writer.submit(records)
+        if on_persisted is not None:
+            future.add_done_callback(lambda _: on_persisted(fingerprints))
+
+        # 4. durableの場合は保存が完了するまで待つ
+        if durable:
+            future.result()
+
+        # 5. レスポンス用の簡易メタデータ
+        return [
+            SimpleMetadata(image_filename=record.image_filename, prompt=record.prompt)
+            for record in records
+        ]
+
+    def _generation_fingerprint(
+        self,
+        prompt: str,
+        seed: int,
+        width: int,
+        height: int,
+        control_images: list[ControlImageParams],
+        num_inference_steps: int,
+        guidance_scale: float,
+        sampling_preset: SamplingPreset,
+    ) -> str:
+        """生成結果を決める条件 (パラメータ・モデル・条件画像の更新時刻) のハッシュ"""
+        payload = {
+            "prompt": prompt,
+            "seed": seed,
+            "width": width,
+            "height": height,
+            "control_images": [
+                params.model_dump()
+                | {
+                    "version": self.local_storage_client.control_image_version(
+                        params.filename
                     )
-                )
+                }
+                for params in control_images
+            ],
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+            "preset": dataclasses.asdict(sampling_preset),
+            "models": {
+                "base": self.settings.SD_BASE_MODEL,
+                "controlnet": self.settings.CONTROLNET_MODEL,
+                "dtype": self.settings.DIFFUSION_DTYPE,
+                "quantization": self.settings.DIFFUSION_QUANTIZATION,
+            },
+        }
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def _release_in_flight(self, fingerprints: list[str]):
+        """保存が終わった (または失敗した) 条件を生成中の一覧から外す"""
+        with self._in_flight_lock:
+            for fingerprint in fingerprints:
+                self._in_flight.pop(fingerprint, None)
+
+    def resolve_preset(self, preset: str | None) -> SamplingPreset:
+        """リクエストのプリセット名を解決 (未指定なら既定のプリセット)"""
+        return get_sampling_preset(
+            preset or self.settings.DIFFUSION_DEFAULT_PRESET,
+            self.settings.DIFFUSION_PRESETS,
+        )
+
+    def ensure_generation_enabled(self):
+        """検索専用モードでは画像生成を受け付けない"""
+        if self.settings.SEARCH_ONLY:
+            raise HTTPException(
+                status_code=503,
+                detail="Image generation is disabled in search-only mode.",
+            )
+
+    def _broadcast_prompts_and_seeds(
+        self, prompts: list[str], seeds: list[int]
+    ) -> tuple[list[str], list[int]]:
+        """プロンプトとシードの件数を揃える"""
+        if not prompts or not seeds:
+            raise ValueError("At least one prompt and one seed are required.")
+        if len(prompts) == 1:
+            prompts = prompts * len(seeds)
+        elif len(seeds) == 1:
+            seeds = seeds * len(prompts)
+        elif len(prompts) != len(seeds):
+            raise ValueError(
+                "Prompts and seeds must match in length unless one of them has a single item."
+            )
+
+        if len(prompts) > self.settings.MAX_GENERATION_BATCH_SIZE:
+            raise ValueError(
+                f"Batch size must be at most {self.settings.MAX_GENERATION_BATCH_SIZE}."
+            )
+        return prompts, seeds
+
+    def _collect_control_images(
+        self,
+        control_image_filename_1: str | None,
+        control_image_filename_2: str | None,
+        controlnet_conditioning_scale_1: float | None,
+        controlnet_conditioning_scale_2: float | None,
+        control_guidance_end_1: float | None,
+        control_guidance_end_2: float | None,
+        control_images: list[ControlImageParams],
+    ) -> list[ControlImageParams]:
+        """番号付きの条件画像と追加の条件画像を1つのリストにまとめ、検証する"""
+        control_image_filenames: list[str] = [
+            control_image_filename
+            for control_image_filename in (
+                control_image_filename_1,
+                control_image_filename_2,
             )
+            if control_image_filename
+        ]
 
         controlnet_conditioning_scale: list[float] = []
         if controlnet_conditioning_scale_1:
@@ -92,93 +521,126 @@ class ImageService:
             control_guidance_end.append(control_guidance_end_2)
 
         ## サイズが同じか検証する
-        if len(control_images) != len(controlnet_conditioning_scale):
+        if len(control_image_filenames) != len(controlnet_conditioning_scale):
             raise ValueError(
                 "Control images and conditioning scales must match in length."
             )
-        if len(control_images) != len(control_guidance_end):
+        if len(control_image_filenames) != len(control_guidance_end):
             raise ValueError("Control images and guidance ends must match in length.")
 
-        ## サイズが2以下であることを検証する
-        if len(control_images) > 2:
-            raise ValueError("Control images must be 0, 1, or 2 in length.")
+        ## 追加の条件画像は番号付きの条件画像の後ろに並べる
+        all_control_images = [
+            ControlImageParams(
+                filename=filename,
+                conditioning_scale=conditioning_scale,
+                guidance_end=guidance_end,
+            )
+            for filename, conditioning_scale, guidance_end in zip(
+                control_image_filenames,
+                controlnet_conditioning_scale,
+                control_guidance_end,
+                strict=True,
+            )
+        ] + list(control_images)
 
-        ## サイズが0の場合、ダミー画像を与える
-        if not control_images:
-            control_images = [Image.new("RGB", (width, height), (255, 255, 255))]
-            controlnet_conditioning_scale = [0.0]
-            control_guidance_end = [0.1]
+        ## 上限を超えていないか検証する
+        max_control_images = self.settings.MAX_CONTROL_IMAGES
+        if len(all_control_images) > max_control_images:
+            raise ValueError(f"Control images must be at most {max_control_images}.")
+        return all_control_images
 
-        # 2. 画像生成
-        image: Image.Image = self.diffusion_client.generate_image(
-            prompt=prompt,
-            control_images=control_images,
-            width=width,
-            height=height,
-            controlnet_conditioning_scale=controlnet_conditioning_scale,
-            control_guidance_end=control_guidance_end,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
+    def fetch_all_simple_metadata_list(self) -> list[SimpleMetadata]:
+        """保存されている全ての画像についてシンプルなメタデータを新しい順に取得"""
+        simple_metadata_list, _ = self.fetch_simple_metadata_page()
+        return simple_metadata_list
+
+    def fetch_simple_metadata_page(
+        self, limit: int | None = None, cursor: str | None = None
+    ) -> tuple[list[SimpleMetadata], str | None]:
+        """シンプルなメタデータを新しい順に1ページ分取得し、次のページのカーソルも返す"""
+        rows = self.sqlite_client.retrieve_simple_metadata_page(
+            limit=limit,
+            cursor=self._decode_cursor(cursor) if cursor else None,
         )
+        simple_metadata_list = [
+            SimpleMetadata(image_filename=image_filename, prompt=prompt or "")
+            for image_filename, prompt, _ in rows
+        ]
 
-        # 3. 画像のembeddingとテキストのembeddingを生成
-        image_embedding = self.clip_client.generate_image_embedding(image)
-        text_embedding = self.clip_client.generate_text_embedding(prompt)
+        # 1ページ分取得できた場合のみ次のカーソルを返す
+        next_cursor = None
+        if limit is not None and len(rows) == limit:
+            image_filename, _, created_at = rows[-1]
+            next_cursor = self._encode_cursor(created_at, image_filename)
+        return simple_metadata_list, next_cursor
 
-        # 4. 保存用ファイル名を決定
-        image_filename = f"{uuid.uuid4().hex}.png"
+    @staticmethod
+    def _encode_cursor(created_at: datetime, image_filename: str) -> str:
+        """ページングのカーソル (作成日時とファイル名) を文字列にする"""
+        payload = json.dumps([created_at.isoformat(), image_filename])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
 
-        # 5. ローカルに画像保存 (ここでは省略。実際はちゃんと保存関数呼ぶ想定)
-        self.local_storage_client.save_image(image, image_filename)
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+        """文字列のカーソルを (作成日時, ファイル名) に戻す"""
+        try:
+            created_at, image_filename = json.loads(base64.urlsafe_b64decode(cursor))
+            return datetime.fromisoformat(created_at), str(image_filename)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid cursor: {cursor}") from e
 
-        # 6. Qdrantにアップロード
-        self.qdrant_client.upload_point(
-            image_embedding=image_embedding,
-            text_embedding=text_embedding,
-            image_filename=image_filename,
-            prompt=prompt,
-        )
+    def fetch_persistence_stats(self) -> PersistenceStats:
+        """バックグラウンドでの保存の状況 (失敗した書き込みを含む) を取得"""
+        return self.persistence_writer.stats()
 
-        # 7. SQLiteにメタデータ保存
-        self.sqlite_client.upload_metadata(
-            image_filename=image_filename,
-            prompt=prompt,
-            width=width,
-            height=height,
-            control_image_filename_1=control_image_filename_1,
-            control_image_filename_2=control_image_filename_2,
-            controlnet_conditioning_scale_1=controlnet_conditioning_scale_1,
-            controlnet_conditioning_scale_2=controlnet_conditioning_scale_2,
-            control_guidance_end_1=control_guidance_end_1,
-            control_guidance_end_2=control_guidance_end_2,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-        )
-
-        # 8. レスポンス用の簡易メタデータを返す
-        return SimpleMetadata(
-            image_filename=image_filename,
-            prompt=prompt,
-        )
+    def fetch_cache_stats(self) -> list[CacheStats]:
+        """各キャッシュのヒット・ミス数などを取得"""
+        stats = [
+            self.local_storage_client.control_image_cache.stats(),
+            self.clip_batcher.text_embedding_cache.stats(),
+            self.search_result_cache.stats(),
+        ]
+        # 統計のためだけに画像生成のモデルをロードしない
+        if not isinstance(self.diffusion_client, LazyClient) or (
+            self.diffusion_client.loaded
+        ):
+            stats.insert(0, self.diffusion_client.prompt_embedding_cache.stats())
+        return stats
 
-    def fetch_all_simple_metadata_list(self) -> list[SimpleMetadata]:
-        """保存されている全ての画像についてシンプルなメタデータを取得"""
-        retrieved_metadata_list: list[ImageMetadata] = (
-            self.sqlite_client.retrieve_metadata_list()
+    def fetch_preset_stats(self) -> list[PresetStats]:
+        """有効なプリセットごとに直近の画像の生成時間を集計"""
+        latencies = self.sqlite_client.retrieve_generation_latencies(
+            self.settings.PRESET_STATS_WINDOW
         )
-        simple_metadata_list = []
-        for metadata in retrieved_metadata_list:
-            simple_metadata = SimpleMetadata(
-                image_filename=str(metadata.image_filename),
-                prompt=str(metadata.prompt),
+        stats = []
+        for name in self.settings.DIFFUSION_PRESETS:
+            preset = get_sampling_preset(name, self.settings.DIFFUSION_PRESETS)
+            rows = latencies.get(name, [])
+            seconds = [generation_seconds for generation_seconds, _ in rows]
+            seconds_per_step = [
+                generation_seconds / steps
+                for generation_seconds, steps in rows
+                if steps
+            ]
+            stats.append(
+                PresetStats(
+                    name=name,
+                    description=preset.description,
+                    num_inference_steps=preset.num_inference_steps,
+                    is_default=name == self.settings.DIFFUSION_DEFAULT_PRESET,
+                    count=len(rows),
+                    avg_seconds=float(np.mean(seconds)) if seconds else None,
+                    p95_seconds=float(np.percentile(seconds, 95)) if seconds else None,
+                    avg_seconds_per_step=float(np.mean(seconds_per_step))
+                    if seconds_per_step
+                    else None,
+                )
             )
-            simple_metadata_list.append(simple_metadata)
+        return stats
 
-        # 新しい順にして返す
-        simple_metadata_list.reverse()
-        return simple_metadata_list
+    def save_caches(self):
+        """再起動後も使うキャッシュ (テキスト埋め込み) をファイルに保存"""
+        self.clip_batcher.save_text_embedding_cache()
 
     def fetch_all_control_image_filenames(self) -> list[str]:
         """control_imagesディレクトリにあるすべての画像ファイルについて名前を取得"""
@@ -191,49 +653,203 @@ class ImageService:
             if p.is_file() and p.suffix.lower() in [".jpg", ".jpeg", ".png"]
         ]
 
+    def fetch_thumbnail_path(self, image_filename: str, size: int) -> Path:
+        """サムネイルのパスを取得 (未作成なら元画像から作成)"""
+        # ディレクトリをまたぐファイル名は受け付けない
+        if Path(image_filename).name != image_filename:
+            raise ValueError(f"Invalid image filename: {image_filename}")
+        if self.persistence_writer.wait_for_each([image_filename]):
+            raise HTTPException(
+                status_code=409, detail=f"Image {image_filename} could not be saved."
+            )
+        if not (Path(self.local_storage_client.image_dir) / image_filename).exists():
+            raise HTTPException(
+                status_code=404, detail=f"Image {image_filename} not found."
+            )
+        return self.local_storage_client.load_thumbnail_path(image_filename, size)
+
     async def search_similar_images(
         self,
         image: UploadFile | None = None,
         text: str | None = None,
         topk: int = 3,
-    ) -> list[SimpleMetadata]:
-        """テキストまたは画像に基づいて類似画像を検索する"""
+        filters: SearchFilters | None = None,
+    ) -> list[ScoredMetadata]:
+        """テキストまたは画像に基づいて類似画像を類似度付きで検索する (filtersで絞り込み可能)"""
 
         if not text and not image:
             raise ValueError("textまたはimageのどちらか一方は必須です。")
 
-        # 埋め込み生成
+        # 同じ条件の検索結果がキャッシュにあればモデル・検索を使わずに返す
+        image_data = await image.read() if image and not text else None
+        cache_key = self._search_result_key("similar", text, image_data, topk, filters)
+        cached = self.search_result_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        # 埋め込み生成 (同時リクエストはまとめて1回のforwardで処理される)
         query_embedding = None
         if text:
-            query_embedding = self.clip_client.generate_text_embedding(text)
-        elif image:
-            image_data = await image.read()
+            query_embedding = await self.clip_batcher.embed_text(text)
+        elif image_data is not None:
             pil_image = Image.open(BytesIO(image_data)).convert("RGB")
-            query_embedding = self.clip_client.generate_image_embedding(pil_image)
+            query_embedding = await self.clip_batcher.embed_image(pil_image)
         else:
             raise ValueError("textまたはimageのどちらか一方が必要です。")
 
-        # Qdrantで検索
-        simple_metadata_list: list[SimpleMetadata] = self.qdrant_client.search_points(
-            query_embedding, topk=topk
+        # Qdrantで検索 (ローカルモードの検索もブロッキングなのでCLIPレーンで実行)
+        scored_metadata_list: list[ScoredMetadata] = await self.inference_executor.run(
+            "clip",
+            self.qdrant_client.search_points,
+            query_embedding,
+            topk=topk,
+            filters=filters,
         )
 
-        return simple_metadata_list
+        self.search_result_cache.put(cache_key, list(scored_metadata_list))
+        return scored_metadata_list
+
+    async def search_hybrid_images(
+        self,
+        image: UploadFile | None = None,
+        text: str | None = None,
+        topk: int = 3,
+        filters: SearchFilters | None = None,
+        params: HybridSearchParams | None = None,
+    ) -> list[ScoredMetadata]:
+        """テキストと画像を同時に指定し、1回の検索で順位を統合する (「この画像に似ていて、よりX」)"""
+        if not text and not image:
+            raise ValueError("textまたはimageのどちらか一方は必須です。")
+        params = params or HybridSearchParams()
+
+        image_data = await image.read() if image else None
+        cache_key = self._search_result_key(
+            "hybrid", text, image_data, topk, filters, params
+        )
+        cached = self.search_result_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        # テキスト・画像の埋め込みを並行して生成
+        text_task = self.clip_batcher.embed_text(text) if text else None
+        image_task = None
+        if image_data is not None:
+            pil_image = Image.open(BytesIO(image_data)).convert("RGB")
+            image_task = self.clip_batcher.embed_image(pil_image)
+        text_embedding, image_embedding = await asyncio.gather(
+            text_task or asyncio.sleep(0), image_task or asyncio.sleep(0)
+        )
+
+        # (ベクトル名, embedding, 重み) の組を作る (重みが0のものは使わない)
+        queries: list[tuple[str, np.ndarray, float]] = []
+        if image_embedding is not None and params.image_weight > 0:
+            queries.append(("image", image_embedding, params.image_weight))
+        if text_embedding is not None and params.text_weight > 0:
+            queries.append(("image", text_embedding, params.text_weight))
+        if text_embedding is not None and params.prompt_weight > 0:
+            queries.append(("text", text_embedding, params.prompt_weight))
+        if not queries:
+            raise ValueError("At least one query with a positive weight is required.")
+
+        scored_metadata_list: list[ScoredMetadata] = await self.inference_executor.run(
+            "clip",
+            self.qdrant_client.hybrid_search_points,
+            queries,
+            topk=topk,
+            filters=filters,
+            fusion=params.fusion,
+        )
+        self.search_result_cache.put(cache_key, list(scored_metadata_list))
+        return scored_metadata_list
+
+    def _search_result_key(
+        self,
+        kind: str,
+        text: str | None,
+        image_data: bytes | None,
+        topk: int,
+        filters: SearchFilters | None,
+        params: HybridSearchParams | None = None,
+    ) -> tuple:
+        """検索結果キャッシュのキー (コレクションが変わったら古い結果を捨てる)"""
+        version = self.qdrant_client.version
+        if version != self._search_result_version:
+            self.search_result_cache.clear()
+            self._search_result_version = version
+        return (
+            version,
+            kind,
+            text,
+            hashlib.sha256(image_data).hexdigest() if image_data is not None else None,
+            topk,
+            filters.model_dump_json() if filters else None,
+            params.model_dump_json() if params else None,
+        )
+
+    async def stream_similar_images(
+        self,
+        image: UploadFile | None = None,
+        text: str | None = None,
+        topk: int = 3,
+        filters: SearchFilters | None = None,
+    ) -> AsyncIterator[bytes]:
+        """類似画像の検索結果を1行1件のNDJSONとして少しずつ返す
+
+        検索 (と入力の検証) はイテレータを返す前に済ませ、結果の直列化だけを逐次行う
+        """
+        results = await self.search_similar_images(
+            image=image, text=text, topk=topk, filters=filters
+        )
+        chunk_size = self.settings.SEARCH_STREAM_CHUNK_SIZE
+
+        async def iterate() -> AsyncIterator[bytes]:
+            for start in range(0, len(results), chunk_size):
+                yield "".join(
+                    result.model_dump_json() + "\n"
+                    for result in results[start : start + chunk_size]
+                ).encode("utf-8")
+
+        return iterate()
+
+    def fetch_embeddings(
+        self, image_filenames: list[str], using: str = "image"
+    ) -> tuple[bytes, tuple[int, int]]:
+        """指定した画像のembeddingをfloat32 [N, dim] (リトルエンディアン) のバイナリと形状で取得"""
+        if using not in ("image", "text"):
+            raise ValueError(f"Unknown embedding type: {using}")
+        # 保存待ちの画像は書き込みが終わってから読む
+        self.persistence_writer.wait_for(image_filenames)
+        embeddings = self.qdrant_client.retrieve_embeddings(image_filenames, using)
+        data = embeddings.astype("<f4", copy=False).tobytes()
+        return data, (embeddings.shape[0], embeddings.shape[1])
 
     def delete_images(self, image_filenames: list[str]) -> DeleteResponse:
-        """指定された画像ファイルを削除"""
-        deleted_filenames = []
-        failed_filenames = []
+        """指定された画像ファイルを削除 (Qdrant・SQLiteはそれぞれ1回でまとめて削除)"""
+        # 保存待ちの画像は書き込みが終わってから削除する (書き込みに失敗した画像は削除できない)
+        unsaved = self.persistence_writer.wait_for_each(image_filenames)
+        try:
+            # 存在確認と削除を1トランザクションで行い、Qdrantの削除に失敗したら戻す
+            with self.sqlite_client.unit_of_work() as session:
+                existing = self.sqlite_client.retrieve_existing_filenames(
+                    [name for name in image_filenames if name not in unsaved],
+                    session=session,
+                )
+                deleted_filenames = [
+                    name for name in image_filenames if name in existing
+                ]
+                failed_filenames = [
+                    name for name in image_filenames if name not in existing
+                ]
+                self.sqlite_client.delete_metadata_list(
+                    deleted_filenames, session=session
+                )
+                self.qdrant_client.delete_points(deleted_filenames)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
-        for image_filename in image_filenames:
-            try:
-                self.qdrant_client.delete_point(image_filename)
-                self.sqlite_client.delete_metadata(image_filename)
-                self.local_storage_client.delete_image(image_filename)
-                deleted_filenames.append(image_filename)
-            except Exception as e:
-                failed_filenames.append(image_filename)
-                raise HTTPException(status_code=500, detail=str(e))
+        for image_filename in deleted_filenames:
+            self.local_storage_client.delete_image(image_filename)
+        self.map_service.remove_images(deleted_filenames)
 
         return DeleteResponse(
             status="success" if not failed_filenames else "partial",
@@ -0,0 +1,194 @@
+import shutil
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+from pathlib import Path
+
+from PIL import Image
+
+from api.clients import (
+    CLIPClient,
+    LocalStorageClient,
+    SQLiteClient,
+    VectorStore,
+)
+from api.config import Settings
+from api.schema import IngestReport
+from api.service.map import MapService
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class IngestService:
+    """アプリ外で作られた画像フォルダを一括で取り込む"""
+
+    def __init__(
+        self,
+        clip_client: CLIPClient,
+        qdrant_client: VectorStore,
+        sqlite_client: SQLiteClient,
+        local_storage_client: LocalStorageClient,
+        map_service: MapService,
+        settings: Settings,
+    ):
+        self.clip_client = clip_client
+        self.qdrant_client = qdrant_client
+        self.sqlite_client = sqlite_client
+        self.local_storage_client = local_storage_client
+        self.map_service = map_service
+        self.batch_size = settings.INGEST_BATCH_SIZE
+        self.decode_workers = settings.INGEST_DECODE_WORKERS
+
+    def ingest_directory(
+        self,
+        directory: str,
+        batch_size: int | None = None,
+        on_progress: Callable[[IngestReport], None] | None = None,
+    ) -> IngestReport:
+        """ディレクトリ以下の画像をCLIPでまとめて埋め込み、Qdrant・SQLiteに登録する
+
+        登録済みのファイルはスキップするので、中断しても再実行で続きから取り込める
+        """
+        source_dir = Path(directory).resolve()
+        if not source_dir.is_dir():
+            raise ValueError(f"{directory} is not a directory.")
+        batch_size = batch_size or self.batch_size
+
+        report = IngestReport(
+            ingested=0, skipped=0, failed=0, elapsed_seconds=0.0, images_per_second=0.0
+        )
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as decoder:
+            for batch in self._iter_batches(source_dir, batch_size):
+                ingested, skipped, failed = self._ingest_batch(batch, decoder)
+                report.ingested += ingested
+                report.skipped += skipped
+                report.failed += failed
+                report.elapsed_seconds = time.perf_counter() - started_at
+                report.images_per_second = (
+                    report.ingested / report.elapsed_seconds
+                    if report.elapsed_seconds
+                    else 0.0
+                )
+                if on_progress is not None:
+                    on_progress(report)
+
+        return report
+
+    def _iter_batches(
+        self, source_dir: Path, batch_size: int
+    ) -> Iterator[list[tuple[Path, str]]]:
+        """(画像パス, 登録するファイル名) をバッチごとに返す"""
+        image_dir = Path(self.local_storage_client.image_dir).resolve()
+        batch: list[tuple[Path, str]] = []
+        for path in sorted(source_dir.rglob("*")):
+            if not path.is_file() or path.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            # 画像ディレクトリ外のファイルは相対パスからファイル名を決める
+            if path.parent == image_dir:
+                image_filename = path.name
+            else:
+                image_filename = "__".join(path.relative_to(source_dir).parts)
+            batch.append((path, image_filename))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _ingest_batch(
+        self, batch: list[tuple[Path, str]], decoder: ThreadPoolExecutor
+    ) -> tuple[int, int, int]:
+        """1バッチ分の画像を取り込み、(取り込み数, スキップ数, 失敗数) を返す"""
+        existing = self.sqlite_client.retrieve_existing_filenames(
+            [image_filename for _, image_filename in batch]
+        )
+        targets = [
+            (path, image_filename)
+            for path, image_filename in batch
+            if image_filename not in existing
+        ]
+        skipped = len(batch) - len(targets)
+
+        # デコードは別スレッドで並列に行う
+        decoded = list(decoder.map(self._decode_image, [path for path, _ in targets]))
+        loaded = [
+            (path, image_filename, image)
+            for (path, image_filename), image in zip(targets, decoded, strict=True)
+            if image is not None
+        ]
+        failed = len(targets) - len(loaded)
+        if not loaded:
+            return 0, skipped, failed
+
+        image_embeddings = self.clip_client.generate_image_embeddings(
+            [image for _, _, image in loaded]
+        )
+
+        # 画像ディレクトリ外のファイルはフロントエンドから参照できるようコピーする
+        image_dir = Path(self.local_storage_client.image_dir)
+        for path, image_filename, image in loaded:
+            destination = image_dir / image_filename
+            if not destination.exists():
+                shutil.copy2(path, destination)
+            self.local_storage_client.save_thumbnails(image, image_filename)
+
+        prompts = [self._read_caption(path) for path, _, _ in loaded]
+        image_filenames = [image_filename for _, image_filename, _ in loaded]
+        # 日時での絞り込みが両方で一致するよう、作成日時は同じ値を使う
+        created_at = datetime.now(UTC)
+        try:
+            # Qdrantへの登録に失敗したらSQLiteも戻す
+            with self.sqlite_client.unit_of_work() as session:
+                self.sqlite_client.bulk_upload_metadata(
+                    [
+                        {
+                            "image_filename": image_filename,
+                            "prompt": prompt,
+                            "width": image.width,
+                            "height": image.height,
+                            "created_at": created_at,
+                        }
+                        for (_, image_filename, image), prompt in zip(
+                            loaded, prompts, strict=True
+                        )
+                    ],
+                    session=session,
+                )
+                self.qdrant_client.upload_points(
+                    image_embeddings=image_embeddings,
+                    text_embeddings=None,
+                    image_filenames=image_filenames,
+                    prompts=prompts,
+                    extra_payloads=[
+                        {
+                            "created_at": created_at.isoformat(),
+                            "control_image_filenames": [],
+                        }
+                        for _ in loaded
+                    ],
+                )
+        except Exception:
+            # 途中のバッチまでアップロードされたポイントや、コミットに失敗した分のポイントを残さない
+            self.qdrant_client.delete_points(image_filenames)
+            raise
+        self.map_service.add_images(image_filenames, image_embeddings)
+        return len(loaded), skipped, failed
+
+    @staticmethod
+    def _decode_image(path: Path) -> Image.Image | None:
+        """画像を読み込む (壊れている場合はNone)"""
+        try:
+            with Image.open(path) as image:
+                return image.convert("RGB")
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_caption(path: Path) -> str:
+        """同名の .txt ファイルがあればキャプションとして使う"""
+        caption_path = path.with_suffix(".txt")
+        if caption_path.exists():
+            return caption_path.read_text(encoding="utf-8").strip()
+        return ""
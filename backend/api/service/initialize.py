@@ -1,18 +1,59 @@
+from typing import TYPE_CHECKING, cast
+
 from api.clients import (
     CLIPClient,
-    DiffusionClient,
+    EmbeddingMapClient,
+    LazyClient,
     LocalStorageClient,
-    QdrantClientManager,
+    MapTileClient,
     SQLiteClient,
+    create_vector_store,
 )
 from api.config.settings import settings
+from api.service.executor import InferenceExecutor
 from api.service.image import ImageService
+from api.service.job import JobService
+from api.service.map import MapService
+from api.service.persistence import PersistenceWriter
+from api.service.warmup import ModelWarmup
+
+if TYPE_CHECKING:
+    from api.clients import DiffusionClient
+
+
+def _load_diffusion_client() -> "DiffusionClient":
+    if settings.SEARCH_ONLY:
+        raise RuntimeError("Image generation is disabled in search-only mode.")
+    from api.clients import DiffusionClient
+
+    return DiffusionClient(settings)
+
 
-diffusion_client = DiffusionClient(settings)
-clip_client = CLIPClient(settings)
-qdrant_client = QdrantClientManager(settings)
+# モデルは起動時にはロードせず、最初に使われたとき (またはウォームアップ時) にロードする
+lazy_diffusion_client = LazyClient("diffusion", _load_diffusion_client)
+lazy_clip_client = LazyClient("clip", lambda: CLIPClient(settings))
+diffusion_client = cast("DiffusionClient", lazy_diffusion_client)
+clip_client = cast(CLIPClient, lazy_clip_client)
+qdrant_client = create_vector_store(settings)
 sqlite_client = SQLiteClient(settings)
 local_storage_client = LocalStorageClient(settings)
+embedding_map_client = EmbeddingMapClient(settings)
+map_tile_client = MapTileClient(settings)
+inference_executor = InferenceExecutor(settings)
+
+map_service = MapService(
+    embedding_map_client=embedding_map_client,
+    map_tile_client=map_tile_client,
+    qdrant_client=qdrant_client,
+)
+
+persistence_writer = PersistenceWriter(
+    local_storage_client=local_storage_client,
+    qdrant_client=qdrant_client,
+    sqlite_client=sqlite_client,
+    map_service=map_service,
+    settings=settings,
+)
 
 image_service = ImageService(
     diffusion_client=diffusion_client,
@@ -20,5 +61,20 @@ image_service = ImageService(
     qdrant_client=qdrant_client,
     sqlite_client=sqlite_client,
     local_storage_client=local_storage_client,
+    map_service=map_service,
+    persistence_writer=persistence_writer,
+    inference_executor=inference_executor,
+    settings=settings,
+)
+
+job_service = JobService(
+    image_service=image_service,
+    sqlite_client=sqlite_client,
+    inference_executor=inference_executor,
+    settings=settings,
+)
+
+model_warmup = ModelWarmup(
+    clients=[lazy_clip_client, lazy_diffusion_client],
     settings=settings,
 )
@@ -0,0 +1,195 @@
+import logging
+import threading
+import uuid
+
+import numpy as np
+from fastapi import HTTPException
+
+from api.clients import GenerationJob, SQLiteClient
+from api.config import Settings
+from api.schema import ImageGenerationParams, JobProgress, JobQueueStats, JobStatus
+from api.service.executor import InferenceExecutor
+from api.service.image import GenerationCancelledError, ImageService
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelledError(GenerationCancelledError):
+    """実行中のジョブがキャンセルされたことを表す"""
+
+
+class JobService:
+    def __init__(
+        self,
+        image_service: ImageService,
+        sqlite_client: SQLiteClient,
+        inference_executor: InferenceExecutor,
+        settings: Settings,
+    ):
+        self.image_service = image_service
+        self.sqlite_client = sqlite_client
+        self.inference_executor = inference_executor
+        self.poll_interval = settings.JOB_POLL_INTERVAL_SECONDS
+        self.stats_window = settings.JOB_STATS_WINDOW
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._worker: threading.Thread | None = None
+
+    def start(self):
+        """ワーカースレッドを起動 (前回実行中だったジョブは再投入する)"""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self.sqlite_client.requeue_running_jobs()
+        self._stop.clear()
+        self._worker = threading.Thread(
+            target=self._worker_loop, name="generation-job-worker", daemon=True
+        )
+        self._worker.start()
+
+    def stop(self):
+        """ワーカースレッドを停止"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout=self.poll_interval * 2)
+            self._worker = None
+
+    def submit(self, params: ImageGenerationParams) -> JobStatus:
+        """生成ジョブをキューに追加してジョブIDを返す"""
+        self.image_service.ensure_generation_enabled()
+        # プリセットでステップ数が決まっている場合はその値を進捗の総数にする
+        num_inference_steps, _ = self.image_service.resolve_preset(
+            params.preset
+        ).resolve(params.num_inference_steps, params.guidance_scale)
+        job = self.sqlite_client.enqueue_job(
+            job_id=uuid.uuid4().hex,
+            params=params.model_dump(),
+            total_steps=num_inference_steps,
+        )
+        self._wakeup.set()
+        return self._to_status(job)
+
+    def get_status(self, job_id: str) -> JobStatus:
+        """ジョブの状態を取得"""
+        return self._to_status(self._retrieve_job(job_id))
+
+    def get_progress(self, job_id: str) -> JobProgress:
+        """ジョブの進捗 (デノイズのステップ数) を取得"""
+        job = self._retrieve_job(job_id)
+        total_steps = int(job.total_steps or 0)
+        current_step = int(job.current_step or 0)
+        return JobProgress(
+            job_id=str(job.job_id),
+            status=str(job.status),
+            current_step=current_step,
+            total_steps=total_steps,
+            progress=current_step / total_steps if total_steps else 0.0,
+        )
+
+    def cancel(self, job_id: str) -> JobStatus:
+        """ジョブのキャンセルを要求"""
+        job = self.sqlite_client.request_job_cancel(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+        return self._to_status(job)
+
+    def get_stats(self) -> JobQueueStats:
+        """キューの深さと直近のジョブのレイテンシを取得"""
+        counts = self.sqlite_client.count_jobs_by_status()
+        finished_jobs = self.sqlite_client.retrieve_finished_jobs(self.stats_window)
+
+        wait_seconds = [
+            (job.started_at - job.created_at).total_seconds() for job in finished_jobs
+        ]
+        run_seconds = [
+            (job.finished_at - job.started_at).total_seconds()
+            for job in finished_jobs
+            if job.status == "succeeded"
+        ]
+        return JobQueueStats(
+            queue_depth=counts.get("queued", 0),
+            running=counts.get("running", 0),
+            succeeded=counts.get("succeeded", 0),
+            failed=counts.get("failed", 0),
+            cancelled=counts.get("cancelled", 0),
+            avg_wait_seconds=float(np.mean(wait_seconds)) if wait_seconds else None,
+            avg_run_seconds=float(np.mean(run_seconds)) if run_seconds else None,
+            p95_run_seconds=float(np.percentile(run_seconds, 95))
+            if run_seconds
+            else None,
+        )
+
+    def _retrieve_job(self, job_id: str) -> GenerationJob:
+        job = self.sqlite_client.retrieve_job(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+        return job
+
+    def _worker_loop(self):
+        """待機中のジョブを1件ずつ取り出して実行"""
+        while not self._stop.is_set():
+            job = self.sqlite_client.claim_next_job()
+            if job is None:
+                self._wakeup.wait(timeout=self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            # 同期APIの生成と同じdiffusionレーンで実行する (空きが出るまで待つ)
+            future = self.inference_executor.submit(
+                "diffusion", self._run_job, job, block=True
+            )
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Generation job worker failed on %s", job.job_id)
+
+    def _run_job(self, job: GenerationJob):
+        job_id = str(job.job_id)
+
+        def step_callback(current_step: int, total_steps: int):
+            if self.sqlite_client.update_job_progress(job_id, current_step):
+                raise JobCancelledError(f"Job {job_id} was cancelled.")
+
+        try:
+            # 完了したジョブの画像はすぐ参照できるよう、保存を待ってから終了する
+            params = ImageGenerationParams(**job.params).model_copy(
+                update={"durable": True}
+            )
+            result = self.image_service.generate_and_save_image(
+                # ネストしたモデル (control_images) をそのまま渡すためmodel_dumpは使わない
+                **dict(params),
+                step_callback=step_callback,
+            )
+        except JobCancelledError:
+            self.sqlite_client.finish_job(job_id, status="cancelled")
+            logger.info("Generation job %s cancelled", job_id)
+            return
+        except Exception as e:
+            self.sqlite_client.finish_job(job_id, status="failed", error=str(e))
+            logger.exception("Generation job %s failed", job_id)
+            return
+
+        self.sqlite_client.finish_job(
+            job_id, status="succeeded", image_filename=result.image_filename
+        )
+        finished_job = self._retrieve_job(job_id)
+        logger.info(
+            "Generation job %s succeeded (wait: %.2fs, run: %.2fs)",
+            job_id,
+            (finished_job.started_at - finished_job.created_at).total_seconds(),
+            (finished_job.finished_at - finished_job.started_at).total_seconds(),
+        )
+
+    @staticmethod
+    def _to_status(job: GenerationJob) -> JobStatus:
+        return JobStatus(
+            job_id=str(job.job_id),
+            status=str(job.status),
+            current_step=int(job.current_step or 0),
+            total_steps=int(job.total_steps or 0),
+            image_filename=job.image_filename,  # type: ignore
+            error=job.error,  # type: ignore
+            created_at=job.created_at,  # type: ignore
+            started_at=job.started_at,  # type: ignore
+            finished_at=job.finished_at,  # type: ignore
+        )
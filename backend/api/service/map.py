@@ -0,0 +1,97 @@
+import threading
+
+import numpy as np
+
+from api.clients import EmbeddingMapClient, MapTileClient, VectorStore
+from api.schema import MapInfo, MapTile
+
+
+class MapService:
+    def __init__(
+        self,
+        embedding_map_client: EmbeddingMapClient,
+        map_tile_client: MapTileClient,
+        qdrant_client: VectorStore,
+    ):
+        self.embedding_map_client = embedding_map_client
+        self.map_tile_client = map_tile_client
+        self.qdrant_client = qdrant_client
+        # タイルの計算に使う座標 (版が変わるまでタイルごとにコピーしない)
+        self._snapshot_lock = threading.Lock()
+        self._snapshot: tuple[list[str], np.ndarray, int] | None = None
+
+    def rebuild(self) -> MapInfo:
+        """Qdrantの全画像embeddingで射影を学習し直す"""
+        image_filenames, embeddings = self.qdrant_client.scroll_embeddings("image")
+        if len(image_filenames) < 2:
+            raise ValueError("At least two images are required to build the map.")
+        self.embedding_map_client.fit(image_filenames, embeddings)
+        # 射影が変わるのでタイルは全て作り直す
+        self.map_tile_client.clear()
+        return self.fetch_info()
+
+    def fetch_info(self) -> MapInfo:
+        """マップの状態を取得"""
+        image_filenames, _, version = self.embedding_map_client.get_coordinates()
+        return MapInfo(
+            method=self.embedding_map_client.method,
+            fitted=self.embedding_map_client.is_fitted,
+            count=len(image_filenames),
+            version=version,
+        )
+
+    def fetch_coordinates(self) -> tuple[bytes, int, int]:
+        """座標をfloat32 (リトルエンディアン, [N, 2]) のバイト列で取得"""
+        _, coordinates, version = self.embedding_map_client.get_coordinates()
+        data = coordinates.astype("<f4", copy=False).tobytes()
+        return data, len(coordinates), version
+
+    def fetch_filenames(self) -> tuple[list[str], int]:
+        """座標と同じ順のファイル名を取得"""
+        image_filenames, _, version = self.embedding_map_client.get_coordinates()
+        return image_filenames, version
+
+    def fetch_tile(self, z: int, x: int, y: int) -> MapTile:
+        """タイルを取得 (キャッシュがなければ計算して保存)
+
+        同じズームレベルのタイルの計算は1件ずつ行う (点の振り分けは版ごとに1回だけ計算する)
+        """
+        self.map_tile_client.validate(z, x, y)
+        bounds = self.embedding_map_client.get_bounds()
+        if bounds is None:
+            raise ValueError("The map has not been built yet.")
+        with self.map_tile_client.level_lock(z):
+            tile = self.map_tile_client.load_tile(z, x, y)
+            if tile is None:
+                image_filenames, coordinates, version = self._coordinates_snapshot()
+                tile = self.map_tile_client.build_tile(
+                    z, x, y, image_filenames, coordinates, bounds, version=version
+                )
+                self.map_tile_client.save_tile(tile)
+        return tile
+
+    def _coordinates_snapshot(self) -> tuple[list[str], np.ndarray, int]:
+        """現在の版の (ファイル名, 座標, 版) を取得 (版が変わるまで使い回す)"""
+        with self._snapshot_lock:
+            if (
+                self._snapshot is None
+                or self._snapshot[2] != self.embedding_map_client.version
+            ):
+                self._snapshot = self.embedding_map_client.get_coordinates()
+            return self._snapshot
+
+    def add_images(self, image_filenames: list[str], embeddings: np.ndarray):
+        """新しい画像を学習済みの射影でマップに配置 (学習し直さない)"""
+        coordinates = self.embedding_map_client.add_points(image_filenames, embeddings)
+        self._invalidate_tiles(coordinates)
+
+    def remove_images(self, image_filenames: list[str]):
+        """削除された画像をマップから取り除く"""
+        coordinates = self.embedding_map_client.remove_points(image_filenames)
+        self._invalidate_tiles(coordinates)
+
+    def _invalidate_tiles(self, coordinates: np.ndarray):
+        """変更された点を含むタイルだけキャッシュから削除"""
+        bounds = self.embedding_map_client.get_bounds()
+        if bounds is not None:
+            self.map_tile_client.invalidate(coordinates, bounds)
@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from api.clients import LocalStorageClient, SQLiteClient, VectorStore
+from api.config import Settings
+from api.schema import PersistenceFailure, PersistenceStats
+from api.service.map import MapService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GeneratedImageRecord:
+    """生成済みで保存待ちの画像1枚分のデータ"""
+
+    image: Image.Image
+    image_filename: str
+    image_embedding: np.ndarray
+    text_embedding: np.ndarray
+    prompt: str
+    metadata: dict[str, Any]
+    extra_payload: dict[str, Any] = field(default_factory=dict)
+
+
+class PersistenceWriter:
+    """画像のエンコード・書き込みとQdrant・SQLiteへの登録をバックグラウンドで行う
+
+    書き込みは1本のスレッドで投入順に行い、リクエスト単位でまとめて登録する
+    失敗した段階は間隔を空けて再試行し、それでも失敗した書き込みは統計に記録する
+    """
+
+    def __init__(
+        self,
+        local_storage_client: LocalStorageClient,
+        qdrant_client: VectorStore,
+        sqlite_client: SQLiteClient,
+        map_service: MapService,
+        settings: Settings,
+    ):
+        self.local_storage_client = local_storage_client
+        self.qdrant_client = qdrant_client
+        self.sqlite_client = sqlite_client
+        self.map_service = map_service
+        self.durable_default = settings.PERSIST_DURABLE_DEFAULT
+        self.max_retries = settings.PERSIST_MAX_RETRIES
+        self.retry_backoff_seconds = settings.PERSIST_RETRY_BACKOFF_SECONDS
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="persistence"
+        )
+        # 保存待ちの画像を保持しすぎないよう、上限に達したら投入側を待たせる
+        self._slots = threading.BoundedSemaphore(settings.PERSIST_MAX_PENDING)
+        self._lock = threading.Lock()
+        self._pending: dict[str, Future[None]] = {}
+        self._succeeded = 0
+        self._retried = 0
+        self._failed = 0
+        self._failures: deque[PersistenceFailure] = deque(
+            maxlen=settings.PERSIST_FAILURE_HISTORY
+        )
+
+    def submit(self, records: list[GeneratedImageRecord]) -> Future[None]:
+        """保存処理を投入し、完了を待つためのFutureを返す"""
+        self._slots.acquire()
+        future = self._executor.submit(self._write, records)
+        with self._lock:
+            for record in records:
+                self._pending[record.image_filename] = future
+        future.add_done_callback(lambda _: self._on_done(records))
+        return future
+
+    def wait_for(self, image_filenames: list[str], timeout: float | None = None):
+        """指定した画像が保存待ちなら書き込み完了まで待つ"""
+        with self._lock:
+            futures = {
+                self._pending[name] for name in image_filenames if name in self._pending
+            }
+        for future in futures:
+            future.result(timeout=timeout)
+
+    def wait_for_each(
+        self, image_filenames: list[str], timeout: float | None = None
+    ) -> set[str]:
+        """指定した画像が保存待ちなら書き込み完了まで待ち、書き込みに失敗した画像のファイル名を返す"""
+        with self._lock:
+            futures: dict[Future[None], list[str]] = {}
+            for name in image_filenames:
+                if name in self._pending:
+                    futures.setdefault(self._pending[name], []).append(name)
+        failed: set[str] = set()
+        for future, names in futures.items():
+            try:
+                future.result(timeout=timeout)
+            except TimeoutError:
+                raise
+            except Exception:
+                # 失敗の内容は書き込み側で記録しているので、ここではファイル名だけを返す
+                failed.update(names)
+        return failed
+
+    def pending_count(self) -> int:
+        """保存待ちの画像数"""
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self) -> PersistenceStats:
+        """保存待ち・成功・再試行・失敗の件数と、直近に失敗した書き込みを取得"""
+        with self._lock:
+            return PersistenceStats(
+                pending=len(self._pending),
+                succeeded=self._succeeded,
+                retried=self._retried,
+                failed=self._failed,
+                recent_failures=list(reversed(self._failures)),
+            )
+
+    def shutdown(self):
+        """保存待ちの処理を全て書き込んでから停止"""
+        self._executor.shutdown(wait=True)
+
+    def _on_done(self, records: list[GeneratedImageRecord]):
+        with self._lock:
+            for record in records:
+                self._pending.pop(record.image_filename, None)
+        self._slots.release()
+
+    def _write(self, records: list[GeneratedImageRecord]):
+        try:
+            # 段階ごとに再試行し、成功した段階はやり直さない
+            for step in (self._save_files, self._register, self._add_to_map):
+                self._run_with_retry(step, records)
+        except Exception as e:
+            logger.exception(
+                "Failed to persist %s",
+                ", ".join(record.image_filename for record in records),
+            )
+            with self._lock:
+                self._failed += len(records)
+                self._failures.append(
+                    PersistenceFailure(
+                        image_filenames=[record.image_filename for record in records],
+                        error=str(e) or type(e).__name__,
+                        failed_at=datetime.now(UTC),
+                    )
+                )
+            raise
+        with self._lock:
+            self._succeeded += len(records)
+
+    def _run_with_retry(
+        self,
+        step: Callable[[list[GeneratedImageRecord]], None],
+        records: list[GeneratedImageRecord],
+    ):
+        """1つの段階を実行し、失敗したら待ち時間を倍にしながら再試行する"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                step(records)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    "Retrying %s for %s",
+                    step.__name__,
+                    ", ".join(record.image_filename for record in records),
+                    exc_info=True,
+                )
+                with self._lock:
+                    self._retried += 1
+                time.sleep(self.retry_backoff_seconds * 2**attempt)
+
+    def _save_files(self, records: list[GeneratedImageRecord]):
+        """ローカルに画像とサムネイルを保存"""
+        for record in records:
+            self.local_storage_client.save_image(record.image, record.image_filename)
+
+    def _register(self, records: list[GeneratedImageRecord]):
+        """SQLite・Qdrantにまとめて登録 (Qdrantに失敗したらSQLiteも戻す)"""
+        # 日時での絞り込みが両方で一致するよう、作成日時は同じ値を使う
+        created_at = datetime.now(UTC)
+        with self.sqlite_client.unit_of_work() as session:
+            self.sqlite_client.bulk_upload_metadata(
+                [
+                    {"image_filename": r.image_filename, "prompt": r.prompt}
+                    | r.metadata
+                    | {"created_at": created_at}
+                    for r in records
+                ],
+                session=session,
+            )
+            self.qdrant_client.upload_points(
+                image_embeddings=np.stack([r.image_embedding for r in records]),
+                text_embeddings=np.stack([r.text_embedding for r in records]),
+                image_filenames=[r.image_filename for r in records],
+                prompts=[r.prompt for r in records],
+                extra_payloads=[
+                    r.extra_payload | {"created_at": created_at.isoformat()}
+                    for r in records
+                ],
+            )
+
+    def _add_to_map(self, records: list[GeneratedImageRecord]):
+        """学習済みの射影で埋め込みマップに配置"""
+        self.map_service.add_images(
+            [r.image_filename for r in records],
+            np.stack([r.image_embedding for r in records]),
+        )
@@ -0,0 +1,60 @@
+import logging
+import threading
+
+from api.clients import LazyClient
+from api.config import Settings
+from api.schema import ModelStatus, Readiness
+
+logger = logging.getLogger(__name__)
+
+
+class ModelWarmup:
+    """遅延ロードするモデルの事前ロードと、準備状況 (readiness) の確認を行う"""
+
+    def __init__(self, clients: list[LazyClient], settings: Settings):
+        self.clients = clients
+        self.search_only = settings.SEARCH_ONLY
+        self.enabled = settings.WARMUP_ON_STARTUP
+        self._thread: threading.Thread | None = None
+
+    def is_required(self, client: LazyClient) -> bool:
+        """現在のモードで必要なモデルか (検索専用モードでは画像生成のモデルは不要)"""
+        return not (self.search_only and client.name == "diffusion")
+
+    def start(self):
+        """必要なモデルをバックグラウンドで順にロード (起動自体は待たせない)"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._warm_up, name="model-warmup", daemon=True
+        )
+        self._thread.start()
+
+    def readiness(self) -> Readiness:
+        """必要なモデルが全てロード済みかを取得"""
+        models = [
+            ModelStatus(
+                name=client.name,
+                required=self.is_required(client),
+                loaded=client.loaded,
+                load_seconds=client.load_seconds,
+                error=client.error,
+            )
+            for client in self.clients
+        ]
+        return Readiness(
+            ready=all(model.loaded for model in models if model.required),
+            search_only=self.search_only,
+            models=models,
+        )
+
+    def _warm_up(self):
+        for client in self.clients:
+            if not self.is_required(client):
+                continue
+            try:
+                client.get()
+                logger.info("Loaded %s in %.1fs", client.name, client.load_seconds)
+            except Exception:
+                # 失敗しても最初の利用時に再度ロードを試みる
+                logger.exception("Failed to load %s", client.name)
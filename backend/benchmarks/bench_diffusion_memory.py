@@ -0,0 +1,131 @@
+"""画像生成モデルのメモリ設定ごとに、ピークのメモリ使用量と1ステップあたりの時間を測る
+
+backendディレクトリで `python -m benchmarks.bench_diffusion_memory` を実行する
+(ピークRSSを正しく測るため、設定ごとに別プロセスでモデルをロードする)
+"""
+
+import argparse
+import itertools
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# 設定名 -> Settingsの上書き
+MODES: dict[str, dict] = {
+    "baseline": {},
+    "vae-tiling-slicing": {
+        "DIFFUSION_VAE_TILING": True,
+        "DIFFUSION_VAE_SLICING": True,
+        "DIFFUSION_ATTENTION_SLICING": True,
+    },
+    "model-offload": {"DIFFUSION_OFFLOAD": "model"},
+    "sequential-offload": {"DIFFUSION_OFFLOAD": "sequential"},
+    "int8": {"DIFFUSION_QUANTIZATION": "int8"},
+    "int8-vae-tiling": {
+        "DIFFUSION_QUANTIZATION": "int8",
+        "DIFFUSION_VAE_TILING": True,
+        "DIFFUSION_VAE_SLICING": True,
+    },
+    "nf4-model-offload": {
+        "DIFFUSION_QUANTIZATION": "nf4",
+        "DIFFUSION_OFFLOAD": "model",
+    },
+}
+
+
+def run_mode(overrides: dict, size: int, steps: int) -> dict:
+    """1つの設定でモデルをロードして1枚生成し、計測結果を返す (子プロセスで実行)"""
+    import torch
+
+    from api.clients import DiffusionClient
+    from api.config import Settings
+
+    started_at = time.perf_counter()
+    client = DiffusionClient(Settings(**overrides))
+    load_seconds = time.perf_counter() - started_at
+
+    step_times: list[float] = []
+    started_at = time.perf_counter()
+    client.generate_image(
+        prompt="a watercolor painting of a lighthouse",
+        control_images=[],
+        width=size,
+        height=size,
+        controlnet_conditioning_scale=[],
+        control_guidance_end=[],
+        num_inference_steps=steps,
+        guidance_scale=3.5,
+        seed=0,
+        step_callback=lambda step, total: step_times.append(time.perf_counter()),
+    )
+    total_seconds = time.perf_counter() - started_at
+
+    # 最初のステップはウォームアップを含むため、ステップ間の中央値を使う
+    intervals = [b - a for a, b in itertools.pairwise(step_times)]
+    return {
+        "load_seconds": load_seconds,
+        "total_seconds": total_seconds,
+        "seconds_per_step": statistics.median(intervals) if intervals else None,
+        # Linuxのru_maxrssはKB単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_cuda_mb": (
+            torch.cuda.max_memory_allocated() / 1024**2
+            if torch.cuda.is_available()
+            else None
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_mode(MODES[args.child], args.size, args.steps)))
+        return
+
+    print(
+        f"{'mode':>20} {'load':>8} {'s/step':>8} {'total':>8} "
+        f"{'peak RSS':>10} {'peak CUDA':>10}"
+    )
+    for mode in args.modes:
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_diffusion_memory",
+                "--child",
+                mode,
+                "--size",
+                str(args.size),
+                "--steps",
+                str(args.steps),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()
+            print(f"{mode:>20} failed: {error[-1] if error else process.returncode}")
+            continue
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        seconds_per_step = result["seconds_per_step"]
+        peak_cuda = result["peak_cuda_mb"]
+        print(
+            f"{mode:>20} {result['load_seconds']:>7.1f}s "
+            f"{seconds_per_step if seconds_per_step is not None else float('nan'):>7.2f}s "
+            f"{result['total_seconds']:>7.1f}s "
+            f"{result['peak_rss_mb']:>8.0f}MB "
+            f"{peak_cuda if peak_cuda is not None else float('nan'):>8.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Qdrantの量子化・HNSW設定ごとに、全件探索に対する再現率と検索レイテンシを測る
+
+backendディレクトリで `python -m benchmarks.bench_qdrant --url http://localhost:6333` を実行する
+(ローカルモードは常に全件探索なので、設定の違いを測るにはQdrantサーバーが必要)
+"""
+
+import argparse
+import time
+import warnings
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    Distance,
+    HnswConfigDiff,
+    PointStruct,
+    QuantizationSearchParams,
+    SearchParams,
+    VectorParams,
+)
+
+from api.clients.qdrant import build_quantization_config
+
+COLLECTION_NAME = "benchmark_embeddings"
+
+
+def make_embeddings(num_points: int, dim: int, seed: int) -> np.ndarray:
+    """CLIPのembeddingに近い、クラスタを持つ正規化済みのベクトルを作る"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(num_points // 100, 1), dim))
+    embeddings = centers[rng.integers(len(centers), size=num_points)]
+    embeddings += rng.normal(scale=0.5, size=(num_points, dim))
+    return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(
+        np.float32
+    )
+
+
+def build_collection(
+    client: QdrantClient,
+    embeddings: np.ndarray,
+    quantization: str,
+    on_disk: bool,
+    hnsw_m: int,
+    hnsw_ef_construct: int,
+):
+    if client.collection_exists(COLLECTION_NAME):
+        client.delete_collection(COLLECTION_NAME)
+    client.create_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=VectorParams(
+            size=embeddings.shape[1],
+            distance=Distance.COSINE,
+            on_disk=on_disk,
+            hnsw_config=HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct),
+            quantization_config=build_quantization_config(quantization, True),
+        ),
+    )
+    for start in range(0, len(embeddings), 1000):
+        client.upsert(
+            collection_name=COLLECTION_NAME,
+            points=[
+                PointStruct(id=start + i, vector=vector.tolist())
+                for i, vector in enumerate(embeddings[start : start + 1000])
+            ],
+            wait=True,
+        )
+
+
+def search(
+    client: QdrantClient, queries: np.ndarray, topk: int, params: SearchParams
+) -> tuple[list[set[int]], list[float]]:
+    """各クエリの (上位topkのID, レイテンシ[ms]) を返す"""
+    results, latencies = [], []
+    for query in queries:
+        started_at = time.perf_counter()
+        points = client.query_points(
+            collection_name=COLLECTION_NAME,
+            query=query.tolist(),
+            search_params=params,
+            limit=topk,
+        ).points
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        results.append({int(point.id) for point in points})
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None, help="Qdrant server URL")
+    parser.add_argument("--points", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument(
+        "--quantization", nargs="+", default=["none", "scalar", "binary"]
+    )
+    parser.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--hnsw-m", type=int, default=16)
+    parser.add_argument("--hnsw-ef-construct", type=int, default=100)
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--on-disk", action="store_true")
+    args = parser.parse_args()
+
+    if args.url is None:
+        warnings.warn(
+            "Running in local mode: search is always exact, so settings have no effect.",
+            stacklevel=1,
+        )
+    client = QdrantClient(url=args.url) if args.url else QdrantClient(":memory:")
+    embeddings = make_embeddings(args.points, args.dim, seed=0)
+    queries = make_embeddings(args.queries, args.dim, seed=1)
+
+    print(
+        f"{'quantization':>12} {'ef':>5} {'rescore':>7} {'recall':>7} {'p50':>8} {'p95':>8}"
+    )
+    for quantization in args.quantization:
+        build_collection(
+            client,
+            embeddings,
+            quantization,
+            args.on_disk,
+            args.hnsw_m,
+            args.hnsw_ef_construct,
+        )
+        # 同じコレクションでの全件探索を正解とする
+        exact, _ = search(client, queries, args.topk, SearchParams(exact=True))
+        for ef in args.ef:
+            for rescore in [False, True] if quantization != "none" else [False]:
+                params = SearchParams(
+                    hnsw_ef=ef,
+                    quantization=QuantizationSearchParams(
+                        rescore=rescore, oversampling=args.oversampling
+                    ),
+                )
+                results, latencies = search(client, queries, args.topk, params)
+                recall = np.mean(
+                    [
+                        len(result & truth) / args.topk
+                        for result, truth in zip(results, exact, strict=True)
+                    ]
+                )
+                print(
+                    f"{quantization:>12} {ef:>5} {rescore!s:>7} {recall:>7.3f} "
+                    f"{np.percentile(latencies, 50):>6.2f}ms "
+                    f"{np.percentile(latencies, 95):>6.2f}ms"
+                )
+    client.delete_collection(COLLECTION_NAME)
+
+
+if __name__ == "__main__":
+    main()
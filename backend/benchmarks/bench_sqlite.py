@@ -0,0 +1,99 @@
+"""SQLiteの書き込み・一覧取得のスループットを設定ごとに比較する
+
+backendディレクトリで `python -m benchmarks.bench_sqlite` を実行する
+"""
+
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from api.clients import SQLiteClient
+from api.config import Settings
+
+# 比較する設定 (baselineは変更前と同じSQLiteのデフォルト)
+CONFIGS = {
+    "baseline": {
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_MMAP_SIZE": 0,
+    },
+    "tuned": {
+        "SQLITE_JOURNAL_MODE": "WAL",
+        "SQLITE_SYNCHRONOUS": "NORMAL",
+        "SQLITE_MMAP_SIZE": 256 * 1024 * 1024,
+    },
+}
+
+
+def dummy_metadata(i: int) -> dict:
+    return {
+        "image_filename": f"{i:08d}.png",
+        "prompt": f"benchmark prompt {i}",
+        "width": 1024,
+        "height": 1024,
+        "control_image_filename_1": None,
+        "control_image_filename_2": None,
+        "controlnet_conditioning_scale_1": None,
+        "controlnet_conditioning_scale_2": None,
+        "control_guidance_end_1": None,
+        "control_guidance_end_2": None,
+        "num_inference_steps": 28,
+        "guidance_scale": 3.5,
+        "seed": i,
+    }
+
+
+def run(name: str, overrides: dict, num_inserts: int, page_size: int) -> dict:
+    """書き込みスレッドと一覧取得スレッドを同時に走らせて処理数を測る"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings = Settings(
+            SQLITE_DB_PATH=str(Path(tmp_dir) / "bench.db"),
+            **overrides,  # type: ignore[arg-type]
+        )
+        client = SQLiteClient(settings)
+        done = threading.Event()
+        pages = 0
+
+        def reader():
+            nonlocal pages
+            while not done.is_set():
+                client.retrieve_simple_metadata_page(limit=page_size)
+                pages += 1
+
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        started_at = time.perf_counter()
+        # 生成1回分と同じく、1件ずつ別トランザクションで書き込む
+        for i in range(num_inserts):
+            client.upload_metadata(**dummy_metadata(i))
+        elapsed = time.perf_counter() - started_at
+        done.set()
+        reader_thread.join()
+        client.engine.dispose()
+
+    return {
+        "config": name,
+        "inserts_per_second": num_inserts / elapsed,
+        "pages_per_second": pages / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--inserts", type=int, default=2000)
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    for name, overrides in CONFIGS.items():
+        result = run(name, overrides, args.inserts, args.page_size)
+        print(
+            f"{result['config']:>8}: "
+            f"{result['inserts_per_second']:8.1f} inserts/s, "
+            f"{result['pages_per_second']:8.1f} pages/s (concurrent listing)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""検索バックエンド (Qdrantのローカルモード / NumPy) の検索レイテンシを比較する
+
+backendディレクトリで `python -m benchmarks.bench_vector_store` を実行する
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from api.clients import create_vector_store
+from api.config import Settings
+
+
+def measure(store, queries: np.ndarray, topk: int, batch_size: int) -> dict:
+    """1件ずつの検索とバッチ検索のレイテンシ (ミリ秒) を測る"""
+    single = []
+    for query in queries:
+        started_at = time.perf_counter()
+        store.search_points(query, topk=topk)
+        single.append((time.perf_counter() - started_at) * 1000)
+
+    started_at = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        store.search_points_batch(queries[start : start + batch_size], topk=topk)
+    batch_per_query = (time.perf_counter() - started_at) * 1000 / len(queries)
+
+    return {
+        "p50": np.percentile(single, 50),
+        "p95": np.percentile(single, 95),
+        "batch_per_query": batch_per_query,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--points", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    print(f"{'backend':>14} {'points':>7} {'p50':>9} {'p95':>9} {'batch/query':>12}")
+    for num_points in args.points:
+        embeddings = rng.normal(size=(num_points, args.dim)).astype(np.float32)
+        filenames = [f"{i:08d}.png" for i in range(num_points)]
+        for backend, dtype in [
+            ("qdrant", "float32"),
+            ("numpy", "float32"),
+            ("numpy", "float16"),
+        ]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                settings = Settings(
+                    VECTOR_BACKEND=backend,
+                    EMBEDDING_DIM=args.dim,
+                    NUMPY_STORE_DTYPE=dtype,
+                    QDRANT_DB_PATH=str(Path(tmp_dir) / "qdrant"),
+                    NUMPY_STORE_DIR=str(Path(tmp_dir) / "numpy"),
+                    QDRANT_MIGRATE_POINT_IDS=False,
+                )
+                store = create_vector_store(settings)
+                for start in range(0, num_points, 1000):
+                    store.upload_points(
+                        image_embeddings=embeddings[start : start + 1000],
+                        text_embeddings=None,
+                        image_filenames=filenames[start : start + 1000],
+                        prompts=[""] * len(filenames[start : start + 1000]),
+                    )
+                result = measure(store, queries, args.topk, args.batch_size)
+                name = backend if backend == "qdrant" else f"numpy-{dtype}"
+                print(
+                    f"{name:>14} {num_points:>7} "
+                    f"{result['p50']:>7.2f}ms {result['p95']:>7.2f}ms "
+                    f"{result['batch_per_query']:>10.2f}ms"
+                )
+                if hasattr(store, "qdrant"):
+                    store.qdrant.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+
+from api.clients import (
+    CLIPClient,
+    EmbeddingMapClient,
+    LocalStorageClient,
+    MapTileClient,
+    SQLiteClient,
+    create_vector_store,
+)
+from api.config.settings import settings
+from api.schema import IngestReport
+from api.service.ingest import IngestService
+from api.service.map import MapService
+
+# 画像フォルダを一括で取り込む (APIサーバーとは同時に実行しないこと)
+parser = argparse.ArgumentParser(description="Ingest an existing image folder")
+parser.add_argument("directory", help="Directory containing images to ingest")
+parser.add_argument("--batch-size", type=int, default=None)
+args = parser.parse_args()
+
+qdrant_client = create_vector_store(settings)
+ingest_service = IngestService(
+    clip_client=CLIPClient(settings),
+    qdrant_client=qdrant_client,
+    sqlite_client=SQLiteClient(settings),
+    local_storage_client=LocalStorageClient(settings),
+    map_service=MapService(
+        EmbeddingMapClient(settings), MapTileClient(settings), qdrant_client
+    ),
+    settings=settings,
+)
+
+
+def print_progress(report: IngestReport):
+    print(
+        f"ingested={report.ingested} skipped={report.skipped} failed={report.failed} "
+        f"({report.images_per_second:.1f} images/s)",
+        flush=True,
+    )
+
+
+report = ingest_service.ingest_directory(
+    args.directory, batch_size=args.batch_size, on_progress=print_progress
+)
+print(report.model_dump_json(indent=2))
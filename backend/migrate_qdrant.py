@@ -0,0 +1,18 @@
+import argparse
+
+from api.clients import QdrantClientManager, SQLiteClient
+from api.config.settings import settings
+
+# 既存のQdrantコレクションを現在の形式に移行する (APIサーバーとは同時に実行しないこと)
+# 全件を走査するため起動時には行わず、アップデート後に1回だけ実行する
+parser = argparse.ArgumentParser(description="Migrate an existing Qdrant collection")
+args = parser.parse_args()
+
+qdrant_client = QdrantClientManager(settings)
+migrated = qdrant_client.migrate_point_ids()
+print(f"migrated_point_ids={migrated}")
+
+# 旧形式のポイントに絞り込み用のペイロード (作成日時・シード・条件画像) をSQLiteから補う
+sqlite_client = SQLiteClient(settings)
+backfilled = qdrant_client.backfill_payloads(sqlite_client.retrieve_filter_fields())
+print(f"backfilled_payloads={backfilled}")
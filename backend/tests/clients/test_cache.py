@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from api.clients import LRUCache
+
+
+@pytest.fixture
+def cache():
+    # テスト用の小さいキャッシュ
+    return LRUCache[str, int]("test", max_size=2)
+
+
+def test_get_and_put(cache):
+    """値を保存・取得でき、ヒット・ミス数が記録されるかテスト"""
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+
+    stats = cache.stats()
+    assert stats.name == "test"
+    assert stats.size == 1
+    assert stats.hits == 1
+    assert stats.misses == 1
+
+
+def test_eviction(cache):
+    """上限を超えると最も使われていないエントリが削除されるかテスト"""
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")  # "a" を最近使ったことにする
+    cache.put("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats().evictions == 1
+
+
+def test_disabled_cache():
+    """上限が0の場合は何も保存されないかテスト"""
+    cache = LRUCache[str, int]("disabled", max_size=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_max_bytes():
+    """合計サイズが上限を超えると古いエントリが削除されるかテスト"""
+    cache = LRUCache[str, bytes]("bytes", max_size=10, max_bytes=10, sizeof=len)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.put("c", b"123")
+
+    assert "a" not in cache
+    assert cache.stats().size_bytes == 8
+
+    # 単体で上限を超えるものはキャッシュされない
+    cache.put("d", b"12345678901")
+    assert "d" not in cache
+
+
+def test_ttl():
+    """有効期限を過ぎたエントリはミスとして扱われ削除されるかテスト"""
+    cache = LRUCache[str, int]("ttl", max_size=10, ttl_seconds=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert cache.items() == [("a", 1)]
+
+    time.sleep(0.1)
+    assert cache.items() == []
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert cache.stats().misses == 1
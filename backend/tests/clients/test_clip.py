@@ -1,8 +1,10 @@
+import asyncio
+
 import numpy as np
 import pytest
 from PIL import Image
 
-from api.clients import CLIPClient
+from api.clients import CLIPBatcher, CLIPClient
 from tests.config import test_settings
 
 
@@ -36,3 +38,58 @@ def test_generate_text_embedding(clip_client):
     assert np.allclose(
         np.linalg.norm(embedding), 1.0, atol=1e-6
     )  # 埋め込みベクトルの正規化
+
+
+def test_generate_image_embeddings(clip_client, dummy_data):
+    """複数画像の埋め込みベクトルがまとめて生成されるかテスト"""
+    embeddings = clip_client.generate_image_embeddings([dummy_data, dummy_data])
+    assert embeddings.shape == (2, 512)
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0, atol=1e-6)
+    # 単体で生成した場合と一致すること
+    single = clip_client.generate_image_embedding(dummy_data)
+    assert np.allclose(embeddings[0], single, atol=1e-5)
+
+
+def test_generate_text_embeddings(clip_client):
+    """複数テキストの埋め込みベクトルがまとめて生成されるかテスト"""
+    texts = ["A sample text", "Another, much longer sample text"]
+    embeddings = clip_client.generate_text_embeddings(texts)
+    assert embeddings.shape == (2, 512)
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0, atol=1e-6)
+    # パディングがあっても単体で生成した場合と一致すること
+    single = clip_client.generate_text_embedding(texts[0])
+    assert np.allclose(embeddings[0], single, atol=1e-5)
+
+
+def test_clip_batcher(clip_client):
+    """同時リクエストがまとめて処理され、正しい順で結果が返るかテスト"""
+    batcher = CLIPBatcher(clip_client, test_settings)
+    texts = ["a cat", "a dog", "a house"]
+
+    async def run():
+        return await asyncio.gather(*(batcher.embed_text(text) for text in texts))
+
+    embeddings = asyncio.run(run())
+    expected = clip_client.generate_text_embeddings(texts)
+    for embedding, expected_embedding in zip(embeddings, expected, strict=True):
+        assert np.allclose(embedding, expected_embedding, atol=1e-5)
+
+
+def test_clip_batcher_text_cache(clip_client, tmp_path):
+    """同じテキストはモデルを使わずにキャッシュから返り、保存・読み込みできるかテスト"""
+    settings = test_settings.model_copy(
+        update={"TEXT_EMBEDDING_CACHE_PATH": str(tmp_path / "text_embeddings.npz")}
+    )
+    batcher = CLIPBatcher(clip_client, settings)
+
+    first = asyncio.run(batcher.embed_text("a cat"))
+    second = asyncio.run(batcher.embed_text("a cat"))
+    assert second is first
+    assert batcher.text_embedding_cache.stats().hits == 1
+    assert batcher.save_text_embedding_cache() == 1
+
+    # 再起動後も同じ埋め込みが使われる
+    reloaded = CLIPBatcher(clip_client, settings)
+    assert len(reloaded.text_embedding_cache) == 1
+    assert np.allclose(asyncio.run(reloaded.embed_text("a cat")), first)
+    assert reloaded.text_embedding_cache.stats().hits == 1
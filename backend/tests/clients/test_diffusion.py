@@ -1,8 +1,10 @@
 import pytest
+import torch
 from diffusers.utils.loading_utils import load_image
 from PIL import Image
 
 from api.clients import DiffusionClient
+from api.clients.diffusion import build_quantization_configs
 from tests.config import test_settings
 
 
@@ -36,3 +38,60 @@ def test_generate_image(diffusion_client, dummy_data):
     image = diffusion_client.generate_image(**dummy_data)
 
     assert isinstance(image, Image.Image)
+
+
+def test_generate_images(diffusion_client, dummy_data):
+    """複数のシードで画像がまとめて生成されるかテスト"""
+    params = {k: v for k, v in dummy_data.items() if k not in ("prompt", "seed")}
+    images = diffusion_client.generate_images(
+        prompts=[dummy_data["prompt"]] * 2, seeds=[1, 2], **params
+    )
+
+    assert len(images) == 2
+    assert all(isinstance(image, Image.Image) for image in images)
+
+
+def test_prompt_embedding_cache(diffusion_client, dummy_data):
+    """同じプロンプトの埋め込みがキャッシュから再利用されるかテスト"""
+    diffusion_client.prompt_embedding_cache.clear()
+    prompt_embeds, pooled_prompt_embeds = diffusion_client.encode_prompts(
+        [dummy_data["prompt"]]
+    )
+    cached_prompt_embeds, _ = diffusion_client.encode_prompts([dummy_data["prompt"]])
+
+    assert prompt_embeds.shape[0] == pooled_prompt_embeds.shape[0] == 1
+    assert cached_prompt_embeds is not None
+    assert diffusion_client.prompt_embedding_cache.stats().hits >= 1
+
+    # LoRAアダプタが異なる場合はキャッシュを使わずにエンコードし直す
+    misses = diffusion_client.prompt_embedding_cache.stats().misses
+    diffusion_client._active_adapter = "turbo"
+    diffusion_client.encode_prompts([dummy_data["prompt"]])
+    assert diffusion_client.prompt_embedding_cache.stats().misses == misses + 1
+
+
+def test_generate_with_offload(dummy_data):
+    """オフロードを有効にしても、ControlNetあり・なしのパイプラインを交互に使えるかテスト"""
+    client = DiffusionClient(
+        test_settings.model_copy(update={"DIFFUSION_OFFLOAD": "model"})
+    )
+    params = {**dummy_data, "num_inference_steps": 2}
+    without_control = {**params, "control_images": []}
+    for kwargs in (params, without_control, params, without_control):
+        assert isinstance(client.generate_image(**kwargs), Image.Image)
+
+    # どちらのパイプラインを使った後も、全モジュールにpipeのフックが付いている
+    hooked = [
+        component
+        for component in client.pipe.components.values()
+        if isinstance(component, torch.nn.Module)
+    ]
+    assert all(hasattr(component, "_hf_hook") for component in hooked)
+    assert len(client.pipe._all_hooks) == len(hooked)
+
+
+def test_build_quantization_configs():
+    """量子化しない場合は設定を作らず、未知の量子化はエラーになるかテスト"""
+    assert build_quantization_configs("none", torch.bfloat16) == (None, None)
+    with pytest.raises(ValueError):
+        build_quantization_configs("int3", torch.bfloat16)
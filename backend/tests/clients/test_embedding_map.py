@@ -0,0 +1,82 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from api.clients import EmbeddingMapClient
+from tests.config import test_settings
+
+
+@pytest.fixture
+def embedding_map_client():
+    # テスト用の埋め込みマップ
+    client = EmbeddingMapClient(test_settings)
+    yield client
+    if Path(test_settings.MAP_DIR).exists():
+        shutil.rmtree(test_settings.MAP_DIR)
+
+
+@pytest.fixture
+def dummy_data():
+    """テスト用のダミーデータを返す"""
+    rng = np.random.default_rng(0)
+    return {
+        "filenames": [f"{i}.png" for i in range(20)],
+        "embeddings": rng.normal(size=(20, test_settings.EMBEDDING_DIM)),
+    }
+
+
+def test_fit_and_reload(embedding_map_client, dummy_data):
+    """射影を学習して座標が保存され、再読み込みできるかテスト"""
+    client = embedding_map_client
+    assert not client.is_fitted
+
+    client.fit(dummy_data["filenames"], dummy_data["embeddings"])
+    filenames, coordinates, version = client.get_coordinates()
+    assert filenames == dummy_data["filenames"]
+    assert coordinates.shape == (20, 2)
+    assert coordinates.dtype == np.float32
+
+    reloaded = EmbeddingMapClient(test_settings)
+    assert reloaded.is_fitted
+    reloaded_filenames, reloaded_coordinates, reloaded_version = (
+        reloaded.get_coordinates()
+    )
+    assert reloaded_filenames == filenames
+    assert np.allclose(reloaded_coordinates, coordinates)
+    assert reloaded_version == version
+    assert np.allclose(reloaded.get_bounds(), client.get_bounds())
+
+
+def test_add_and_remove_points(embedding_map_client, dummy_data):
+    """学習し直さずに点を追加・削除できるかテスト"""
+    client = embedding_map_client
+    client.fit(dummy_data["filenames"], dummy_data["embeddings"])
+    _, coordinates, _ = client.get_coordinates()
+
+    # 既存の点と同じembeddingなら同じ位置に配置される
+    added = client.add_points(["new.png"], dummy_data["embeddings"][:1])
+    assert np.allclose(added[0], coordinates[0], atol=1e-4)
+    filenames, _, _ = client.get_coordinates()
+    assert filenames[-1] == "new.png"
+    assert len(filenames) == 21
+
+    removed = client.remove_points(["new.png", "0.png", "unknown.png"])
+    assert removed.shape == (2, 2)
+    filenames, coordinates, _ = client.get_coordinates()
+    assert len(filenames) == coordinates.shape[0] == 19
+    assert "0.png" not in filenames
+
+    # 追加・削除はログに追記され、再読み込みで同じ状態に戻る
+    snapshot = np.load(client.coordinates_path)
+    assert len(snapshot["filenames"]) == 20
+    reloaded = EmbeddingMapClient(test_settings)
+    assert reloaded.filenames == filenames
+    assert np.allclose(reloaded.coordinates, coordinates)
+    assert reloaded.version == client.version
+
+    # 学習し直すとnpzに書かれ、ログは捨てられる
+    client.fit(dummy_data["filenames"], dummy_data["embeddings"])
+    assert not client.log_path.exists()
+    assert EmbeddingMapClient(test_settings).filenames == dummy_data["filenames"]
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from api.clients import LazyClient
+
+
+class DummyClient:
+    def __init__(self):
+        self.value = 1
+
+    def double(self) -> int:
+        return self.value * 2
+
+
+def test_lazy_client():
+    """最初に使われたときに1回だけ作成され、属性がクライアントに渡されるかテスト"""
+    created = []
+
+    def factory():
+        created.append(1)
+        return DummyClient()
+
+    client = LazyClient("dummy", factory)
+    assert not client.loaded
+    assert not created
+
+    # 同時に使われても作成は1回だけ
+    threads = [threading.Thread(target=client.double) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert client.loaded
+    assert client.double() == 2
+    assert client.load_seconds is not None
+
+
+def test_lazy_client_error():
+    """作成に失敗した場合はエラーを記録し、次の利用時に再度作成を試みるかテスト"""
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("failed")
+        return DummyClient()
+
+    client = LazyClient("dummy", factory)
+    with pytest.raises(RuntimeError):
+        client.get()
+    assert client.error == "failed"
+    assert not client.loaded
+
+    assert client.value == 1
+    assert client.error is None
+    assert len(attempts) == 2
@@ -1,3 +1,4 @@
+import os
 import shutil
 from pathlib import Path
 
@@ -36,3 +37,66 @@ def test_save_and_delete_image(local_storage_client, dummy_data):
 
     is_deleted = local_storage_client.delete_image(dummy_data["image_filename"])
     assert is_deleted
+
+
+def test_load_control_image(local_storage_client):
+    """条件画像がリサイズされ、2回目以降はキャッシュから返るかテスト"""
+    image = local_storage_client.load_control_image("sample.png", 256, 384)
+    assert image.size == (256, 384)
+
+    cached_image = local_storage_client.load_control_image("sample.png", 256, 384)
+    assert cached_image is image
+    assert local_storage_client.control_image_cache.stats().hits == 1
+
+
+def test_control_image_cache_invalidated_on_update(tmp_path):
+    """条件画像が更新されたらキャッシュが使われないかテスト"""
+    settings = test_settings.model_copy(update={"CONDITION_IMAGE_DIR": str(tmp_path)})
+    client = LocalStorageClient(settings)
+    control_image_path = tmp_path / "control.png"
+
+    Image.new("RGB", (64, 64), color="black").save(control_image_path)
+    first = client.load_control_image("control.png", 64, 64)
+
+    # 更新時刻を進めて画像を差し替える
+    Image.new("RGB", (64, 64), color="white").save(control_image_path)
+    stat = control_image_path.stat()
+    os.utime(control_image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    second = client.load_control_image("control.png", 64, 64)
+
+    assert first.getpixel((0, 0)) == (0, 0, 0)
+    assert second.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_thumbnails(local_storage_client, dummy_data):
+    """保存時に各サイズのサムネイルが作られ、削除時に消えるかテスト"""
+    client = local_storage_client
+    client.save_image(**dummy_data)
+    for size in test_settings.THUMBNAIL_SIZES:
+        path = client.thumbnail_path(dummy_data["image_filename"], size)
+        with Image.open(path) as thumbnail:
+            assert max(thumbnail.size) == min(size, 512)
+            assert thumbnail.format == test_settings.THUMBNAIL_FORMAT.upper()
+    # 一時ファイルに書いてから置き換えるので、一時ファイルは残らない
+    assert not list(Path(test_settings.THUMBNAIL_DIR).rglob("*.tmp"))
+    assert not list(Path(client.image_dir).glob("*.tmp"))
+
+    client.delete_image(dummy_data["image_filename"])
+    assert not client.thumbnail_path(dummy_data["image_filename"], 128).exists()
+    shutil.rmtree(test_settings.THUMBNAIL_DIR)
+
+
+def test_backfill_thumbnails(local_storage_client, dummy_data):
+    """サムネイルのない画像だけにサムネイルが作られるかテスト"""
+    client = local_storage_client
+    dummy_data["image"].save(Path(client.image_dir) / "old.png")
+    client.save_image(**dummy_data)
+
+    created, failed = client.backfill_thumbnails(workers=2)
+    assert (created, failed) == (1, 0)
+    assert client.thumbnail_path("old.png", 256).exists()
+    assert client.backfill_thumbnails(workers=2) == (0, 0)
+
+    with pytest.raises(ValueError):
+        client.load_thumbnail_path("old.png", 100)
+    shutil.rmtree(test_settings.THUMBNAIL_DIR)
@@ -0,0 +1,74 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from api.clients import MapTileClient
+from tests.config import test_settings
+
+
+@pytest.fixture
+def map_tile_client():
+    # テスト用のタイルキャッシュ
+    client = MapTileClient(test_settings)
+    yield client
+    if Path(test_settings.MAP_DIR).exists():
+        shutil.rmtree(test_settings.MAP_DIR)
+
+
+@pytest.fixture
+def dummy_data():
+    """テスト用のダミーデータを返す"""
+    rng = np.random.default_rng(0)
+    return {
+        "filenames": [f"{i}.png" for i in range(100)],
+        "coordinates": rng.uniform(0, 1, size=(100, 2)).astype(np.float32),
+        "bounds": np.array([0.0, 0.0, 1.0, 1.0]),
+    }
+
+
+def test_build_tile(map_tile_client, dummy_data):
+    """タイル内の点がクラスタにまとめられるかテスト"""
+    client = map_tile_client
+    root = client.build_tile(0, 0, 0, **dummy_data)
+    assert root.count == 100
+    assert sum(cluster.count for cluster in root.clusters) == 100
+    assert len(root.clusters) <= client.grid_size**2
+
+    # 1段下のタイルの合計はルートと一致する
+    children = [
+        client.build_tile(1, x, y, **dummy_data) for x in (0, 1) for y in (0, 1)
+    ]
+    assert sum(tile.count for tile in children) == 100
+    for tile in children:
+        for cluster in tile.clusters:
+            assert cluster.image_filename in dummy_data["filenames"]
+
+    # 版を指定すると振り分けをズームレベルごとに使い回し、結果は同じになる
+    cached = [
+        client.build_tile(1, x, y, **dummy_data, version=1)
+        for x in (0, 1)
+        for y in (0, 1)
+    ]
+    assert cached == children
+    assert client._level_index[1][0] == 1
+    assert sum(len(indices) for indices in client._level_index[1][1].values()) == 100
+
+
+def test_invalidate(map_tile_client, dummy_data):
+    """変更された点を含むタイルだけ削除されるかテスト"""
+    client = map_tile_client
+    for x, y in [(0, 0), (1, 1)]:
+        client.save_tile(client.build_tile(1, x, y, **dummy_data))
+    client.save_tile(client.build_tile(0, 0, 0, **dummy_data))
+    assert client.load_tile(1, 0, 0) is not None
+
+    removed = client.invalidate(np.array([[0.25, 0.25]]), dummy_data["bounds"])
+    assert removed == 2
+    assert client.load_tile(0, 0, 0) is None
+    assert client.load_tile(1, 0, 0) is None
+    assert client.load_tile(1, 1, 1) is not None
+
+    with pytest.raises(ValueError):
+        client.validate(1, 2, 0)
@@ -0,0 +1,155 @@
+import shutil
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from api.clients import NumpyVectorStore, numpy_store as numpy_store_module
+from api.schema import SearchFilters
+from tests.config import test_settings
+
+
+@pytest.fixture
+def numpy_store():
+    # テスト用のNumPyバックエンド
+    store = NumpyVectorStore(test_settings)
+    yield store
+    if Path(test_settings.NUMPY_STORE_DIR).exists():
+        shutil.rmtree(test_settings.NUMPY_STORE_DIR)
+
+
+@pytest.fixture
+def dummy_data():
+    """テスト用のダミーデータを返す"""
+    rng = np.random.default_rng(0)
+    return {
+        "image_embeddings": rng.normal(size=(3, test_settings.EMBEDDING_DIM)),
+        "text_embeddings": rng.normal(size=(3, test_settings.EMBEDDING_DIM)),
+        "image_filenames": ["a.png", "b.png", "c.png"],
+        "prompts": ["a red cat", "a blue dog", "a red dog"],
+        "extra_payloads": [
+            {"seed": 1, "control_image_filenames": ["pose.png"]},
+            {"seed": 2, "control_image_filenames": ["pose.png", "depth.png"]},
+            {"seed": 1, "control_image_filenames": []},
+        ],
+    }
+
+
+def test_upload_and_search_points(numpy_store, dummy_data):
+    """登録したembeddingで検索すると自身が先頭に来るかテスト (バッチ検索も)"""
+    numpy_store.upload_points(**dummy_data)
+    results = numpy_store.search_points(dummy_data["image_embeddings"][1], topk=2)
+    assert results[0].image_filename == "b.png"
+    assert results[0].score == pytest.approx(1.0, abs=1e-3)
+    assert results[0].score >= results[1].score
+    assert len(results) == 2
+
+    batch_results = numpy_store.search_points_batch(
+        dummy_data["image_embeddings"], topk=1
+    )
+    assert [results[0].image_filename for results in batch_results] == [
+        "a.png",
+        "b.png",
+        "c.png",
+    ]
+
+
+def test_search_points_with_filters(numpy_store, dummy_data):
+    """Qdrantと同じ条件で絞り込めるかテスト"""
+    numpy_store.upload_points(**dummy_data)
+
+    def search(**kwargs) -> set[str]:
+        results = numpy_store.search_points(
+            dummy_data["image_embeddings"][0], topk=3, filters=SearchFilters(**kwargs)
+        )
+        return {result.image_filename for result in results}
+
+    assert search() == {"a.png", "b.png", "c.png"}
+    assert search(control_image_filename="pose.png") == {"a.png", "b.png"}
+    assert search(seed=1) == {"a.png", "c.png"}
+    assert search(prompt_contains="red") == {"a.png", "c.png"}
+    assert search(seed=1, prompt_contains="dog") == {"c.png"}
+    assert search(created_after=datetime.now(UTC) + timedelta(days=1)) == set()
+
+
+def test_hybrid_search_points(numpy_store, dummy_data):
+    """text embeddingのない行はテキストの候補に含まれないかテスト"""
+    numpy_store.upload_points(**dummy_data)
+    numpy_store.upload_points(
+        image_embeddings=dummy_data["image_embeddings"][:1],
+        text_embeddings=None,
+        image_filenames=["ingested.png"],
+        prompts=[""],
+    )
+    for fusion in ("rrf", "weighted"):
+        results = numpy_store.hybrid_search_points(
+            queries=[("text", dummy_data["text_embeddings"][2], 1.0)],
+            topk=4,
+            fusion=fusion,
+        )
+        filenames = [result.image_filename for result in results]
+        assert filenames[0] == "c.png"
+        assert "ingested.png" not in filenames
+
+
+def test_delete_and_reload(numpy_store, dummy_data):
+    """削除後も残りの行が正しく検索でき、再読み込みしても同じ結果になるかテスト"""
+    numpy_store.upload_points(**dummy_data)
+    numpy_store.delete_points(["a.png"])
+    # 変更のたびに版が増え、存在しないファイルの削除では増えない
+    assert numpy_store.version == 2
+    numpy_store.delete_points(["missing.png"])
+    assert numpy_store.version == 2
+    with pytest.raises(HTTPException):
+        numpy_store.delete_point("a.png")
+
+    reloaded = NumpyVectorStore(test_settings)
+    for store in (numpy_store, reloaded):
+        assert store.count == 2
+        results = store.search_points(dummy_data["image_embeddings"][2], topk=3)
+        assert results[0].image_filename == "c.png"
+        image_filenames, embeddings = store.scroll_embeddings("image")
+        assert sorted(image_filenames) == ["b.png", "c.png"]
+        assert embeddings.shape == (2, test_settings.EMBEDDING_DIM)
+        # 絞り込み用の列も移動・再読み込みされる
+        results = store.search_points(
+            dummy_data["image_embeddings"][2],
+            topk=3,
+            filters=SearchFilters(seed=2, created_before=datetime.now(UTC)),
+        )
+        assert [result.image_filename for result in results] == ["b.png"]
+
+
+def test_payload_log_compaction(numpy_store, dummy_data, monkeypatch):
+    """ペイロードのログは追記され、古い行が溜まると書き直されるかテスト"""
+    monkeypatch.setattr(numpy_store_module, "PAYLOAD_LOG_MIN_LINES", 4)
+    numpy_store.upload_points(**dummy_data)
+    numpy_store.upload_points(
+        **{key: value[:1] for key, value in dummy_data.items()}
+        | {"prompts": ["a green cat"]}
+    )
+    assert len(numpy_store.payloads_path.read_text().splitlines()) == 4
+
+    for _ in range(3):
+        numpy_store.upload_points(**dummy_data)
+    assert len(numpy_store.payloads_path.read_text().splitlines()) <= 6
+
+    reloaded = NumpyVectorStore(test_settings)
+    assert reloaded.payloads == numpy_store.payloads
+
+
+def test_retrieve_embeddings(numpy_store, dummy_data):
+    """指定した順に正規化済みのembeddingが取得でき、ないものは404になるかテスト"""
+    numpy_store.upload_points(**dummy_data)
+    embeddings = numpy_store.retrieve_embeddings(["c.png", "a.png"])
+    assert embeddings.shape == (2, test_settings.EMBEDDING_DIM)
+    assert embeddings.dtype == np.float32
+    expected = dummy_data["image_embeddings"][[2, 0]]
+    expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+    np.testing.assert_allclose(embeddings, expected, atol=1e-5)
+
+    with pytest.raises(HTTPException) as exc_info:
+        numpy_store.retrieve_embeddings(["a.png", "missing.png"])
+    assert exc_info.value.status_code == 404
@@ -0,0 +1,19 @@
+import pytest
+
+from api.clients import SAMPLING_PRESETS, get_sampling_preset
+
+
+def test_get_sampling_preset():
+    """有効なプリセットだけを取得でき、未知・無効なものはエラーになるかテスト"""
+    assert get_sampling_preset("turbo", ["default", "turbo"]).name == "turbo"
+    with pytest.raises(ValueError):
+        get_sampling_preset("turbo", ["default"])
+    with pytest.raises(ValueError):
+        get_sampling_preset("unknown", ["unknown"])
+
+
+def test_resolve():
+    """プリセットのステップ数・ガイダンスがリクエストより優先されるかテスト"""
+    assert SAMPLING_PRESETS["default"].resolve(30, 7.5) == (30, 7.5)
+    assert SAMPLING_PRESETS["turbo"].resolve(30, 7.5) == (8, 3.5)
+    assert SAMPLING_PRESETS["unipc"].resolve(30, 7.5) == (20, 7.5)
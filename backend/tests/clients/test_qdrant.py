@@ -1,11 +1,15 @@
 import shutil
+import uuid
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 
 import numpy as np
 import pytest
+from fastapi import HTTPException
+from qdrant_client.models import PointStruct
 
-from api.clients.qdrant import QdrantClientManager
-from api.schema import SimpleMetadata
+from api.clients.qdrant import QdrantClientManager, build_quantization_config
+from api.schema import SearchFilters, SimpleMetadata
 from tests.config import test_settings
 
 
@@ -51,6 +55,32 @@ def test_upload_and_search_point(qdrant_manager, dummy_data):
     assert isinstance(result, SimpleMetadata)
     assert result.image_filename == image_filename
     assert result.prompt == prompt
+    assert result.score == pytest.approx(1.0, abs=1e-3)
+
+
+def test_retrieve_embeddings(qdrant_manager):
+    """指定した順にembeddingが取得でき、ないものは404になるかテスト"""
+    manager = qdrant_manager
+    embeddings = np.random.rand(3, test_settings.EMBEDDING_DIM)
+    manager.upload_points(
+        image_embeddings=embeddings,
+        text_embeddings=None,
+        image_filenames=["a.png", "b.png", "c.png"],
+        prompts=["a", "b", "c"],
+    )
+
+    retrieved = manager.retrieve_embeddings(["c.png", "a.png"])
+    assert retrieved.shape == (2, test_settings.EMBEDDING_DIM)
+    assert retrieved.dtype == np.float32
+    # コサイン距離のコレクションは正規化して保存される
+    expected = embeddings[[2, 0]] / np.linalg.norm(
+        embeddings[[2, 0]], axis=1, keepdims=True
+    )
+    np.testing.assert_allclose(retrieved, expected, atol=1e-5)
+
+    with pytest.raises(HTTPException) as exc_info:
+        manager.retrieve_embeddings(["a.png", "missing.png"])
+    assert exc_info.value.status_code == 404
 
 
 def test_delete_point(qdrant_manager, dummy_data):
@@ -77,3 +107,210 @@ def test_delete_point(qdrant_manager, dummy_data):
     # 削除後の確認
     results = manager.search_points(query_embedding=embedding, topk=1)
     assert len(results) == 0
+
+
+def test_upload_points(qdrant_manager):
+    manager = qdrant_manager
+    embeddings = np.random.rand(3, test_settings.EMBEDDING_DIM)
+
+    # 画像のembeddingだけをまとめてアップロード
+    manager.upload_points(
+        image_embeddings=embeddings,
+        text_embeddings=None,
+        image_filenames=["a.png", "b.png", "c.png"],
+        prompts=["", "", ""],
+    )
+
+    results = manager.search_points(query_embedding=embeddings[1], topk=3)
+    assert len(results) == 3
+    assert results[0].image_filename == "b.png"
+
+
+def test_delete_points(qdrant_manager):
+    manager = qdrant_manager
+    embeddings = np.random.rand(3, test_settings.EMBEDDING_DIM)
+    manager.upload_points(
+        image_embeddings=embeddings,
+        text_embeddings=embeddings,
+        image_filenames=["a.png", "b.png", "c.png"],
+        prompts=["A", "B", "C"],
+    )
+
+    # 複数のポイントをまとめて削除 (存在しないものは無視される)
+    manager.delete_points(["a.png", "c.png", "unknown.png"])
+
+    results = manager.search_points(query_embedding=embeddings[0], topk=3)
+    assert [result.image_filename for result in results] == ["b.png"]
+    # 登録・削除のたびに版が増える
+    assert manager.version == 2
+
+
+def test_migrate_point_ids(qdrant_manager, dummy_data):
+    manager = qdrant_manager
+
+    # 旧形式 (ランダムなID) のポイントを直接登録する
+    manager.qdrant.upsert(
+        collection_name=manager.collection_name,
+        points=[
+            PointStruct(
+                id=str(uuid.uuid4()),
+                vector={
+                    "image": dummy_data["embedding"].tolist(),
+                    "text": dummy_data["embedding"].tolist(),
+                },
+                payload={
+                    "image_filename": dummy_data["image_filename"],
+                    "prompt": dummy_data["prompt"],
+                },
+            )
+        ],
+    )
+
+    assert manager.migrate_point_ids() == 1
+    assert manager.migrate_point_ids() == 0
+
+    # 移行後はファイル名から決まるIDで削除できる
+    manager.delete_point(image_filename=dummy_data["image_filename"])
+    results = manager.search_points(query_embedding=dummy_data["embedding"], topk=1)
+    assert len(results) == 0
+
+
+def test_backfill_payloads(qdrant_manager):
+    manager = qdrant_manager
+    embeddings = np.random.rand(1, test_settings.EMBEDDING_DIM)
+    # 絞り込み用のペイロードを持たない旧形式のポイント
+    manager.upload_points(
+        image_embeddings=embeddings,
+        text_embeddings=embeddings,
+        image_filenames=["a.png"],
+        prompts=["a"],
+    )
+    created_at = datetime(2024, 1, 1, tzinfo=UTC)
+
+    # コレクションにないポイントは数えない
+    assert (
+        manager.backfill_payloads(
+            [
+                ("a.png", created_at, 7, ["pose.png"]),
+                ("missing.png", created_at, None, []),
+            ]
+        )
+        == 1
+    )
+
+    def search(**kwargs) -> set[str]:
+        results = manager.search_points(
+            query_embedding=embeddings[0], topk=1, filters=SearchFilters(**kwargs)
+        )
+        return {result.image_filename for result in results}
+
+    assert search(seed=7) == {"a.png"}
+    assert search(control_image_filename="pose.png") == {"a.png"}
+    assert search(created_before=created_at + timedelta(days=1)) == {"a.png"}
+
+
+def test_search_points_with_filters(qdrant_manager):
+    manager = qdrant_manager
+    embeddings = np.random.rand(3, test_settings.EMBEDDING_DIM)
+    manager.upload_points(
+        image_embeddings=embeddings,
+        text_embeddings=embeddings,
+        image_filenames=["a.png", "b.png", "c.png"],
+        prompts=["a red cat", "a blue dog", "a red dog"],
+        extra_payloads=[
+            {"seed": 1, "control_image_filenames": ["pose.png"]},
+            {"seed": 2, "control_image_filenames": ["pose.png", "depth.png"]},
+            {"seed": 1, "control_image_filenames": []},
+        ],
+    )
+
+    def search(**kwargs) -> set[str]:
+        results = manager.search_points(
+            query_embedding=embeddings[0], topk=3, filters=SearchFilters(**kwargs)
+        )
+        return {result.image_filename for result in results}
+
+    assert search() == {"a.png", "b.png", "c.png"}
+    assert search(control_image_filename="pose.png") == {"a.png", "b.png"}
+    assert search(seed=1) == {"a.png", "c.png"}
+    assert search(prompt_contains="red") == {"a.png", "c.png"}
+    assert search(seed=1, prompt_contains="dog") == {"c.png"}
+    assert search(created_after=datetime.now(UTC) + timedelta(days=1)) == set()
+
+
+def test_hybrid_search_points(qdrant_manager):
+    manager = qdrant_manager
+    # 画像のembeddingは a > c > b、テキストのembeddingは b > c > a の順にクエリに近い
+    image_embeddings = np.zeros((3, test_settings.EMBEDDING_DIM))
+    image_embeddings[:, :2] = [[1.0, 0.0], [0.0, 1.0], [0.8, 0.6]]
+    text_embeddings = np.zeros((3, test_settings.EMBEDDING_DIM))
+    text_embeddings[:, 2:4] = [[0.0, 1.0], [1.0, 0.0], [0.6, 0.8]]
+    manager.upload_points(
+        image_embeddings=image_embeddings,
+        text_embeddings=text_embeddings,
+        image_filenames=["a.png", "b.png", "c.png"],
+        prompts=["a", "b", "c"],
+        extra_payloads=[{"seed": 1}, {"seed": 2}, {"seed": 1}],
+    )
+    queries = [("image", image_embeddings[0], 1.0), ("text", text_embeddings[1], 3.0)]
+
+    # RRFでは両方の候補が統合され、どちらかの1位が先頭に来る
+    results = manager.hybrid_search_points(queries=queries, topk=3, fusion="rrf")
+    assert {result.image_filename for result in results} == {"a.png", "b.png", "c.png"}
+    assert results[0].image_filename in {"a.png", "b.png"}
+
+    # 類似度の重み付き和では重みの大きいクエリに近い画像が先頭に来る
+    results = manager.hybrid_search_points(queries=queries, topk=3, fusion="weighted")
+    assert [result.image_filename for result in results] == ["b.png", "c.png", "a.png"]
+
+    for fusion in ("rrf", "weighted"):
+        filtered = manager.hybrid_search_points(
+            queries=queries, topk=3, filters=SearchFilters(seed=1), fusion=fusion
+        )
+        assert {result.image_filename for result in filtered} == {"a.png", "c.png"}
+
+    with pytest.raises(ValueError):
+        manager.hybrid_search_points(queries=[], topk=3)
+
+
+def test_collection_storage_settings():
+    settings = test_settings.model_copy(
+        update={
+            "COLLECTION_NAME": "quantized_embeddings",
+            "QDRANT_ON_DISK": True,
+            "QDRANT_QUANTIZATION": "scalar",
+            "QDRANT_HNSW_M": 32,
+        }
+    )
+    manager = QdrantClientManager(settings)
+    try:
+        vectors = manager.qdrant.get_collection(
+            settings.COLLECTION_NAME
+        ).config.params.vectors
+        for name in ("image", "text"):
+            assert vectors[name].on_disk
+            assert vectors[name].hnsw_config.m == 32
+            assert vectors[name].quantization_config.scalar is not None
+        # ローカルモードでは検索パラメータを渡さない
+        assert manager.search_params is None
+    finally:
+        manager.qdrant.close()
+        shutil.rmtree(test_settings.QDRANT_DB_PATH)
+
+    with pytest.raises(ValueError):
+        build_quantization_config("pq", always_ram=True)
+
+
+def test_diff_vectors_config(qdrant_manager):
+    """既存のコレクションと異なる設定だけが更新対象になるかテスト"""
+    manager = qdrant_manager
+    collection_info = manager.qdrant.get_collection(manager.collection_name)
+    assert manager._diff_vectors_config(collection_info) == {}
+
+    manager.hnsw_config = manager.hnsw_config.model_copy(update={"m": 32})
+    manager.quantization_config = build_quantization_config("scalar", True)
+    diffs = manager._diff_vectors_config(collection_info)
+    assert set(diffs) == {"image", "text"}
+    assert diffs["image"].hnsw_config.model_dump(exclude_none=True) == {"m": 32}
+    assert diffs["image"].quantization_config == manager.quantization_config
+    assert diffs["image"].on_disk is None
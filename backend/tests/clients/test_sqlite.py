@@ -1,7 +1,9 @@
 import os
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 
 import pytest
+from sqlalchemy import inspect, text
 
 from api.clients import SQLiteClient
 from tests.config import test_settings
@@ -12,7 +14,8 @@ def sql_client():
     # テスト用のSQLiteクライアント
     client = SQLiteClient(test_settings)
     yield client
-    # テスト後にDBを削除する
+    # 接続を閉じてからテスト後にDBを削除する
+    client.engine.dispose()
     if Path(test_settings.SQLITE_DB_PATH).exists:
         os.remove(test_settings.SQLITE_DB_PATH)
 
@@ -132,3 +135,229 @@ def test_delete_metadata(sql_client, dummy_data):
     # データ削除後に確認
     retrieved_metadata_list_after = client.retrieve_metadata_list()
     assert len(retrieved_metadata_list_after) == 0
+
+
+def test_job_lifecycle(sql_client):
+    client = sql_client
+
+    # ジョブを追加
+    job = client.enqueue_job(job_id="job1", params={"prompt": "A"}, total_steps=30)
+    assert job.status == "queued"
+    assert client.count_jobs_by_status() == {"queued": 1}
+
+    # ジョブを取り出すと実行中になる
+    claimed = client.claim_next_job()
+    assert claimed is not None
+    assert claimed.job_id == "job1"
+    assert claimed.status == "running"
+    assert claimed.params == {"prompt": "A"}
+    assert client.claim_next_job() is None
+
+    # 進捗を更新
+    assert client.update_job_progress("job1", 10) is False
+    assert client.retrieve_job("job1").current_step == 10
+
+    # 実行中のジョブはキャンセル要求のみ記録される
+    client.request_job_cancel("job1")
+    assert client.update_job_progress("job1", 11) is True
+
+    client.finish_job("job1", status="cancelled")
+    finished_jobs = client.retrieve_finished_jobs(limit=10)
+    assert [job.job_id for job in finished_jobs] == ["job1"]
+    assert finished_jobs[0].status == "cancelled"
+
+
+def test_cancel_queued_job(sql_client):
+    client = sql_client
+
+    client.enqueue_job(job_id="job1", params={}, total_steps=30)
+    cancelled = client.request_job_cancel("job1")
+    assert cancelled.status == "cancelled"
+    assert client.claim_next_job() is None
+    assert client.request_job_cancel("unknown") is None
+
+
+def test_requeue_running_jobs(sql_client):
+    client = sql_client
+
+    client.enqueue_job(job_id="job1", params={}, total_steps=30)
+    client.claim_next_job()
+    client.update_job_progress("job1", 5)
+
+    # 再起動時に実行中のジョブは待機中に戻る
+    assert client.requeue_running_jobs() == 1
+    job = client.retrieve_job("job1")
+    assert job.status == "queued"
+    assert job.current_step == 0
+
+
+def test_bulk_upload_metadata(sql_client, dummy_data):
+    client = sql_client
+
+    # まとめてアップロード
+    client.bulk_upload_metadata(
+        [
+            {"image_filename": "a.png", "prompt": "", "width": 64, "height": 64},
+            {"image_filename": "b.png", "prompt": "B", "width": 32, "height": 32},
+        ]
+    )
+    client.upload_metadata(**dummy_data)
+
+    assert len(client.retrieve_metadata_list()) == 3
+    assert client.retrieve_existing_filenames(["a.png", "b.png", "c.png"]) == {
+        "a.png",
+        "b.png",
+    }
+
+
+def test_delete_metadata_list(sql_client, dummy_data):
+    client = sql_client
+
+    client.bulk_upload_metadata(
+        [
+            {"image_filename": name, "prompt": "", "width": 64, "height": 64}
+            for name in ["a.png", "b.png", "c.png"]
+        ]
+    )
+
+    # 複数のメタデータをまとめて削除
+    client.delete_metadata_list(["a.png", "c.png"])
+
+    remaining = client.retrieve_metadata_list()
+    assert [metadata.image_filename for metadata in remaining] == ["b.png"]
+
+
+def test_retrieve_simple_metadata_page(sql_client):
+    client = sql_client
+
+    client.bulk_upload_metadata(
+        [
+            {"image_filename": f"{i}.png", "prompt": f"P{i}", "width": 64, "height": 64}
+            for i in range(5)
+        ]
+    )
+
+    # カーソルを使って新しい順に2件ずつ取得する
+    pages = []
+    cursor = None
+    while True:
+        rows = client.retrieve_simple_metadata_page(limit=2, cursor=cursor)
+        if not rows:
+            break
+        pages.append([image_filename for image_filename, _, _ in rows])
+        image_filename, _, created_at = rows[-1]
+        cursor = (created_at, image_filename)
+
+    assert pages == [["4.png", "3.png"], ["2.png", "1.png"], ["0.png"]]
+
+    # limitを指定しない場合は全件取得
+    rows = client.retrieve_simple_metadata_page()
+    assert [prompt for _, prompt, _ in rows] == ["P4", "P3", "P2", "P1", "P0"]
+
+
+def test_pragmas(sql_client):
+    """接続ごとにWALなどの設定が反映されているかテスト"""
+    with sql_client.engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        synchronous = connection.exec_driver_sql("PRAGMA synchronous").scalar()
+    assert journal_mode == test_settings.SQLITE_JOURNAL_MODE.lower()
+    assert synchronous == 1  # NORMAL
+
+
+def test_unit_of_work(sql_client, dummy_data):
+    """unit_of_work内の操作がまとめてコミット・ロールバックされるかテスト"""
+    with sql_client.unit_of_work() as session:
+        sql_client.upload_metadata(**dummy_data, session=session)
+        sql_client.bulk_upload_metadata(
+            [{"image_filename": "bulk.png", "prompt": "bulk"}], session=session
+        )
+    assert sql_client.retrieve_existing_filenames(["test.png", "bulk.png"]) == {
+        "test.png",
+        "bulk.png",
+    }
+
+    with pytest.raises(RuntimeError):
+        with sql_client.unit_of_work() as session:
+            sql_client.delete_metadata_list(["test.png", "bulk.png"], session=session)
+            raise RuntimeError("rollback")
+    assert len(sql_client.retrieve_existing_filenames(["test.png", "bulk.png"])) == 2
+
+
+def test_migrate_adds_columns(sql_client):
+    """後から追加したカラムが既存のテーブルに追加されるかテスト"""
+    client = sql_client
+    with client.engine.begin() as connection:
+        connection.execute(text("ALTER TABLE image_metadata DROP COLUMN preset"))
+
+    client._migrate()
+    columns = {
+        column["name"]
+        for column in inspect(client.engine).get_columns("image_metadata")
+    }
+    assert "preset" in columns
+
+
+def test_retrieve_generation_latencies(sql_client, dummy_data):
+    """プリセットごとに直近の生成時間が新しい順に取得できるかテスト"""
+    client = sql_client
+    client.bulk_upload_metadata(
+        [
+            dummy_data
+            | {
+                "image_filename": f"{i}.png",
+                "preset": "turbo" if i % 2 else "default",
+                "generation_seconds": float(i),
+                "created_at": datetime(2025, 1, 1, tzinfo=UTC) + timedelta(minutes=i),
+            }
+            for i in range(5)
+        ]
+        # 取り込んだ画像 (プリセットなし) は集計に含めない
+        + [dummy_data | {"image_filename": "ingested.png"}]
+    )
+
+    latencies = client.retrieve_generation_latencies(limit=2)
+    assert latencies == {
+        "default": [(4.0, 30), (2.0, 30)],
+        "turbo": [(3.0, 30), (1.0, 30)],
+    }
+
+
+def test_control_images_column(sql_client, dummy_data):
+    """3つ目以降の条件画像がJSONとして保存・取得できるかテスト"""
+    client = sql_client
+    control_images = [
+        {"filename": "cond3.png", "conditioning_scale": 0.4, "guidance_end": 0.7}
+    ]
+    client.upload_metadata(**dummy_data, control_images=control_images)
+
+    (retrieved_metadata,) = client.retrieve_metadata_list()
+    assert retrieved_metadata.control_images == control_images
+
+
+def test_retrieve_filter_fields(sql_client, dummy_data):
+    """検索の絞り込みに使う項目がまとめて取得できるかテスト"""
+    client = sql_client
+    control_images = [
+        {"filename": "cond3.png", "conditioning_scale": 0.4, "guidance_end": 0.7}
+    ]
+    client.upload_metadata(**dummy_data, control_images=control_images)
+
+    ((image_filename, created_at, seed, control_image_filenames),) = list(
+        client.retrieve_filter_fields()
+    )
+    assert image_filename == dummy_data["image_filename"]
+    assert created_at.tzinfo is not None
+    assert seed == dummy_data["seed"]
+    assert control_image_filenames == ["cond1.png", "cond2.png", "cond3.png"]
+
+
+def test_retrieve_simple_metadata_by_fingerprints(sql_client, dummy_data):
+    """フィンガープリントから生成済みの画像が引けるかテスト"""
+    client = sql_client
+    client.upload_metadata(**dummy_data, fingerprint="abc")
+    client.upload_metadata(
+        **dummy_data | {"image_filename": "other.png"}, fingerprint="def"
+    )
+
+    found = client.retrieve_simple_metadata_by_fingerprints(["abc", "missing"])
+    assert found == {"abc": (dummy_data["image_filename"], dummy_data["prompt"])}
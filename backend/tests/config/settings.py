@@ -17,6 +17,15 @@ class TestSettings(Settings):
     QDRANT_DB_PATH: str = str(
         Path(__file__).resolve().parents[1] / "test_data" / "test_embeddings.db"
     )
+    MAP_DIR: str = str(
+        Path(__file__).resolve().parents[1] / "test_data" / "test_embedding_map"
+    )
+    THUMBNAIL_DIR: str = str(
+        Path(__file__).resolve().parents[1] / "test_data" / "thumbnails"
+    )
+    NUMPY_STORE_DIR: str = str(
+        Path(__file__).resolve().parents[1] / "test_data" / "test_embeddings_npy"
+    )
 
 
 # テスト用シングルトン
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+import httpx
+import numpy as np
+import pytest
+from PIL import Image
+
+from api.config.settings import settings
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    """テスト用のディレクトリを使うようにしてからアプリを読み込む"""
+    data_dir = tmp_path_factory.mktemp("data")
+    for name, value in {
+        "IMAGE_DIR": data_dir / "generated_images",
+        "CONDITION_IMAGE_DIR": data_dir / "control_images",
+        "SQLITE_DB_PATH": data_dir / "metadata.db",
+        "MAP_DIR": data_dir / "embedding_map",
+        "THUMBNAIL_DIR": data_dir / "thumbnails",
+        "NUMPY_STORE_DIR": data_dir / "embeddings_npy",
+    }.items():
+        setattr(settings, name, str(value))
+    settings.VECTOR_BACKEND = "numpy"
+    # サービスは最初に参照されたときに上の設定で初期化される
+    from api.main import app
+
+    return app
+
+
+def request_concurrently(app, *requests):
+    """イベントループ上で複数のリクエストを同時に送り、レスポンスを返す"""
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(*(request(client) for request in requests))
+
+    return asyncio.run(main())
+
+
+def test_thumbnail_generated_off_event_loop(app, monkeypatch):
+    """未作成のサムネイルの作成中も、他のリクエストが処理されるかテスト"""
+    from api.service import image_service
+
+    local_storage_client = image_service.local_storage_client
+    Image.new("RGB", (640, 480), "red").save(
+        Path(local_storage_client.image_dir) / "a.png"
+    )
+    started = threading.Event()
+    release = threading.Event()
+    waited: list[bool] = []
+    load_thumbnail_path = local_storage_client.load_thumbnail_path
+
+    def slow_load_thumbnail_path(image_filename: str, size: int) -> Path:
+        started.set()
+        # イベントループがブロックされていると、releaseされずにタイムアウトする
+        waited.append(release.wait(timeout=5))
+        return load_thumbnail_path(image_filename, size)
+
+    monkeypatch.setattr(
+        local_storage_client, "load_thumbnail_path", slow_load_thumbnail_path
+    )
+
+    async def fetch_thumbnail(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.get("/api/image/thumbnail/128/a.png")
+
+    async def fetch_stats_then_release(client: httpx.AsyncClient) -> httpx.Response:
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        response = await client.get("/api/image/cache-stats")
+        release.set()
+        return response
+
+    thumbnail, stats = request_concurrently(
+        app, fetch_thumbnail, fetch_stats_then_release
+    )
+    assert stats.status_code == 200
+    assert thumbnail.status_code == 200
+    assert thumbnail.headers["content-type"] == "image/webp"
+    assert waited == [True]
+    assert local_storage_client.thumbnail_path("a.png", 128).exists()
+
+
+def test_delete_during_tile_build(app, monkeypatch):
+    """タイルの計算中に削除しても、他のリクエストが処理されるかテスト"""
+    from api.service import image_service, map_service
+
+    image_service.sqlite_client.bulk_upload_metadata(
+        [
+            {"image_filename": name, "prompt": "", "width": 8, "height": 8}
+            for name in ("b.png", "c.png", "d.png")
+        ]
+    )
+    map_service.embedding_map_client.fit(
+        ["b.png", "c.png", "d.png"],
+        np.random.default_rng(0).normal(size=(3, settings.EMBEDDING_DIM)),
+    )
+    map_tile_client = map_service.map_tile_client
+    invalidating = threading.Event()
+    invalidate = map_tile_client.invalidate
+
+    def watched_invalidate(*args, **kwargs):
+        invalidating.set()
+        return invalidate(*args, **kwargs)
+
+    monkeypatch.setattr(map_tile_client, "invalidate", watched_invalidate)
+
+    # タイルの計算中と同じくロックを保持する (ブロックされた場合に備えて5秒後に必ず解放する)
+    lock = map_tile_client.level_lock(0)
+    lock.acquire()
+    released = threading.Event()
+    released_by_timer: list[bool] = []
+
+    def release(by_timer: bool):
+        if not released.is_set():
+            released.set()
+            released_by_timer.append(by_timer)
+            lock.release()
+
+    timer = threading.Timer(5, release, args=(True,))
+    timer.start()
+
+    async def delete(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.request(
+            "DELETE", "/api/image/delete", json={"image_filenames": ["b.png"]}
+        )
+
+    async def fetch_stats_then_release(client: httpx.AsyncClient) -> httpx.Response:
+        while not invalidating.is_set():
+            await asyncio.sleep(0.01)
+        response = await client.get("/api/image/cache-stats")
+        release(by_timer=False)
+        return response
+
+    deleted, stats = request_concurrently(app, delete, fetch_stats_then_release)
+    timer.cancel()
+    assert stats.status_code == 200
+    assert deleted.status_code == 200
+    assert deleted.json()["deleted_filenames"] == ["b.png"]
+    assert released_by_timer == [False]
+
+
+def test_unsaved_images(app, monkeypatch):
+    """保存に失敗した画像は、削除では失敗として返し、サムネイルは409を返すかテスト"""
+    from api.service import image_service
+
+    persistence_writer = image_service.persistence_writer
+    failed: Future[None] = Future()
+    failed.set_exception(ConnectionError("vector store unavailable"))
+    monkeypatch.setitem(persistence_writer._pending, "e.png", failed)
+
+    async def delete(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.request(
+            "DELETE", "/api/image/delete", json={"image_filenames": ["e.png"]}
+        )
+
+    async def fetch_thumbnail(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.get("/api/image/thumbnail/128/e.png")
+
+    deleted, thumbnail = request_concurrently(app, delete, fetch_thumbnail)
+    assert deleted.status_code == 200
+    assert deleted.json()["status"] == "partial"
+    assert deleted.json()["failed_filenames"] == ["e.png"]
+    assert thumbnail.status_code == 409
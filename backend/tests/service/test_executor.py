@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import threading
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from api.clients import CLIPBatcher
+from api.service.executor import InferenceExecutor
+from tests.config import test_settings
+
+
+@pytest.fixture
+def inference_executor():
+    # 1ワーカー + 待機1件のレーン
+    executor = InferenceExecutor(
+        test_settings.model_copy(
+            update={
+                "DIFFUSION_WORKERS": 1,
+                "DIFFUSION_MAX_QUEUE": 1,
+                "CLIP_WORKERS": 1,
+                "CLIP_MAX_QUEUE": 1,
+            }
+        )
+    )
+    yield executor
+    executor.shutdown()
+
+
+class StubCLIPClient:
+    def generate_text_embeddings(self, texts: list[str]) -> np.ndarray:
+        return np.ones((len(texts), test_settings.EMBEDDING_DIM), dtype=np.float32)
+
+
+def fill_lane(inference_executor: InferenceExecutor, lane: str) -> threading.Event:
+    """実行中1件 + 待機1件でレーンを埋め、解放用のイベントを返す"""
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=5)
+
+    inference_executor.submit(lane, block)
+    assert started.wait(timeout=5)
+    inference_executor.submit(lane, block)
+    return release
+
+
+def test_lane_limit(inference_executor):
+    """ワーカー数 + 待機数を超えると503になり、完了すると再び受け付けるかテスト"""
+    release = fill_lane(inference_executor, "diffusion")
+    with pytest.raises(HTTPException) as exc_info:
+        inference_executor.submit("diffusion", lambda: None)
+    assert exc_info.value.status_code == 503
+
+    # 別のレーンは埋まっていない
+    assert inference_executor.submit("clip", lambda: 1).result(timeout=5) == 1
+
+    release.set()
+    # blockを指定すると空きが出るまで待つ
+    future = inference_executor.submit("diffusion", lambda: 2, block=True)
+    assert future.result(timeout=5) == 2
+
+
+def test_run(inference_executor):
+    """イベントループから結果を待てるかテスト"""
+
+    async def main():
+        return await inference_executor.run("clip", lambda x: x * 2, 21)
+
+    assert asyncio.run(main()) == 42
+
+
+def test_clip_batcher_uses_lane(inference_executor):
+    """CLIPのバッチ推論もレーンの上限に従うかテスト"""
+    batcher = CLIPBatcher(
+        StubCLIPClient(),  # type: ignore
+        test_settings,
+        submit=functools.partial(inference_executor.submit, "clip"),
+    )
+    release = fill_lane(inference_executor, "clip")
+
+    async def embed():
+        return await batcher.embed_text("a cat")
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(embed())
+    assert exc_info.value.status_code == 503
+
+    release.set()
+    # 空いたスロットが戻るまで待ってから再投入する
+    inference_executor.submit("clip", lambda: None, block=True).result(timeout=5)
+    assert asyncio.run(embed()).shape == (test_settings.EMBEDDING_DIM,)
+
+
+def test_shutdown(inference_executor):
+    """停止すると待機中のタスクは取り消され、新しいタスクは受け付けないかテスト"""
+    release = threading.Event()
+    inference_executor.submit("diffusion", release.wait, 5)
+    queued = inference_executor.submit("diffusion", lambda: None)
+    inference_executor.shutdown()
+    release.set()
+    assert queued.cancelled()
+    with pytest.raises(RuntimeError):
+        inference_executor.submit("diffusion", lambda: None)
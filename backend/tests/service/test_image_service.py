@@ -0,0 +1,245 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from api.service.executor import InferenceExecutor
+from api.service.image import GenerationCancelledError, ImageService
+from tests.config import test_settings
+
+
+class StubDiffusionClient:
+    """呼び出しを記録し、releaseされるまで生成を止められる拡散モデル"""
+
+    def __init__(self):
+        self.calls: list[list[str]] = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.error: Exception | None = None
+
+    def generate_images(
+        self, prompts: list[str], step_callback=None, **kwargs
+    ) -> list[Image.Image]:
+        self.calls.append(list(prompts))
+        self.started.set()
+        self.release.wait(timeout=5)
+        if self.error is not None:
+            raise self.error
+        if step_callback is not None:
+            step_callback(1, 1)
+        return [Image.new("RGB", (8, 8)) for _ in prompts]
+
+
+class StubCLIPClient:
+    def generate_image_embeddings(self, images: list) -> np.ndarray:
+        return np.zeros((len(images), test_settings.EMBEDDING_DIM), dtype=np.float32)
+
+    def generate_text_embeddings(self, texts: list[str]) -> np.ndarray:
+        return np.zeros((len(texts), test_settings.EMBEDDING_DIM), dtype=np.float32)
+
+
+class StubSQLiteClient:
+    """フィンガープリント -> (ファイル名, プロンプト) だけを持つ"""
+
+    def __init__(self):
+        self.generated: dict[str, tuple[str, str]] = {}
+
+    def retrieve_simple_metadata_by_fingerprints(
+        self, fingerprints: list[str]
+    ) -> dict[str, tuple[str, str]]:
+        return {
+            fingerprint: self.generated[fingerprint]
+            for fingerprint in fingerprints
+            if fingerprint in self.generated
+        }
+
+
+class StubPersistenceWriter:
+    """保存を即座に完了させ、SQLiteのスタブに登録する"""
+
+    durable_default = True
+
+    def __init__(self, sqlite_client: StubSQLiteClient):
+        self.sqlite_client = sqlite_client
+
+    def submit(self, records: list) -> Future[None]:
+        for record in records:
+            self.sqlite_client.generated[record.metadata["fingerprint"]] = (
+                record.image_filename,
+                record.prompt,
+            )
+        future: Future[None] = Future()
+        future.set_result(None)
+        return future
+
+    def wait_for(self, image_filenames: list[str], timeout: float | None = None):
+        pass
+
+
+class WatchedDict(dict):
+    """値を読まれたこと (生成中のリクエストへの相乗り) を通知する辞書"""
+
+    def __init__(self):
+        super().__init__()
+        self.read = threading.Event()
+
+    def __getitem__(self, key):
+        self.read.set()
+        return super().__getitem__(key)
+
+
+@pytest.fixture
+def diffusion_client():
+    return StubDiffusionClient()
+
+
+@pytest.fixture
+def make_service(diffusion_client):
+    executors = []
+
+    def make(settings=test_settings) -> ImageService:
+        sqlite_client = StubSQLiteClient()
+        inference_executor = InferenceExecutor(settings)
+        executors.append(inference_executor)
+        service = ImageService(
+            diffusion_client=diffusion_client,  # type: ignore
+            clip_client=StubCLIPClient(),  # type: ignore
+            qdrant_client=SimpleNamespace(version=0),  # type: ignore
+            sqlite_client=sqlite_client,  # type: ignore
+            local_storage_client=SimpleNamespace(image_format="png"),  # type: ignore
+            map_service=None,  # type: ignore
+            persistence_writer=StubPersistenceWriter(sqlite_client),  # type: ignore
+            inference_executor=inference_executor,
+            settings=settings,
+        )
+        service._in_flight = WatchedDict()
+        return service
+
+    yield make
+    for inference_executor in executors:
+        inference_executor.shutdown()
+
+
+def generate(service: ImageService, **kwargs):
+    """条件画像なしで1枚生成する"""
+    return service.generate_and_save_image(
+        **{
+            "prompt": "a cat",
+            "width": 64,
+            "height": 64,
+            "control_image_filename_1": None,
+            "control_image_filename_2": None,
+            "controlnet_conditioning_scale_1": None,
+            "controlnet_conditioning_scale_2": None,
+            "control_guidance_end_1": None,
+            "control_guidance_end_2": None,
+            "num_inference_steps": 4,
+            "guidance_scale": 1.0,
+            "seed": 1,
+        }
+        | kwargs
+    )
+
+
+def test_reuse_existing_image(make_service, diffusion_client):
+    """同じ条件で生成済みの画像は生成せずに返すかテスト"""
+    service = make_service()
+    first = generate(service)
+    second = generate(service)
+    assert second == first
+    assert len(diffusion_client.calls) == 1
+
+    # 条件が異なれば生成する
+    assert generate(service, seed=2) != first
+    assert len(diffusion_client.calls) == 2
+
+
+def test_coalesce_concurrent_requests(make_service, diffusion_client):
+    """生成中の同じリクエストは相乗りし、パイプラインを1回だけ呼ぶかテスト"""
+    service = make_service()
+    diffusion_client.release.clear()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        owner = pool.submit(generate, service)
+        assert diffusion_client.started.wait(timeout=5)
+        waiter = pool.submit(generate, service)
+        assert service._in_flight.read.wait(timeout=5)
+        diffusion_client.release.set()
+        assert owner.result(timeout=5) == waiter.result(timeout=5)
+    assert len(diffusion_client.calls) == 1
+    assert not service._in_flight
+
+
+def test_failure_propagates_to_waiters(make_service, diffusion_client):
+    """生成に失敗したら相乗りしたリクエストにも伝わり、生成中の一覧から外れるかテスト"""
+    service = make_service()
+    diffusion_client.release.clear()
+    diffusion_client.error = RuntimeError("out of memory")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        owner = pool.submit(generate, service)
+        assert diffusion_client.started.wait(timeout=5)
+        waiter = pool.submit(generate, service)
+        assert service._in_flight.read.wait(timeout=5)
+        diffusion_client.release.set()
+        for future in (owner, waiter):
+            with pytest.raises(RuntimeError, match="out of memory"):
+                future.result(timeout=5)
+    assert not service._in_flight
+
+    # 失敗した条件は次のリクエストで生成し直す
+    diffusion_client.error = None
+    generate(service)
+    assert len(diffusion_client.calls) == 2
+
+
+def test_cancelled_owner(make_service, diffusion_client):
+    """生成を担当したリクエストが中断されたら、相乗りしたリクエストが自分で生成するかテスト"""
+    service = make_service()
+    diffusion_client.release.clear()
+
+    def cancel(current_step: int, total_steps: int):
+        raise GenerationCancelledError("cancelled")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        owner = pool.submit(generate, service, step_callback=cancel)
+        assert diffusion_client.started.wait(timeout=5)
+        waiter = pool.submit(generate, service)
+        assert service._in_flight.read.wait(timeout=5)
+        diffusion_client.release.set()
+        with pytest.raises(GenerationCancelledError):
+            owner.result(timeout=5)
+        result = waiter.result(timeout=5)
+    assert result.prompt == "a cat"
+    assert len(diffusion_client.calls) == 2
+    assert not service._in_flight
+
+
+def test_reuse_disabled(make_service, diffusion_client):
+    """reuse_existing=Falseなら生成済みの画像があっても生成し直すかテスト"""
+    service = make_service()
+    first = generate(service)
+    second = generate(service, reuse_existing=False)
+    assert second.image_filename != first.image_filename
+    assert len(diffusion_client.calls) == 2
+    assert not service._in_flight.read.is_set()
+
+
+def test_wait_timeout(make_service, diffusion_client):
+    """生成中のリクエストを待ちきれない場合は503を返すかテスト"""
+    service = make_service(
+        test_settings.model_copy(update={"GENERATION_REUSE_WAIT_TIMEOUT_SECONDS": 0.05})
+    )
+    diffusion_client.release.clear()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        owner = pool.submit(generate, service)
+        assert diffusion_client.started.wait(timeout=5)
+        with pytest.raises(HTTPException) as exc_info:
+            generate(service)
+        assert exc_info.value.status_code == 503
+        diffusion_client.release.set()
+        owner.result(timeout=5)
+    assert len(diffusion_client.calls) == 1
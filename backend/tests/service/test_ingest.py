@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from api.clients import LocalStorageClient, SQLiteClient
+from api.service.ingest import IngestService
+from tests.config import test_settings
+
+
+class StubCLIPClient:
+    def generate_image_embeddings(self, images: list) -> np.ndarray:
+        return np.ones((len(images), test_settings.EMBEDDING_DIM), dtype=np.float32)
+
+
+class FailingVectorStore:
+    """1バッチ目だけアップロードしてから失敗する"""
+
+    def __init__(self):
+        self.points: set[str] = set()
+
+    def upload_points(self, image_filenames: list[str], **kwargs):
+        self.points.update(image_filenames[:1])
+        raise ConnectionError("vector store unavailable")
+
+    def delete_points(self, image_filenames: list[str]):
+        self.points.difference_update(image_filenames)
+
+
+class StubMapService:
+    def __init__(self):
+        self.added: list[str] = []
+
+    def add_images(self, image_filenames: list[str], embeddings: np.ndarray):
+        self.added.extend(image_filenames)
+
+
+@pytest.fixture
+def ingest_service(tmp_path):
+    settings = test_settings.model_copy(
+        update={
+            "IMAGE_DIR": str(tmp_path / "images"),
+            "CONDITION_IMAGE_DIR": str(tmp_path / "control_images"),
+            "THUMBNAIL_DIR": str(tmp_path / "thumbnails"),
+            "SQLITE_DB_PATH": str(tmp_path / "metadata.db"),
+        }
+    )
+    sqlite_client = SQLiteClient(settings)
+    yield IngestService(
+        clip_client=StubCLIPClient(),  # type: ignore
+        qdrant_client=FailingVectorStore(),  # type: ignore
+        sqlite_client=sqlite_client,
+        local_storage_client=LocalStorageClient(settings),
+        map_service=StubMapService(),  # type: ignore
+        settings=settings,
+    )
+    sqlite_client.engine.dispose()
+
+
+def test_failed_upload_leaves_no_records(ingest_service, tmp_path):
+    """Qdrantへの登録に失敗したら、SQLite・Qdrantのどちらにも残らないかテスト"""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for name in ("a.png", "b.png"):
+        Image.new("RGB", (8, 8)).save(source_dir / name)
+
+    with pytest.raises(ConnectionError):
+        ingest_service.ingest_directory(str(source_dir))
+    assert (
+        ingest_service.sqlite_client.retrieve_existing_filenames(["a.png", "b.png"])
+        == set()
+    )
+    assert ingest_service.qdrant_client.points == set()
+    assert ingest_service.map_service.added == []
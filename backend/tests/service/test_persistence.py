@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from api.service.persistence import GeneratedImageRecord, PersistenceWriter
+from tests.config import test_settings
+
+
+class StubLocalStorageClient:
+    def __init__(self):
+        self.saved: list[str] = []
+
+    def save_image(self, image: Image.Image, image_filename: str):
+        self.saved.append(image_filename)
+
+
+class StubSQLiteClient:
+    @contextmanager
+    def unit_of_work(self):
+        yield None
+
+    def bulk_upload_metadata(self, metadata_list: list[dict], session=None):
+        pass
+
+
+class FlakyVectorStore:
+    """指定した回数だけ登録に失敗する"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.uploaded: list[str] = []
+
+    def upload_points(self, image_filenames: list[str], **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("vector store unavailable")
+        self.uploaded.extend(image_filenames)
+
+
+class StubMapService:
+    def add_images(self, image_filenames: list[str], embeddings: np.ndarray):
+        pass
+
+
+@pytest.fixture
+def make_writer():
+    writers = []
+
+    def make(failures: int) -> PersistenceWriter:
+        writer = PersistenceWriter(
+            local_storage_client=StubLocalStorageClient(),  # type: ignore
+            qdrant_client=FlakyVectorStore(failures),  # type: ignore
+            sqlite_client=StubSQLiteClient(),  # type: ignore
+            map_service=StubMapService(),  # type: ignore
+            settings=test_settings.model_copy(
+                update={"PERSIST_MAX_RETRIES": 2, "PERSIST_RETRY_BACKOFF_SECONDS": 0.0}
+            ),
+        )
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.shutdown()
+
+
+def make_record(image_filename: str) -> GeneratedImageRecord:
+    embedding = np.zeros(test_settings.EMBEDDING_DIM, dtype=np.float32)
+    return GeneratedImageRecord(
+        image=Image.new("RGB", (8, 8)),
+        image_filename=image_filename,
+        image_embedding=embedding,
+        text_embedding=embedding,
+        prompt="a cat",
+        metadata={},
+    )
+
+
+def test_retry_transient_failure(make_writer):
+    """一時的な失敗は再試行され、成功した段階はやり直さないかテスト"""
+    writer = make_writer(failures=2)
+    writer.submit([make_record("a.png")]).result(timeout=5)
+
+    # 完了時のコールバックが終わるまで待つ
+    writer.shutdown()
+    assert writer.qdrant_client.uploaded == ["a.png"]
+    assert writer.local_storage_client.saved == ["a.png"]
+    stats = writer.stats()
+    assert (stats.pending, stats.succeeded, stats.retried, stats.failed) == (
+        0,
+        1,
+        2,
+        0,
+    )
+    assert stats.recent_failures == []
+
+
+def test_record_permanent_failure(make_writer):
+    """再試行しても失敗した書き込みは例外を伝え、統計に残るかテスト"""
+    writer = make_writer(failures=10)
+    future = writer.submit([make_record("a.png"), make_record("b.png")])
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5)
+
+    writer.shutdown()
+    stats = writer.stats()
+    assert (stats.pending, stats.succeeded, stats.retried, stats.failed) == (
+        0,
+        0,
+        2,
+        2,
+    )
+    (failure,) = stats.recent_failures
+    assert failure.image_filenames == ["a.png", "b.png"]
+    assert "vector store unavailable" in failure.error
+
+
+def test_wait_for_each_reports_failures(make_writer):
+    """書き込みに失敗した画像は例外ではなくファイル名で返すかテスト"""
+    writer = make_writer(failures=10)
+    writer.submit([make_record("a.png"), make_record("b.png")])
+    assert writer.wait_for_each(["a.png", "c.png"], timeout=5) == {"a.png"}
+    # 保存待ちでない画像は待たずに成功扱い
+    assert writer.wait_for_each(["c.png"]) == set()
@@ -0,0 +1,12 @@
+import argparse
+
+from api.clients import LocalStorageClient
+from api.config.settings import settings
+
+# 保存済みの画像についてサムネイルを作成する (作成済みのものはスキップ)
+parser = argparse.ArgumentParser(description="Create missing thumbnails")
+parser.add_argument("--workers", type=int, default=settings.INGEST_DECODE_WORKERS)
+args = parser.parse_args()
+
+created, failed = LocalStorageClient(settings).backfill_thumbnails(args.workers)
+print(f"created={created} failed={failed}")
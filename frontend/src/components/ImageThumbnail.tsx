@@ -14,10 +14,11 @@ const ImageThumbnail: React.FC<ImageThumbnailProps> = ({ image, isSelected, onSe
       } rounded-lg overflow-hidden transition-shadow duration-300 hover:shadow-lg p-4`}
     >
       <Image
-        src={`/data/generated_images/${image.image_filename}`}
+        src={`${process.env.NEXT_PUBLIC_API_BASE_URL ?? ""}/api/image/thumbnail/256/${image.image_filename}`}
         alt={image.prompt}
         width={200}
         height={200}
+        unoptimized // サムネイルはバックエンドで縮小済み
         className="rounded-lg object-cover mb-2" // 下にマージンを追加
         onClick={onSelect}
       />